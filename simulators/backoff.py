@@ -0,0 +1,41 @@
+"""Retrying of requests that the web service rejected with `429 Too Many
+Requests` because a queue is full.
+
+The delay starts at the server's `Retry-After` and doubles with every attempt
+up to `MAX_DELAY_S`. A uniformly random jitter of up to the same delay is
+added so that many clients that were rejected at the same time do not all
+come back at the same time.
+"""
+
+import random
+import requests
+import time
+
+MAX_ATTEMPTS = 6
+MAX_DELAY_S = 300
+DEFAULT_RETRY_AFTER_S = 1
+
+
+def post(url, **kwargs):
+    """Like `requests.post`, but retries while the server answers with 429.
+    Returns the last response.
+    """
+    attempt = 0
+    while True:
+        resp = requests.post(url, **kwargs)
+        if resp.status_code != 429 or attempt + 1 >= MAX_ATTEMPTS:
+            return resp
+        delay = get_delay(resp, attempt)
+        print("[!] %s: queue is full, retrying in %.1f s" % (url, delay))
+        time.sleep(delay)
+        attempt += 1
+
+
+def get_delay(resp, attempt):
+    try:
+        retry_after = float(resp.headers.get('Retry-After', DEFAULT_RETRY_AFTER_S))
+    except ValueError:
+        # An HTTP date; not sent by our server
+        retry_after = DEFAULT_RETRY_AFTER_S
+    delay = min(MAX_DELAY_S, retry_after * 2 ** attempt)
+    return delay + random.uniform(0, delay)
@@ -0,0 +1,204 @@
+"""Micro-benchmarks for the crypto of the simulators. They do not need a
+running web service.
+"""
+
+import argparse
+import crypto
+import time
+import trial
+
+from nacl.public import PrivateKey
+
+
+def _measure(name, count, function):
+    start = time.perf_counter()
+    function()
+    duration = time.perf_counter() - start
+    print("%s: %.0f packets/s (%.1f us per packet)" % (name, count / duration, 1e6 * duration / count))
+
+
+def bench_crypto_batch(args):
+    """Runs every step of both directions for `args.packets` packets with the
+    per-packet and the batch operations.
+    """
+    sgx_priv, sgx_pub = crypto.create_keypair()
+    sgx_sign_priv, sgx_sign_pub = crypto.create_sign_keypair()
+    reporter_priv, reporter_pub = crypto.create_keypair()
+    user_priv, user_pub = crypto.create_keypair()
+
+    text = "Hello World!"
+    dummy_pub = PrivateKey.generate().public_key
+    user_messages = [(reporter_pub if i % 2 else dummy_pub, text, i % 2 == 1) for i in range(args.packets)]
+    reporter_messages = [(user_pub if i % 2 else dummy_pub, text, i % 2 == 1) for i in range(args.packets)]
+
+    user_packets = crypto.user_encrypt_messages(user_pub, sgx_pub, user_messages)
+    reporter_packets = crypto.reporter_encrypt_messages_to_user(reporter_priv, sgx_pub, reporter_messages)
+    user_payloads = [payload for _, payload in crypto.sgx_decrypt_packets_from_user(sgx_priv, user_packets)]
+    reporter_payloads = [payload for _, payload in crypto.sgx_decrypt_packets_from_reporter(sgx_priv, reporter_packets)]
+    reporter_inbox = crypto.sgx_sign_packets_to_reporter(sgx_sign_priv, user_payloads)
+    dead_drop = crypto.sgx_sign_packets_to_user(sgx_sign_priv, reporter_payloads)
+
+    def trial_decrypt(decrypt, packets):
+        for packet in packets:
+            try:
+                decrypt(packet)
+            except crypto.CryptoError:
+                pass
+
+    steps = [
+        ('user_encrypt_message',
+         lambda: [crypto.user_encrypt_message(user_pub, sgx_pub, *m) for m in user_messages],
+         lambda: crypto.user_encrypt_messages(user_pub, sgx_pub, user_messages)),
+        ('sgx_decrypt_packet_from_user',
+         lambda: [crypto.sgx_decrypt_packet_from_user(sgx_priv, p) for p in user_packets],
+         lambda: crypto.sgx_decrypt_packets_from_user(sgx_priv, user_packets)),
+        ('sgx_sign_packet_to_reporter',
+         lambda: [crypto.sgx_sign_packet_to_reporter(sgx_sign_priv, p) for p in user_payloads],
+         lambda: crypto.sgx_sign_packets_to_reporter(sgx_sign_priv, user_payloads)),
+        ('reporter_decrypt_packet_from_sgx',
+         lambda: trial_decrypt(
+             lambda p: crypto.reporter_decrypt_packet_from_sgx(reporter_priv, sgx_sign_pub, p), reporter_inbox),
+         lambda: crypto.reporter_decrypt_packets_from_sgx(reporter_priv, sgx_sign_pub, reporter_inbox)),
+        ('reporter_encrypt_message_to_user',
+         lambda: [crypto.reporter_encrypt_message_to_user(reporter_priv, sgx_pub, *m) for m in reporter_messages],
+         lambda: crypto.reporter_encrypt_messages_to_user(reporter_priv, sgx_pub, reporter_messages)),
+        ('sgx_decrypt_packet_from_reporter',
+         lambda: [crypto.sgx_decrypt_packet_from_reporter(sgx_priv, p) for p in reporter_packets],
+         lambda: crypto.sgx_decrypt_packets_from_reporter(sgx_priv, reporter_packets)),
+        ('sgx_sign_packet_to_user',
+         lambda: [crypto.sgx_sign_packet_to_user(sgx_sign_priv, p) for p in reporter_payloads],
+         lambda: crypto.sgx_sign_packets_to_user(sgx_sign_priv, reporter_payloads)),
+        ('user_decrypt_packet_from_sgx',
+         lambda: trial_decrypt(
+             lambda p: crypto.user_decrypt_packet_from_sgx(user_priv, reporter_pub, sgx_sign_pub, p), dead_drop),
+         lambda: crypto.user_decrypt_packets_from_sgx(user_priv, reporter_pub, sgx_sign_pub, dead_drop)),
+    ]
+    for name, single, batch in steps:
+        _measure(name, args.packets, single)
+        _measure(name + " (batch)", args.packets, batch)
+
+
+def bench_contexts(args):
+    """Trial-decrypts a dead drop and a reporter inbox of `args.packets`
+    packets, of which every tenth is addressed to us, and encrypts as many
+    replies: once per packet with the functions and once with the contexts.
+    """
+    sgx_priv, sgx_pub = crypto.create_keypair()
+    sgx_sign_priv, sgx_sign_pub = crypto.create_sign_keypair()
+    reporter_priv, reporter_pub = crypto.create_keypair()
+    user_priv, user_pub = crypto.create_keypair()
+    sgx = crypto.SgxContext(sgx_priv, sgx_sign_priv)
+    user = crypto.UserContext(user_priv, sgx_pub, sgx_sign_pub)
+    reporter = crypto.ReporterContext(reporter_priv, sgx_pub, sgx_sign_pub)
+
+    text = "Hello World!"
+    dummy_pub = PrivateKey.generate().public_key
+    replies = [(user_pub, text, True)] * args.packets
+    reporter_packets = reporter.encrypt_messages_to_user(
+        [(user_pub if i % 10 == 0 else dummy_pub, text, True) for i in range(args.packets)])
+    dead_drop = sgx.sign_packets_to_user([payload for _, payload in sgx.decrypt_packets_from_reporter(reporter_packets)])
+    user_packets = user.encrypt_messages(
+        [(reporter_pub if i % 10 == 0 else dummy_pub, text, True) for i in range(args.packets)])
+    reporter_inbox = sgx.sign_packets_to_reporter([payload for _, payload in sgx.decrypt_packets_from_user(user_packets)])
+
+    def trial_decrypt(decrypt, packets):
+        for packet in packets:
+            try:
+                decrypt(packet)
+            except crypto.CryptoError:
+                pass
+
+    _measure("user_decrypt_packet_from_sgx", args.packets, lambda: trial_decrypt(
+        lambda p: crypto.user_decrypt_packet_from_sgx(user_priv, reporter_pub, sgx_sign_pub, p), dead_drop))
+    _measure("UserContext.decrypt_packet_from_sgx", args.packets, lambda: trial_decrypt(
+        lambda p: user.decrypt_packet_from_sgx(reporter_pub, p), dead_drop))
+    _measure("UserContext.decrypt_packets_from_sgx", args.packets, lambda: user.decrypt_packets_from_sgx(
+        reporter_pub, dead_drop))
+    _measure("reporter_decrypt_packet_from_sgx", args.packets, lambda: trial_decrypt(
+        lambda p: crypto.reporter_decrypt_packet_from_sgx(reporter_priv, sgx_sign_pub, p), reporter_inbox))
+    _measure("ReporterContext.decrypt_packet_from_sgx", args.packets, lambda: trial_decrypt(
+        reporter.decrypt_packet_from_sgx, reporter_inbox))
+    _measure("ReporterContext.decrypt_packets_from_sgx", args.packets, lambda: reporter.decrypt_packets_from_sgx(
+        reporter_inbox))
+    _measure("reporter_encrypt_message_to_user", args.packets, lambda: [
+        crypto.reporter_encrypt_message_to_user(reporter_priv, sgx_pub, *m) for m in replies])
+    _measure("ReporterContext.encrypt_message_to_user", args.packets, lambda: [
+        reporter.encrypt_message_to_user(*m) for m in replies])
+
+
+def bench_trial_decryption(args):
+    """Trial-decrypts a dead drop of `args.packets` packets, of which every
+    tenth is addressed to the user, with each of `args.workers` workers.
+    """
+    import functools
+
+    sgx_priv, sgx_pub = crypto.create_keypair()
+    sgx_sign_priv, sgx_sign_pub = crypto.create_sign_keypair()
+    reporter_priv, reporter_pub = crypto.create_keypair()
+    user_priv, user_pub = crypto.create_keypair()
+    sgx = crypto.SgxContext(sgx_priv, sgx_sign_priv)
+    user = crypto.UserContext(user_priv, sgx_pub, sgx_sign_pub)
+    reporter = crypto.ReporterContext(reporter_priv, sgx_pub, sgx_sign_pub)
+
+    dummy_pub = PrivateKey.generate().public_key
+    reporter_packets = reporter.encrypt_messages_to_user(
+        [(user_pub if i % 10 == 0 else dummy_pub, "Hello World!", True) for i in range(args.packets)])
+    dead_drop = sgx.sign_packets_to_user([payload for _, payload in sgx.decrypt_packets_from_reporter(reporter_packets)])
+
+    decrypt_packets = functools.partial(user.decrypt_packets_from_sgx, reporter_pub)
+    kind = 'processes' if args.processes else 'threads'
+    for workers in args.workers:
+        with trial.TrialDecryptor(decrypt_packets, workers, args.processes, args.chunk_size) as decryptor:
+            # Starts the workers
+            decryptor.decrypt(dead_drop[:workers * args.chunk_size])
+            _measure("TrialDecryptor (%d %s)" % (workers, kind), args.packets, lambda: decryptor.decrypt(dead_drop))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='CoverDrop simulator benchmarks')
+    subparsers = parser.add_subparsers()
+
+    parser_crypto_batch = subparsers.add_parser(
+        'crypto_batch',
+        help='Compares the per-packet and batch operations of crypto.py')
+    parser_crypto_batch.add_argument(
+        '--packets',
+        type=int, default=2000, metavar='n',
+        help='Number of packets per operation; half of them are dummies (default: 2000)')
+    parser_crypto_batch.set_defaults(func=bench_crypto_batch)
+
+    parser_contexts = subparsers.add_parser(
+        'contexts',
+        help='Compares the per-packet functions of crypto.py with the contexts')
+    parser_contexts.add_argument(
+        '--packets',
+        type=int, default=10000, metavar='n',
+        help='Number of packets in the dead drop and the inbox (default: 10000)')
+    parser_contexts.set_defaults(func=bench_contexts)
+
+    parser_trial_decryption = subparsers.add_parser(
+        'trial_decryption',
+        help='Measures the trial decryption of the dead drop with several workers')
+    parser_trial_decryption.add_argument(
+        '--packets',
+        type=int, default=10000, metavar='n',
+        help='Number of packets in the dead drop (default: 10000)')
+    parser_trial_decryption.add_argument(
+        '--workers',
+        type=int, nargs='+', default=[1, 2, 4], metavar='n',
+        help='Numbers of workers (default: 1 2 4)')
+    parser_trial_decryption.add_argument(
+        '--processes',
+        action='store_true',
+        help='Uses processes instead of threads')
+    parser_trial_decryption.add_argument(
+        '--chunk-size',
+        type=int, default=trial.DEFAULT_CHUNK_SIZE, metavar='n',
+        help='Packets per task (default: %d)' % trial.DEFAULT_CHUNK_SIZE)
+    parser_trial_decryption.set_defaults(func=bench_trial_decryption)
+
+    args = parser.parse_args()
+    if 'func' in args:
+        args.func(args)
+    else:
+        parser.print_help()
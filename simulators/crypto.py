@@ -1,6 +1,8 @@
+import collections
 import os
 
 from nacl.encoding import HexEncoder
+from nacl.exceptions import CryptoError
 from nacl.public import Box, PublicKey, PrivateKey, SealedBox
 from nacl.signing import SigningKey, SignedMessage, VerifyKey
 
@@ -66,9 +68,10 @@ def create_sign_keypair():
 # Per entity operations
 #
 
+MAX_TEXT_LEN = 255
+
 
 def user_encrypt_message(user_pub, sgx_pub, reporter_pub, text, real=True):
-    MAX_TEXT_LEN = 255
     text_bytes = text.encode()
     assert len(text_bytes) <= MAX_TEXT_LEN
 
@@ -79,8 +82,7 @@ def user_encrypt_message(user_pub, sgx_pub, reporter_pub, text, real=True):
     inner_payload += user_pub.__bytes__()
     inner_payload.append(len(text))
     inner_payload += text_bytes
-    for _ in range(MAX_TEXT_LEN - len(text_bytes)):
-        inner_payload.append(0x00)
+    inner_payload += bytes(MAX_TEXT_LEN - len(text_bytes))
 
     # Encrypt for the reporter
     inner_box = SealedBox(reporter_pub)
@@ -129,7 +131,6 @@ def reporter_decrypt_packet_from_sgx(reporter_priv, sgx_sign_pub, packet):
 
 
 def reporter_encrypt_message_to_user(reporter_priv, sgx_pub, remote_pub, text, real=True):
-    MAX_TEXT_LEN = 255
     text_bytes = text.encode()
     assert len(text_bytes) <= MAX_TEXT_LEN
 
@@ -139,8 +140,7 @@ def reporter_encrypt_message_to_user(reporter_priv, sgx_pub, remote_pub, text, r
     inner_payload = bytearray()
     inner_payload.append(len(text))
     inner_payload += text_bytes
-    for _ in range(MAX_TEXT_LEN - len(text_bytes)):
-        inner_payload.append(0x00)
+    inner_payload += bytes(MAX_TEXT_LEN - len(text_bytes))
 
     # We can use the proper "Box" instead of the "SealedBox" since the reporter (and
     # the recipient) now both sides public keys now.
@@ -184,6 +184,261 @@ def user_decrypt_packet_from_sgx(user_priv, reporter_pub, sgx_sign_pub, packet):
     return message
 
 
+#
+# Batch operations
+#
+# They produce the same packets as the per-packet operations above, but pad all
+# messages within one preallocated buffer and create every box only once. The
+# decrypt operations for the apps return None for the packets that are not
+# addressed to them instead of raising a `CryptoError`.
+#
+
+
+def user_encrypt_messages(user_pub, sgx_pub, messages):
+    """Returns the packets of `messages`, a sequence of `(reporter_pub, text,
+    real)` tuples. See `user_encrypt_message`.
+    """
+    return _encrypt_for_sgx(
+        SealedBox(sgx_pub), messages, _pad_messages([text for _, text, _ in messages], user_pub.__bytes__()),
+        _get_sealed_box, 385)
+
+
+def sgx_decrypt_packets_from_user(sgx_priv, packets):
+    """Returns the `(is_real, payload)` tuples of the `packets`."""
+    return _decrypt_from_sgx(SealedBox(sgx_priv), packets, 337)
+
+
+def sgx_sign_packets_to_reporter(sgx_sign_priv, packets):
+    return _sign_packets(sgx_sign_priv, packets, 400)
+
+
+def reporter_decrypt_packets_from_sgx(reporter_priv, sgx_sign_pub, packets):
+    """Returns the `(remote_pub, message)` tuple of every packet or None if it
+    is not addressed to this reporter.
+    """
+    return _trial_decrypt(sgx_sign_pub, SealedBox(reporter_priv), packets, _unpack_user_payload)
+
+
+def reporter_encrypt_messages_to_user(reporter_priv, sgx_pub, messages):
+    """Returns the packets of `messages`, a sequence of `(remote_pub, text,
+    real)` tuples. See `reporter_encrypt_message_to_user`.
+    """
+    return _encrypt_for_sgx(
+        SealedBox(sgx_pub), messages, _pad_messages([text for _, text, _ in messages]),
+        _cache_by_key(lambda remote_pub: Box(reporter_priv, remote_pub)), 345)
+
+
+def sgx_decrypt_packets_from_reporter(sgx_priv, packets):
+    """Returns the `(is_real, payload)` tuples of the `packets`."""
+    return _decrypt_from_sgx(SealedBox(sgx_priv), packets, 297)
+
+
+def sgx_sign_packets_to_user(sgx_sign_priv, packets):
+    return _sign_packets(sgx_sign_priv, packets, 360)
+
+
+def user_decrypt_packets_from_sgx(user_priv, reporter_pub, sgx_sign_pub, packets):
+    """Returns the message of every packet or None if it is not addressed to
+    this user.
+    """
+    return _trial_decrypt(sgx_sign_pub, Box(user_priv, reporter_pub), packets, _unpack_reporter_payload)
+
+
+#
+# Per entity contexts
+#
+# Constructing a `Box` computes the X25519 shared key of both key pairs and
+# constructing a `SealedBox` from a private key computes its public key. A
+# context creates these boxes once for the lifetime of the entity instead of
+# once per packet or batch and keeps the `Box`es of the most recently used
+# peers. Their operations behave like the functions above.
+#
+
+BOX_CACHE_SIZE = 64
+
+
+class UserContext:
+
+    def __init__(self, user_priv, sgx_pub, sgx_sign_pub):
+        self.user_priv = user_priv
+        self.user_pub = user_priv.public_key
+        self.sgx_pub = sgx_pub
+        self.sgx_sign_pub = sgx_sign_pub
+        self._sgx_box = SealedBox(sgx_pub)
+        self._get_box = _cache_by_key(lambda reporter_pub: Box(user_priv, reporter_pub))
+
+    def __reduce__(self):
+        # The cached boxes are recreated by the receiving process
+        return UserContext, (self.user_priv, self.sgx_pub, self.sgx_sign_pub)
+
+    def encrypt_message(self, reporter_pub, text, real=True):
+        return self.encrypt_messages([(reporter_pub, text, real)])[0]
+
+    def encrypt_messages(self, messages):
+        """See `user_encrypt_messages`."""
+        payloads = _pad_messages([text for _, text, _ in messages], self.user_pub.__bytes__())
+        return _encrypt_for_sgx(self._sgx_box, messages, payloads, _get_sealed_box, 385)
+
+    def decrypt_packet_from_sgx(self, reporter_pub, packet):
+        return _unpack_reporter_payload(self._get_box(reporter_pub).decrypt(self.sgx_sign_pub.verify(packet)))
+
+    def decrypt_packets_from_sgx(self, reporter_pub, packets):
+        """See `user_decrypt_packets_from_sgx`."""
+        return _trial_decrypt(self.sgx_sign_pub, self._get_box(reporter_pub), packets, _unpack_reporter_payload)
+
+
+class ReporterContext:
+
+    def __init__(self, reporter_priv, sgx_pub, sgx_sign_pub):
+        self.reporter_priv = reporter_priv
+        self.sgx_pub = sgx_pub
+        self.sgx_sign_pub = sgx_sign_pub
+        self._sgx_box = SealedBox(sgx_pub)
+        self._unseal_box = SealedBox(reporter_priv)
+        self._get_box = _cache_by_key(lambda remote_pub: Box(reporter_priv, remote_pub))
+
+    def __reduce__(self):
+        return ReporterContext, (self.reporter_priv, self.sgx_pub, self.sgx_sign_pub)
+
+    def encrypt_message_to_user(self, remote_pub, text, real=True):
+        return self.encrypt_messages_to_user([(remote_pub, text, real)])[0]
+
+    def encrypt_messages_to_user(self, messages):
+        """See `reporter_encrypt_messages_to_user`."""
+        payloads = _pad_messages([text for _, text, _ in messages])
+        return _encrypt_for_sgx(self._sgx_box, messages, payloads, self._get_box, 345)
+
+    def decrypt_packet_from_sgx(self, packet):
+        return _unpack_user_payload(self._unseal_box.decrypt(self.sgx_sign_pub.verify(packet)))
+
+    def decrypt_packets_from_sgx(self, packets):
+        """See `reporter_decrypt_packets_from_sgx`."""
+        return _trial_decrypt(self.sgx_sign_pub, self._unseal_box, packets, _unpack_user_payload)
+
+
+class SgxContext:
+
+    def __init__(self, sgx_priv, sgx_sign_priv):
+        self.sgx_priv = sgx_priv
+        self.sgx_sign_priv = sgx_sign_priv
+        self._unseal_box = SealedBox(sgx_priv)
+
+    def decrypt_packets_from_user(self, packets):
+        return _decrypt_from_sgx(self._unseal_box, packets, 337)
+
+    def decrypt_packets_from_reporter(self, packets):
+        return _decrypt_from_sgx(self._unseal_box, packets, 297)
+
+    def sign_packets_to_reporter(self, packets):
+        return _sign_packets(self.sgx_sign_priv, packets, 400)
+
+    def sign_packets_to_user(self, packets):
+        return _sign_packets(self.sgx_sign_priv, packets, 360)
+
+
+def _cache_by_key(make_box, max_size=BOX_CACHE_SIZE):
+    """Returns a function `get_box(pub, cache=True)` that keeps the boxes of
+    the `max_size` most recently used public keys. Boxes of one-off keys
+    (e.g. of dummy messages) should be created with `cache=False` so that they
+    do not evict the others.
+    """
+    boxes = collections.OrderedDict()
+
+    def get_box(pub, cache=True):
+        key = pub.__bytes__()
+        box = boxes.get(key)
+        if box is not None:
+            boxes.move_to_end(key)
+            return box
+        box = make_box(pub)
+        if cache:
+            boxes[key] = box
+            if len(boxes) > max_size:
+                boxes.popitem(last=False)
+        return box
+
+    return get_box
+
+
+def _get_sealed_box(pub, cache=True):
+    # Nothing to cache: a sealed box computes a new shared key for every message
+    return SealedBox(pub)
+
+
+def _pad_messages(texts, prefix=b''):
+    """Returns the inner payloads of the `texts` as a list: the `prefix`, the
+    size of the text, the text, and zero padding.
+    """
+    payload_size = len(prefix) + 1 + MAX_TEXT_LEN
+    buffer = bytearray(payload_size * len(texts))
+    for index, text in enumerate(texts):
+        text_bytes = text.encode()
+        assert len(text_bytes) <= MAX_TEXT_LEN
+        offset = index * payload_size
+        buffer[offset:offset + len(prefix)] = prefix
+        offset += len(prefix)
+        buffer[offset] = len(text)
+        buffer[offset + 1:offset + 1 + len(text_bytes)] = text_bytes
+
+    # PyNaCl only accepts `bytes`, and slices of `bytes` are `bytes`
+    buffer = bytes(buffer)
+    return [buffer[offset:offset + payload_size] for offset in range(0, len(buffer), payload_size)]
+
+
+def _encrypt_for_sgx(sgx_box, messages, payloads, get_box, packet_size):
+    """Encrypts each payload with the box of the recipient of its message,
+    prepends the real/dummy flag, and encrypts the result with the `sgx_box`.
+    """
+    packets = []
+    for (recipient_pub, _, real), payload in zip(messages, payloads):
+        # Dummy messages go to one-off keys whose boxes are not worth caching
+        outer_payload = (b'\x01' if real else b'\x00') + get_box(recipient_pub, cache=real).encrypt(payload)
+        packet = sgx_box.encrypt(outer_payload)
+        assert len(packet) == packet_size, f"got: {len(packet)}"
+        packets.append(packet)
+    return packets
+
+
+def _decrypt_from_sgx(unseal_box, packets, payload_size):
+    result = []
+    for packet in packets:
+        payload = unseal_box.decrypt(packet)
+        assert len(payload) == payload_size, f"got: {len(payload)}"
+        result.append((payload[0] == 0x01, payload[1:]))
+    return result
+
+
+def _sign_packets(sgx_sign_priv, packets, packet_size):
+    signed_packets = [sgx_sign_priv.sign(packet) for packet in packets]
+    for signed_packet in signed_packets:
+        assert len(signed_packet) == packet_size, f"got: {len(signed_packet)}"
+    return signed_packets
+
+
+def _trial_decrypt(sgx_sign_pub, box, packets, unpack):
+    result = []
+    for packet in packets:
+        try:
+            payload = box.decrypt(sgx_sign_pub.verify(packet))
+        except CryptoError:
+            result.append(None)
+            continue
+        result.append(unpack(payload))
+    return result
+
+
+def _unpack_user_payload(payload):
+    """Returns the public key and the message of a user."""
+    size = payload[32]
+    return PublicKey(payload[0:32]), payload[33:33+size]
+
+
+def _unpack_reporter_payload(payload):
+    """Returns the message of a reporter."""
+    size = payload[0]
+    return payload[1:1+size]
+
+
 def output(identifier, bytes):
     hexstring = HexEncoder().encode(bytes).decode()
     print(identifier + ":", hexstring, "(%dB)" % len(bytes))
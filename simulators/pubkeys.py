@@ -0,0 +1,39 @@
+"""Client side of `/pubkeys`: keeps the last key bundle and its ETag and
+revalidates it with `If-None-Match`.
+
+The web service answers `304 Not Modified` without a body as long as the
+keys stay the same, so the simulators can check for new keys in every
+iteration at almost no cost and only parse them again once they changed.
+"""
+
+import requests
+
+
+class PubKeys:
+    """The keys of the last `/pubkeys` response as returned by `parse`, a
+    function of the JSON body.
+    """
+
+    def __init__(self, url, auth_headers, parse):
+        self.url = url + '/pubkeys'
+        self.auth_headers = auth_headers
+        self.parse = parse
+        self.keys = None
+        self._etag = None
+
+    def refresh(self):
+        """Downloads and parses the keys if they changed since the last call
+        and returns whether they did.
+        """
+        print("[ ] GET /pubkeys")
+        headers = dict(self.auth_headers)
+        if self._etag is not None:
+            headers['If-None-Match'] = self._etag
+        resp = requests.get(self.url, headers=headers)
+        if resp.status_code == 304 and self.keys is not None:
+            return False
+        resp.raise_for_status()
+
+        self.keys = self.parse(resp.json())
+        self._etag = resp.headers.get('ETag')
+        return True
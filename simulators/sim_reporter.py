@@ -1,12 +1,16 @@
 import argparse
 
 from nacl.exceptions import BadSignatureError, CryptoError
+import backoff
 import crypto
 import datetime
 import json
 import os
+import pubkeys
 import time
 import requests
+import trial
+import wire
 
 from nacl.encoding import HexEncoder
 from nacl.public import PrivateKey, SealedBox
@@ -14,6 +18,9 @@ from nacl.public import PrivateKey, SealedBox
 AUTH_HEADERS_USER = {'Authorization': 'Token reporter_app_token'}
 JSON_HEADERS = {'Content-Type': 'application/json'}
 
+# Default of COVERDROP_INGEST_MAX_BATCH_PACKETS on the server
+MAX_BATCH_PACKETS = 100
+
 
 def get_json(args, path, auth_headers=AUTH_HEADERS_USER):
     print("[ ] GET", path)
@@ -25,11 +32,54 @@ def get_json(args, path, auth_headers=AUTH_HEADERS_USER):
 def post(args, path, data, auth_headers=AUTH_HEADERS_USER):
     print("[ ] POST", path)
     headers = headers = {**auth_headers, **JSON_HEADERS}
-    resp = requests.post(
+    resp = backoff.post(
         args.url + path,
         data=json.dumps(data),
         headers=headers)
     resp.raise_for_status()
+    return resp
+
+
+def get_binary(args, path, auth_headers=AUTH_HEADERS_USER):
+    print("[ ] GET", path)
+    resp = requests.get(args.url + path, headers={**auth_headers, **wire.BINARY_HEADERS})
+    resp.raise_for_status()
+    return resp
+
+
+def post_binary(args, path, data, auth_headers=AUTH_HEADERS_USER):
+    print("[ ] POST", path)
+    resp = backoff.post(args.url + path, data=data, headers={**auth_headers, **wire.BINARY_HEADERS})
+    resp.raise_for_status()
+    return resp
+
+
+def sync_inbox(args, cursor):
+    """Returns the new inbox packets since `cursor`, the next cursor, and
+    whether the server had to send the entire inbox instead.
+    """
+    path = '/reporter_inbox?since=%d' % cursor
+    if args.binary:
+        resp = get_binary(args, path)
+        packets = wire.decode(resp.content, 400)
+        return packets, int(resp.headers['X-Cursor']), resp.headers['X-Resync'] == '1'
+
+    sync = get_json(args, path)
+    packets = [crypto.from_hex(p) for p in sync['messages']]
+    return packets, sync['cursor'], sync['resync']
+
+
+def post_packets(args, packets):
+    """Posts the `packets` in as few requests as possible."""
+    for start in range(0, len(packets), MAX_BATCH_PACKETS):
+        batch = packets[start:start + MAX_BATCH_PACKETS]
+        if args.binary:
+            resp = post_binary(args, '/reporter_message/batch', wire.encode(batch, 345))
+        else:
+            resp = post(args, '/reporter_message/batch', {'messages': [crypto.to_hex(p) for p in batch]})
+        statuses = resp.json()['statuses']
+        if any(status != 'accepted' for status in statuses):
+            print("[!] Not all packets were accepted:", statuses)
 
 
 def run(args):
@@ -37,35 +87,37 @@ def run(args):
     with open(os.path.join(crypto.get_public_keys_path(), 'reporter_%d_key.hex' % args.reporter_id), 'r') as f:
         reporter_pub = crypto.read_pub_key(f.readline())
 
-    pubkeys = get_json(args, '/pubkeys', auth_headers={'Authorization': 'Token news_app_token'})
-    sgx_pub = crypto.read_pub_key(pubkeys['sgx_key'])
-    sgx_verify = crypto.read_verify_key(pubkeys['sgx_sign_key'])
-    reporter_pub_1 = crypto.read_pub_key(pubkeys['reporter_keys'][str(args.reporter_id)])
-    print("[+] Downloaded and parsed all required public keys")
-
-    assert reporter_pub == reporter_pub_1
-    print("[+] Published reporter public key matches local one")
+    keys = pubkeys.PubKeys(args.url, {'Authorization': 'Token news_app_token'}, lambda j: (
+        crypto.read_pub_key(j['sgx_key']),
+        crypto.read_verify_key(j['sgx_sign_key']),
+        crypto.read_pub_key(j['reporter_keys'][str(args.reporter_id)])))
+    decryptor = None
 
     seen_messages = set()
+    cursor = 0
 
     try:
         while True:
-            # download reporter deaddrop
-            deaddrop = get_json(args, '/reporter_inbox')
+            # check for new keys; they are only parsed again once they changed
+            if keys.refresh():
+                sgx_pub, sgx_verify, reporter_pub_1 = keys.keys
+                print("[+] Downloaded and parsed all required public keys")
+
+                assert reporter_pub == reporter_pub_1
+                print("[+] Published reporter public key matches local one")
+
+                context = crypto.ReporterContext(reporter_priv, sgx_pub, sgx_verify)
+                if decryptor is not None:
+                    decryptor.close()
+                decryptor = trial.TrialDecryptor(context.decrypt_packets_from_sgx, args.workers, args.processes)
+
+            # download the reporter deaddrop messages that are new since our last sync
+            deaddrop, cursor, resync = sync_inbox(args, cursor)
+            if resync:
+                print("[ ] Our cursor has expired. Got the entire deaddrop")
 
             # try to decode any message
-            decoded_messages = []
-            for packet in deaddrop:
-                try:
-                    m = crypto.reporter_decrypt_packet_from_sgx(
-                        reporter_priv, sgx_verify,
-                        crypto.from_hex(packet)
-                    )
-
-                except CryptoError:
-                    # ignore messages that we cannot decrypt
-                    continue
-                decoded_messages.append(m)
+            decoded_messages = decryptor.decrypt(deaddrop)
 
             new_messages = []
             for m in decoded_messages:
@@ -73,26 +125,26 @@ def run(args):
                     new_messages.append(m)
                     seen_messages.add(m)
 
-            print("[ ] Deaddrop has %d messages. I can decode %d messages and %d are new" % (
+            print("[ ] Deaddrop has %d new messages. I can decode %d messages and %d are new" % (
                 len(deaddrop),
                 len(decoded_messages),
                 len(new_messages)
             ))
 
+            messages = []
             for remote_pub, remote_text in new_messages:
                 print("[+] NEW MESSAGE:", crypto.to_hex(remote_pub.__bytes__()), remote_text)
 
                 # send a reply
                 text = "Reply at %s for: %s" % (datetime.datetime.now().strftime("%d-%b %H:%M:%S"), remote_text.decode())
                 print(f"[ ] I am sending a real message: '{text}'")
-                packet = crypto.reporter_encrypt_message_to_user(reporter_priv, sgx_pub, remote_pub, text, real=True)
-                post(args, '/reporter_message', {'message': crypto.to_hex(packet)})
+                messages.append((remote_pub, text, True))
 
             # send a dummy message
             print(f"[ ] I am sending a dummy message")
             temp_key = PrivateKey.generate().public_key
-            packet = crypto.reporter_encrypt_message_to_user(reporter_priv, sgx_pub, temp_key, "dummy", real=False)
-            post(args, '/reporter_message', {'message': crypto.to_hex(packet)})
+            messages.append((temp_key, "dummy", False))
+            post_packets(args, context.encrypt_messages_to_user(messages))
 
             print("[+] Finished iteration")
 
@@ -100,6 +152,9 @@ def run(args):
 
     except KeyboardInterrupt:
         print("Received CTRL+C")
+    finally:
+        if decryptor is not None:
+            decryptor.close()
 
 
 if __name__ == "__main__":
@@ -107,6 +162,9 @@ if __name__ == "__main__":
     parser.add_argument('--url', type=str)
     parser.add_argument('--delay', type=int, default=5)
     parser.add_argument('--reporter-id', type=int, default=1)
+    parser.add_argument('--binary', action='store_true', help='Use the binary wire format')
+    parser.add_argument('--workers', type=int, help='Workers for trial decryption (default: all cores)')
+    parser.add_argument('--processes', action='store_true', help='Trial-decrypt in processes instead of threads')
     args = parser.parse_args()
 
     run(args)
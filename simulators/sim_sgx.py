@@ -4,6 +4,7 @@ import json
 import os
 import time
 import requests
+import wire
 
 from nacl.encoding import HexEncoder
 from nacl.public import SealedBox
@@ -27,6 +28,39 @@ def post(args, path, data, auth_headers=AUTH_HEADERS_SGX):
         data=json.dumps(data),
        headers=headers)
     resp.raise_for_status()
+    return resp
+
+
+def post_binary(args, path, data, auth_headers=AUTH_HEADERS_SGX):
+    print("[ ] POST", path)
+    resp = requests.post(args.url + path, data=data, headers={**auth_headers, **wire.BINARY_HEADERS})
+    resp.raise_for_status()
+    return resp
+
+
+def claim(args, queue, count, packet_size):
+    """Leases up to `count` messages of the `queue` and returns the lease id
+    and the `(id, packet)` tuples.
+    """
+    path = '/%s/claim?count=%d' % (queue, count)
+    if args.binary:
+        resp = post_binary(args, path, b'')
+        return resp.headers['X-Lease-Id'], wire.decode_with_ids(resp.content, packet_size)
+
+    lease = post(args, path, {}).json()
+    return lease['lease_id'], [(m['id'], HexEncoder.decode(m['message'])) for m in lease['messages']]
+
+
+def release(args, queue, lease_id):
+    """Returns the messages of the lease to the `queue` before it expires."""
+    post(args, '/%s/release' % queue, {'lease_id': lease_id})
+
+
+def send(args, path, packets, packet_size):
+    if args.binary:
+        post_binary(args, path, wire.encode(packets, packet_size))
+    else:
+        post(args, path, {'messages': [crypto.to_hex(x) for x in packets]})
 
 
 def delete(args, path, headers=AUTH_HEADERS_SGX):
@@ -64,11 +98,10 @@ def run(args):
         'sgx_sign_key_private.hex'))
 
     verify_setup(args, sgx_priv, sgx_sign_priv)
+    context = crypto.SgxContext(sgx_priv, sgx_sign_priv)
 
     INPUT_THRESHOLD = 2
     OUTPUT_THRESHOLD = 4
-    buffer_user_to_reporter = []
-    buffer_reporter_to_user = []
 
     try:
         while True:
@@ -76,26 +109,25 @@ def run(args):
             # USER -> REPORTER
             # 
 
-            # get user messages
-            j = get_json(args, '/user_messages?count=2')
+            # claim user messages; they are only removed from the queue once
+            # we have acknowledged them after posting our output
+            lease_id, in_buffer = claim(args, 'user_messages', INPUT_THRESHOLD, 385)
 
-            for m in j:
-                buffer_user_to_reporter.append(m['message'])
-                delete(args, '/user_message/%d' % int(m['id']))
+            # mix only full batches so that no output can be linked to a
+            # single input; a partial batch is returned to the queue
+            if 0 < len(in_buffer) < INPUT_THRESHOLD:
+                print(f"[ ] U2R: Waiting for more than {len(in_buffer)} messages")
+                release(args, 'user_messages', lease_id)
 
-            if len(buffer_user_to_reporter) >= INPUT_THRESHOLD:
-                in_buffer = buffer_user_to_reporter[:INPUT_THRESHOLD]
-                buffer_user_to_reporter = buffer_user_to_reporter[INPUT_THRESHOLD:]
+            if len(in_buffer) >= INPUT_THRESHOLD:
                 print(f"[+] U2R: Processing {len(in_buffer)} messages")
 
                 # filter out real messages
-                out_buffer = []
-                for m in in_buffer:
-                    is_real, inner = crypto.sgx_decrypt_packet_from_user(
-                        sgx_priv,
-                        HexEncoder.decode(m))
-                    if is_real:
-                        out_buffer.append(inner)
+                out_buffer = [
+                    inner
+                    for is_real, inner in context.decrypt_packets_from_user([m for _, m in in_buffer])
+                    if is_real
+                ]
 
                 # add dummy traffic
                 num_dummy = max(0, OUTPUT_THRESHOLD - len(out_buffer))
@@ -105,38 +137,36 @@ def run(args):
                     out_buffer.append(bytes(bytearray(336)))
 
                 # sign outbuffer
-                out_buffer = [
-                    sgx_sign_priv.sign(x)
-                    for x in out_buffer
-                ]
+                out_buffer = context.sign_packets_to_reporter(out_buffer)
 
                 # post messages to reporters
-                post(args, '/send_to_reporter', {'messages': [crypto.to_hex(x) for x in out_buffer]})
+                send(args, '/send_to_reporter', out_buffer, 400)
+                post(args, '/user_messages/ack', {
+                    'lease_id': lease_id,
+                    'ids': [id for id, _ in in_buffer]})
 
 
             #
             # REPORTER -> USER
             # 
-            # get reporter messages
-            j = get_json(args, '/reporter_messages?count=2')
+            # claim reporter messages
+            lease_id, in_buffer = claim(args, 'reporter_messages', INPUT_THRESHOLD, 345)
 
-            for m in j:
-                buffer_reporter_to_user.append(m['message'])
-                delete(args, '/reporter_message/%d' % int(m['id']))
+            # mix only full batches so that no output can be linked to a
+            # single input; a partial batch is returned to the queue
+            if 0 < len(in_buffer) < INPUT_THRESHOLD:
+                print(f"[ ] R2U: Waiting for more than {len(in_buffer)} messages")
+                release(args, 'reporter_messages', lease_id)
 
-            if len(buffer_reporter_to_user) >= INPUT_THRESHOLD:
-                in_buffer = buffer_reporter_to_user[:INPUT_THRESHOLD]
-                buffer_reporter_to_user = buffer_reporter_to_user[INPUT_THRESHOLD:]
+            if len(in_buffer) >= INPUT_THRESHOLD:
                 print(f"[+] R2U: Processing {len(in_buffer)} messages")
 
                 # filter out real messages
-                out_buffer = []
-                for m in in_buffer:
-                    is_real, inner = crypto.sgx_decrypt_packet_from_reporter(
-                        sgx_priv,
-                        HexEncoder.decode(m))
-                    if is_real:
-                        out_buffer.append(inner)
+                out_buffer = [
+                    inner
+                    for is_real, inner in context.decrypt_packets_from_reporter([m for _, m in in_buffer])
+                    if is_real
+                ]
 
                 # add dummy traffic
                 num_dummy = max(0, OUTPUT_THRESHOLD - len(out_buffer))
@@ -146,13 +176,13 @@ def run(args):
                     out_buffer.append(bytes(bytearray(296)))
 
                 # sign outbuffer
-                out_buffer = [
-                    sgx_sign_priv.sign(x)
-                    for x in out_buffer
-                ]
+                out_buffer = context.sign_packets_to_user(out_buffer)
 
                 # post messages to reporters
-                post(args, '/send_to_users', {'messages': [crypto.to_hex(x) for x in out_buffer]})
+                send(args, '/send_to_users', out_buffer, 360)
+                post(args, '/reporter_messages/ack', {
+                    'lease_id': lease_id,
+                    'ids': [id for id, _ in in_buffer]})
 
             time.sleep(args.delay)
     except KeyboardInterrupt:
@@ -163,6 +193,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--url', type=str)
     parser.add_argument('--delay', type=int, default=5)
+    parser.add_argument('--binary', action='store_true', help='Use the binary wire format')
     args = parser.parse_args()
 
     run(args)
@@ -2,15 +2,23 @@ import argparse
 
 from nacl.exceptions import BadSignatureError, CryptoError
 from nacl.public import PrivateKey
+import backoff
 import crypto
 import datetime
+import functools
 import json
+import pubkeys
 import time
 import requests
+import trial
+import wire
 
 AUTH_HEADERS_USER = {'Authorization': 'Token news_app_token'}
 JSON_HEADERS = {'Content-Type': 'application/json'}
 
+# Default of COVERDROP_INGEST_MAX_BATCH_PACKETS on the server
+MAX_BATCH_PACKETS = 100
+
 
 def get_json(args, path, auth_headers=AUTH_HEADERS_USER):
     print("[ ] GET", path)
@@ -22,11 +30,54 @@ def get_json(args, path, auth_headers=AUTH_HEADERS_USER):
 def post(args, path, data, auth_headers=AUTH_HEADERS_USER):
     print("[ ] POST", path)
     headers =  headers={**auth_headers, **JSON_HEADERS}
-    resp = requests.post(
+    resp = backoff.post(
         args.url + path, 
         data=json.dumps(data),
        headers=headers)
     resp.raise_for_status()
+    return resp
+
+
+def get_binary(args, path, auth_headers=AUTH_HEADERS_USER):
+    print("[ ] GET", path)
+    resp = requests.get(args.url + path, headers={**auth_headers, **wire.BINARY_HEADERS})
+    resp.raise_for_status()
+    return resp
+
+
+def post_binary(args, path, data, auth_headers=AUTH_HEADERS_USER):
+    print("[ ] POST", path)
+    resp = backoff.post(args.url + path, data=data, headers={**auth_headers, **wire.BINARY_HEADERS})
+    resp.raise_for_status()
+    return resp
+
+
+def sync_deaddrop(args, cursor):
+    """Returns the new deaddrop packets since `cursor`, the next cursor, and
+    whether the server had to send the entire deaddrop instead.
+    """
+    path = '/deaddrop?since=%d' % cursor
+    if args.binary:
+        resp = get_binary(args, path)
+        packets = wire.decode(resp.content, 360)
+        return packets, int(resp.headers['X-Cursor']), resp.headers['X-Resync'] == '1'
+
+    sync = get_json(args, path)
+    packets = [crypto.from_hex(p) for p in sync['messages']]
+    return packets, sync['cursor'], sync['resync']
+
+
+def post_packets(args, packets):
+    """Posts the `packets` in as few requests as possible."""
+    for start in range(0, len(packets), MAX_BATCH_PACKETS):
+        batch = packets[start:start + MAX_BATCH_PACKETS]
+        if args.binary:
+            resp = post_binary(args, '/user_message/batch', wire.encode(batch, 385))
+        else:
+            resp = post(args, '/user_message/batch', {'messages': [crypto.to_hex(p) for p in batch]})
+        statuses = resp.json()['statuses']
+        if any(status != 'accepted' for status in statuses):
+            print("[!] Not all packets were accepted:", statuses)
 
 
 def run(args):
@@ -34,30 +85,36 @@ def run(args):
     with open('user_key.hex', 'r') as f:
         user_pub = crypto.read_pub_key(f.readline())
 
-    pubkeys = get_json(args, '/pubkeys')
-    sgx_pub = crypto.read_pub_key(pubkeys['sgx_key'])
-    sgx_verify = crypto.read_verify_key(pubkeys['sgx_sign_key'])
-    reporter_pub = crypto.read_pub_key(pubkeys['reporter_keys'][str(args.reporter_contact)])
-    print("[+] Downloaded and parsed all required public keys")
+    keys = pubkeys.PubKeys(args.url, AUTH_HEADERS_USER, lambda j: (
+        crypto.read_pub_key(j['sgx_key']),
+        crypto.read_verify_key(j['sgx_sign_key']),
+        crypto.read_pub_key(j['reporter_keys'][str(args.reporter_contact)])))
+    decryptor = None
 
     seen_messages = set()
+    cursor = 0
 
     try:
         while True:
-            # download user deaddrop
-            deaddrop = get_json(args, '/deaddrop')
+            # check for new keys; they are only parsed again once they changed
+            if keys.refresh():
+                sgx_pub, sgx_verify, reporter_pub = keys.keys
+                print("[+] Downloaded and parsed all required public keys")
+
+                context = crypto.UserContext(user_priv, sgx_pub, sgx_verify)
+                assert context.user_pub == user_pub
+                if decryptor is not None:
+                    decryptor.close()
+                decryptor = trial.TrialDecryptor(
+                    functools.partial(context.decrypt_packets_from_sgx, reporter_pub), args.workers, args.processes)
+
+            # download the user deaddrop messages that are new since our last sync
+            deaddrop, cursor, resync = sync_deaddrop(args, cursor)
+            if resync:
+                print("[ ] Our cursor has expired. Got the entire deaddrop")
 
             # try to decode any message
-            decoded_messages = []
-            for packet in deaddrop:
-                try:
-                    m = crypto.user_decrypt_packet_from_sgx(
-                        user_priv, reporter_pub, sgx_verify,
-                        crypto.from_hex(packet)
-                    )
-                except CryptoError:
-                    continue
-                decoded_messages.append(m)
+            decoded_messages = decryptor.decrypt(deaddrop)
 
             new_messages = []
             for m in decoded_messages:
@@ -65,7 +122,7 @@ def run(args):
                     new_messages.append(m)
                     seen_messages.add(m)
 
-            print("[ ] Deaddrop has %d messages. I can decode %d messages and %d are new" % (
+            print("[ ] Deaddrop has %d new messages. I can decode %d messages and %d are new" % (
                 len(deaddrop),
                 len(decoded_messages),
                 len(new_messages)
@@ -77,14 +134,15 @@ def run(args):
             # send a new message
             text = "Hello at %s local time" % datetime.datetime.now().strftime("%d-%b %H:%M:%S")
             print(f"[ ] I am sending a real message: '{text}'")
-            packet = crypto.user_encrypt_message(user_pub, sgx_pub, reporter_pub, text, real=True)
-            post(args, '/user_message', {'message': crypto.to_hex(packet)})
 
             # send a dummy message
             print(f"[ ] I am sending a dummy message")
             temp_key = PrivateKey.generate().public_key
-            packet = crypto.user_encrypt_message(user_pub, sgx_pub, temp_key, "dummy", real=False)
-            post(args, '/user_message', {'message': crypto.to_hex(packet)})
+            packets = context.encrypt_messages([
+                (reporter_pub, text, True),
+                (temp_key, "dummy", False),
+            ])
+            post_packets(args, packets)
 
             print("[+] Finished iteration")
 
@@ -92,6 +150,9 @@ def run(args):
 
     except KeyboardInterrupt:
         print("Received CTRL+C")
+    finally:
+        if decryptor is not None:
+            decryptor.close()
 
 
 if __name__ == "__main__":
@@ -99,6 +160,9 @@ if __name__ == "__main__":
     parser.add_argument('--url', type=str)
     parser.add_argument('--delay', type=int, default=5)
     parser.add_argument('--reporter-contact', type=int, default=1)
+    parser.add_argument('--binary', action='store_true', help='Use the binary wire format')
+    parser.add_argument('--workers', type=int, help='Workers for trial decryption (default: all cores)')
+    parser.add_argument('--processes', action='store_true', help='Trial-decrypt in processes instead of threads')
     args = parser.parse_args()
 
     run(args)
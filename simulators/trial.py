@@ -0,0 +1,79 @@
+"""Parallel trial decryption of the dead drop and the reporter inbox.
+
+An app cannot tell which packets are addressed to it and therefore tries to
+decrypt every one of them. `TrialDecryptor` splits the packets into chunks
+and decrypts them on a pool of workers. PyNaCl releases the GIL while in
+libsodium, so threads already use several cores; processes additionally
+parallelize the Python overhead per packet but have to copy the packets.
+"""
+
+import concurrent.futures
+import os
+
+DEFAULT_CHUNK_SIZE = 256
+
+
+class TrialDecryptor:
+    """Decrypts packets with `decrypt_packets`, a function that returns a
+    list with the result of each packet or None if it is not addressed to us
+    (e.g. `UserContext.decrypt_packets_from_sgx` with the reporter key bound).
+    For processes it must be picklable; it is sent to every worker once.
+    """
+
+    def __init__(self, decrypt_packets, workers=None, processes=False, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.decrypt_packets = decrypt_packets
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self._executor = None
+        if self.workers > 1 and processes:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, initializer=_init_worker, initargs=(decrypt_packets,))
+            self._decrypt_chunk = _decrypt_in_worker
+        elif self.workers > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+            self._decrypt_chunk = decrypt_packets
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+
+    def decrypt(self, packets, max_matches=None):
+        """Returns the results of the packets that are addressed to us in the
+        order of `packets`. Stops after the first `max_matches` of them.
+        """
+        chunks = [packets[i:i + self.chunk_size] for i in range(0, len(packets), self.chunk_size)]
+        if self._executor is None:
+            results = map(self.decrypt_packets, chunks)
+        else:
+            futures = [self._executor.submit(self._decrypt_chunk, chunk) for chunk in chunks]
+            results = (future.result() for future in futures)
+
+        matches = []
+        try:
+            for result in results:
+                matches.extend(r for r in result if r is not None)
+                if max_matches is not None and len(matches) >= max_matches:
+                    return matches[:max_matches]
+            return matches
+        finally:
+            if self._executor is not None:
+                for future in futures:
+                    future.cancel()
+
+
+_worker_decrypt_packets = None
+
+
+def _init_worker(decrypt_packets):
+    global _worker_decrypt_packets
+    _worker_decrypt_packets = decrypt_packets
+
+
+def _decrypt_in_worker(packets):
+    return _worker_decrypt_packets(packets)
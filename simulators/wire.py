@@ -0,0 +1,37 @@
+"""Client side of the binary wire format of the web service (see
+`webapi/src/wire.py`): a 9-byte header followed by fixed-size records.
+"""
+
+import struct
+
+MEDIA_TYPE = 'application/octet-stream'
+BINARY_HEADERS = {'Content-Type': MEDIA_TYPE, 'Accept': MEDIA_TYPE}
+
+MAGIC = b'CD'
+VERSION = 1
+HEADER = struct.Struct('!2sBHI')
+ID = struct.Struct('!Q')
+
+
+def encode(packets, packet_size):
+    for packet in packets:
+        assert len(packet) == packet_size, f"got: {len(packet)}"
+    return HEADER.pack(MAGIC, VERSION, packet_size, len(packets)) + b''.join(packets)
+
+
+def decode(data, packet_size):
+    magic, version, record_size, count = HEADER.unpack_from(data)
+    assert magic == MAGIC and version == VERSION
+    assert record_size == packet_size, f"got: {record_size}"
+    assert len(data) == HEADER.size + count * record_size
+
+    return [
+        data[offset:offset + record_size]
+        for offset in range(HEADER.size, len(data), record_size)
+    ]
+
+
+def decode_with_ids(data, packet_size):
+    """Returns the `(id, packet)` tuples of a response of the SGX queue endpoints."""
+    records = decode(data, ID.size + packet_size)
+    return [(ID.unpack_from(r)[0], r[ID.size:]) for r in records]
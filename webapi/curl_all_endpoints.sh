@@ -8,6 +8,11 @@ if [ $# -lt 1 ]; then
   exit 1;
 fi
 
+# Hex-encoded packet of $1 bytes that repeats the hex digit $2
+packet() {
+  printf "%0$(( $1 * 2 ))d" 0 | tr 0 "$2";
+}
+
 #
 # General public endpoints
 #
@@ -15,6 +20,12 @@ echo "-> Get all news stories (muted)";
 echo -n "Reponse body length: ";
 curl --fail -s -H "Authorization: Token news_app_token" -X GET $BASE_URL/ | wc -c;
 
+echo "-> Get first page of story summaries";
+curl --fail -s -H "Authorization: Token news_app_token" -X GET "$BASE_URL/stories?limit=5";
+
+echo "-> Search the news stories";
+curl --fail -s -H "Authorization: Token news_app_token" -X GET "$BASE_URL/search?q=lorem&limit=5";
+
 echo "-> Get first news story (muted)";
 echo -n "Reponse body length: ";
 curl --fail -s -H "Authorization: Token news_app_token" -X GET $BASE_URL/story/1 | wc -c;
@@ -31,7 +42,11 @@ curl --fail -s -H "Authorization: Token news_app_token" -X GET $BASE_URL/pubkeys
 #
 echo "-> News app sends a message";
 curl --fail -H "Authorization: Token news_app_token" -H "Content-Type: application/json" -X POST \
-    -d '{"message": "AAAAAA"}' $BASE_URL/user_message;
+    -d "{\"message\": \"$(packet 385 A)\"}" $BASE_URL/user_message;
+
+echo "-> News app sends a batch of messages";
+curl --fail -s -H "Authorization: Token news_app_token" -H "Content-Type: application/json" -X POST \
+    -d "{\"messages\": [\"$(packet 385 A)\", \"AAAAAA02\"]}" $BASE_URL/user_message/batch;
 
 echo "-> SGX gets user messages";
 curl --fail -s -H "Authorization: Token sgx_token" -X GET $BASE_URL/user_messages?count=10;
@@ -39,16 +54,31 @@ curl --fail -s -H "Authorization: Token sgx_token" -X GET $BASE_URL/user_message
 echo "-> SGX deletes user message";
 curl --fail -H "Authorization: Token sgx_token" -X DELETE $BASE_URL/user_message/1;
 
+echo "-> SGX claims user messages";
+curl --fail -s -H "Authorization: Token sgx_token" -X POST $BASE_URL/user_messages/claim?count=10;
+
+echo "-> SGX acknowledges claimed user messages";
+curl --fail -s -H "Authorization: Token sgx_token" -H "Content-Type: application/json" -X POST \
+    -d '{"lease_id": "none", "ids": []}' $BASE_URL/user_messages/ack;
+
+echo "-> SGX releases claimed user messages";
+curl --fail -s -H "Authorization: Token sgx_token" -H "Content-Type: application/json" -X POST \
+    -d '{"lease_id": "none"}' $BASE_URL/user_messages/release;
+
 echo "-> SGX posts message to reporter";
 curl --fail -H "Authorization: Token sgx_token" -H "Content-Type: application/json" -X POST \
-    -d '{"messages": ["BBBBBB01", "BBBBBB02"]}' $BASE_URL/send_to_reporter;
+    -d "{\"messages\": [\"$(packet 400 B)\", \"$(packet 400 B)\"]}" $BASE_URL/send_to_reporter;
 
 echo "-> Reporter app gets reporter inbox";
 curl --fail -s -H "Authorization: Token reporter_app_token" -X GET $BASE_URL/reporter_inbox;
 
 echo "-> Reporter app sends message";
 curl --fail -s -H "Authorization: Token reporter_app_token" -H "Content-Type: application/json" -X POST \
-    -d '{"message": "CCCCCC"}' $BASE_URL/reporter_message;
+    -d "{\"message\": \"$(packet 345 C)\"}" $BASE_URL/reporter_message;
+
+echo "-> Reporter app sends a batch of messages";
+curl --fail -s -H "Authorization: Token reporter_app_token" -H "Content-Type: application/json" -X POST \
+    -d "{\"messages\": [\"$(packet 345 C)\", \"CCCCCC02\"]}" $BASE_URL/reporter_message/batch;
 
 echo "-> SGX gets reporter message";
 curl --fail -s -H "Authorization: Token sgx_token" -X GET $BASE_URL/reporter_messages?count=10 ;
@@ -56,11 +86,26 @@ curl --fail -s -H "Authorization: Token sgx_token" -X GET $BASE_URL/reporter_mes
 echo "-> SGX deletes reporter message";
 curl --fail -H "Authorization: Token sgx_token" -X DELETE $BASE_URL/reporter_message/1;
 
+echo "-> SGX claims reporter messages";
+curl --fail -s -H "Authorization: Token sgx_token" -X POST $BASE_URL/reporter_messages/claim?count=10;
+
+echo "-> SGX acknowledges claimed reporter messages";
+curl --fail -s -H "Authorization: Token sgx_token" -H "Content-Type: application/json" -X POST \
+    -d '{"lease_id": "none", "ids": []}' $BASE_URL/reporter_messages/ack;
+
+echo "-> SGX releases claimed reporter messages";
+curl --fail -s -H "Authorization: Token sgx_token" -H "Content-Type: application/json" -X POST \
+    -d '{"lease_id": "none"}' $BASE_URL/reporter_messages/release;
+
 echo "-> SGX posts message to user";
 curl --fail -H "Authorization: Token sgx_token" -H "Content-Type: application/json" -X POST \
-    -d '{"messages": ["DDDDDD01", "DDDDDD02"]}' $BASE_URL/send_to_users;
+    -d "{\"messages\": [\"$(packet 360 D)\", \"$(packet 360 D)\"]}" $BASE_URL/send_to_users;
 
 echo "-> News app gets deaddrop (muted)";
 curl --fail -s -H "Authorization: Token news_app_token" -X GET $BASE_URL/deaddrop ;
 
+echo "-> Monitoring scrapes metrics (muted)";
+echo -n "Reponse body length: ";
+curl --fail -s -H "Authorization: Token monitoring_token" -X GET $BASE_URL/metrics | wc -c;
+
 echo "[+] All endpoints appear to be up and not throwing"
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""Admission control for the user and reporter message queues.
+
+If the SGX stops draining a queue, it must not grow without bounds. Each
+worker therefore checks the backlog of a queue against its capacity before
+accepting a message. The backlog is counted in the database at most every
+`COVERDROP_QUEUE_COUNT_CACHE_MS` per worker and incremented locally for every
+admitted message in between. Only one request of a worker refreshes the
+count at a time while the others keep using the cached one.
+
+The cap is enforced by every worker on its own: a worker does not see the
+messages that the others admitted since its last count, so a queue can exceed
+its cap by up to the number of workers times the messages that a worker admits
+within `COVERDROP_QUEUE_COUNT_CACHE_MS`.
+
+Once a queue is full, messages are either rejected with `429 Too Many
+Requests` (`COVERDROP_QUEUE_FULL_MODE=reject`) or silently dropped while the
+request still succeeds (`shed`). As the server cannot tell real from dummy
+messages, shedding drops both alike and a client cannot learn anything from
+the response.
+"""
+
+import config
+import datastore
+import threading
+import time
+
+USER_MESSAGES = 'user_messages'
+REPORTER_MESSAGES = 'reporter_messages'
+
+MODE_REJECT = 'reject'
+MODE_SHED = 'shed'
+
+_counts = {}
+_counted_at = None
+# Messages admitted while the count is refreshed, which the query may miss
+_admitted_while_refreshing = None
+_lock = threading.Lock()
+_refreshed = threading.Condition(_lock)
+
+
+def get_capacity(queue):
+    if queue == USER_MESSAGES:
+        return config.QUEUE_MAX_USER_MESSAGES
+    return config.QUEUE_MAX_REPORTER_MESSAGES
+
+
+def admit(queue, count=1):
+    """Returns whether `count` more messages may be added to the `queue` and,
+    if so, counts them towards its backlog.
+    """
+    capacity = get_capacity(queue)
+    if capacity <= 0:
+        return True
+
+    while True:
+        if _needs_refresh():
+            _refresh()
+
+        with _lock:
+            if not _counts:
+                # This worker has not counted the queues yet; waits for the
+                # first count or, if it failed, tries again
+                if _admitted_while_refreshing is not None:
+                    _refreshed.wait()
+                continue
+            if _counts[queue] + count > capacity:
+                return False
+            _counts[queue] += count
+            if _admitted_while_refreshing is not None:
+                _admitted_while_refreshing[queue] += count
+            return True
+
+
+def _needs_refresh():
+    """Returns whether the count has expired and, if so, makes the caller
+    responsible for refreshing it.
+    """
+    global _admitted_while_refreshing
+    with _lock:
+        if _admitted_while_refreshing is not None:
+            return False
+        if _counted_at is not None and time.monotonic() - _counted_at < config.QUEUE_COUNT_CACHE_MS / 1000:
+            return False
+        _admitted_while_refreshing = {USER_MESSAGES: 0, REPORTER_MESSAGES: 0}
+        return True
+
+
+def _refresh():
+    global _counts, _counted_at, _admitted_while_refreshing
+    counts = None
+    try:
+        # Counted outside the lock so that other requests are not blocked on
+        # the query
+        counts = datastore.count_queued_messages()
+    finally:
+        with _lock:
+            if counts is not None:
+                # Messages admitted during the query may already have been
+                # counted; counting them twice errs on the safe side
+                _counts = {queue: counts[queue] + admitted
+                           for queue, admitted in _admitted_while_refreshing.items()}
+                _counted_at = time.monotonic()
+            _admitted_while_refreshing = None
+            _refreshed.notify_all()
@@ -0,0 +1,922 @@
+"""Micro-benchmarks for the web service. They run the Flask app in-process via
+its test client, so they measure the server-side cost of a request without any
+network overhead. Run from within the `src` folder like `cli.py`.
+"""
+
+from sqlalchemy.engine.url import make_url
+
+import argparse
+import os
+import threading
+import time
+
+AUTH_HEADERS_NEWS = {'Authorization': 'Token news_app_token'}
+AUTH_HEADERS_SGX = {'Authorization': 'Token sgx_token'}
+
+
+def _random_hex(num_bytes):
+    return os.urandom(num_bytes).hex()
+
+
+def _run_requests(args, make_request):
+    """Issues `args.requests` requests spread over `args.threads` threads and
+    returns the achieved requests per second.
+    """
+    from flaskapp import app
+
+    per_thread = args.requests // args.threads
+    errors = []
+
+    def worker():
+        client = app.test_client()
+        for _ in range(per_thread):
+            resp = make_request(client)
+            # Streamed bodies are only produced when they are read
+            resp.get_data()
+            if resp.status_code not in (200, 304):
+                errors.append(resp.status_code)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.perf_counter() - start
+
+    if errors:
+        print("WARNING: %d requests failed (e.g. status %d)" % (len(errors), errors[0]))
+    return per_thread * args.threads / duration
+
+
+def bench_user_message(args):
+    packet = _random_hex(385)
+
+    def make_request(client):
+        return client.post('/user_message', json={'message': packet}, headers=AUTH_HEADERS_NEWS)
+
+    rps = _run_requests(args, make_request)
+    print("POST /user_message: %.1f requests/s (%d threads)" % (rps, args.threads))
+
+
+def bench_deaddrop(args):
+    """Measures GET /deaddrop served from the snapshots or, with
+    `--no-snapshots`, by querying the database on every request.
+    """
+    import config
+    from flaskapp import app
+
+    config.SNAPSHOTS = not args.no_snapshots
+    client = app.test_client()
+    client.post('/debug/delete_all_messages', headers=AUTH_HEADERS_SGX)
+    client.post('/send_to_users',
+                json={'messages': [_random_hex(360) for _ in range(args.deaddrop_size)]},
+                headers=AUTH_HEADERS_SGX)
+
+    def make_request(client):
+        return client.get('/deaddrop', headers=AUTH_HEADERS_NEWS)
+
+    rps = _run_requests(args, make_request)
+    print("GET /deaddrop (%d messages%s): %.1f requests/s (%d threads)" % (
+        args.deaddrop_size, ', no snapshots' if args.no_snapshots else '', rps, args.threads))
+
+
+def bench_pubkeys(args):
+    """Measures GET /pubkeys served from the key bundle or, with
+    `--uncached`, by a route that reads the keys on every request as
+    `/pubkeys` did before the bundle was cached.
+    """
+    import datastore
+
+    # The key files are looked up relative to the `webapi` folder
+    if not os.path.exists(datastore.SGX_KEY_PATH):
+        os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+    import flaskapp
+    from flask import jsonify
+
+    app = flaskapp.app
+    path = '/pubkeys'
+    if args.uncached:
+        path = '/benchmark/pubkeys_uncached'
+
+        @app.route(path)
+        @flaskapp.require_service_auth(require='news_app')
+        def get_pub_keys_uncached():
+            reporters = datastore.get_all_reporters()
+            return jsonify({
+                'sgx_key': datastore.get_sgx_key(),
+                'sgx_sign_key': datastore.get_sgx_sign_key(),
+                'reporter_keys': {r.id: r.pub_key for r in reporters},
+            })
+
+    if len(datastore.get_all_reporters()) != args.reporters:
+        datastore.delete_all_reporters()
+        for i in range(args.reporters):
+            datastore.add_reporter(datastore.Reporter(name='Reporter %d' % i, pub_key=_random_hex(32)))
+
+    headers = dict(AUTH_HEADERS_NEWS)
+    if args.revalidate:
+        resp = app.test_client().get(path, headers=AUTH_HEADERS_NEWS)
+        if 'ETag' in resp.headers:
+            headers['If-None-Match'] = resp.headers['ETag']
+
+    def make_request(client):
+        return client.get(path, headers=headers)
+
+    rps = _run_requests(args, make_request)
+    print("GET /pubkeys (%d reporters%s%s): %.1f requests/s (%d threads)" % (
+        args.reporters, ', uncached' if args.uncached else '', ', revalidated' if args.revalidate else '',
+        rps, args.threads))
+
+
+def bench_stories(args):
+    """Measures the latency of the first request (i.e. before the response is
+    cached) and the throughput of GET / and GET /stories. With
+    `--per-story-reporter`, also of an uncached route that loads the reporter
+    of every story with a query of its own as GET / did before the reporters
+    were joined. `--no-response-cache` disables the cache of the responses.
+    """
+    import datastore
+    import flaskapp
+    import response_cache
+    from flask import jsonify
+    from sqlalchemy.orm import noload
+
+    app = flaskapp.app
+    if args.no_response_cache:
+        response_cache.news.max_bytes = 0
+    paths = ['/', '/stories']
+    if args.per_story_reporter:
+        paths.append('/benchmark/index_per_story_reporter')
+
+        @app.route(paths[-1])
+        @flaskapp.require_service_auth(require='news_app')
+        def get_index_per_story_reporter():
+            with datastore.ScopeSession() as session:
+                stories = session.query(datastore.NewsStory) \
+                    .options(noload(datastore.NewsStory.author)) \
+                    .order_by(datastore.NewsStory.id).all()
+            return jsonify([dict(it.to_dict(), reporter=datastore.get_reporter(it.reporter).to_dict())
+                            for it in stories])
+
+    datastore.delete_all_news_stories()
+    if not datastore.get_all_reporters():
+        for i in range(3):
+            datastore.add_reporter(datastore.Reporter(name='Reporter %d' % i, pub_key=_random_hex(32)))
+    reporter_ids = [r.id for r in datastore.get_all_reporters()]
+    for i in range(args.stories):
+        datastore.add_news_story(datastore.NewsStory(
+            headline='Headline %d' % i,
+            reporter=reporter_ids[i % len(reporter_ids)],
+            content='Lorem ipsum dolor sit amet. ' * 100,
+            image='https://example.com/%d.jpg' % i))
+
+    for path in paths:
+        def make_request(client):
+            return client.get(path, headers=AUTH_HEADERS_NEWS)
+
+        start = time.perf_counter()
+        size = len(make_request(app.test_client()).data)
+        latency = time.perf_counter() - start
+
+        rps = _run_requests(args, make_request)
+        print("GET %-8s (%d stories%s): %8d bytes  %7.1f ms  %7.1f requests/s (%d threads)" % (
+            path, args.stories, ', uncached' if args.no_response_cache else '', size, 1000 * latency, rps,
+            args.threads))
+
+
+def bench_search(args):
+    """Measures full-text searches over lorem-ipsum stories. Every headline
+    also carries one of `--keywords` random keywords so that there are
+    selective queries besides the lorem-ipsum words that occur in almost
+    every story.
+    """
+    import datastore
+    import lorem
+    import random
+
+    datastore.delete_all_news_stories()
+    start = time.perf_counter()
+    for offset in range(0, args.stories, 10000):
+        datastore.add_news_stories([datastore.NewsStory(
+            headline='%s k%d' % (lorem.sentence(), random.randrange(args.keywords)),
+            content='\n\n'.join(lorem.paragraph() for _ in range(args.paragraphs)),
+        ) for _ in range(min(10000, args.stories - offset))])
+    print("Added and indexed %d stories in %.1f s" % (args.stories, time.perf_counter() - start))
+
+    def measure(name, search):
+        durations = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            results = search()
+            durations.append(time.perf_counter() - start)
+        durations.sort()
+        print("  %-24s %4d results  p50 %8.2f ms  max %8.2f ms" % (
+            name, len(results), 1000 * durations[len(durations) // 2], 1000 * durations[-1]))
+
+    queries = ['k%d' % random.randrange(args.keywords), 'dolor', 'dolor amet', 'quiquia numquam velit']
+    print("FTS5 (first page of 20):")
+    for query in queries:
+        measure(query, lambda: datastore.search_news_stories(query, 0, 20))
+    measure(queries[1] + ' (offset 980)', lambda: datastore.search_news_stories(queries[1], 980, 20))
+
+    print("LIKE scan (first page of 20):")
+    with datastore.ScopeSession() as session:
+        for query in queries:
+            measure(query, lambda: datastore._search_news_stories_like(session, query.split(), 0, 20))
+
+
+def bench_send_to_users(args):
+    """Measures the latency of publishing a batch of the SGX. With
+    `--per-message`, the messages are committed one by one as before batches
+    were inserted within a single transaction.
+    """
+    import datastore
+    from flaskapp import app
+
+    client = app.test_client()
+    durations = []
+    for _ in range(args.batches):
+        messages = [_random_hex(360) for _ in range(args.batch_size)]
+        start = time.perf_counter()
+        if args.per_message:
+            for message in messages:
+                datastore.add_dead_drop_message(bytes.fromhex(message))
+        else:
+            resp = client.post('/send_to_users', json={'messages': messages}, headers=AUTH_HEADERS_SGX)
+            assert resp.status_code == 200, resp.status_code
+        durations.append(time.perf_counter() - start)
+
+    durations.sort()
+    print("%s (%d messages): median %.1f ms, max %.1f ms" % (
+        'add_dead_drop_message per message' if args.per_message else 'POST /send_to_users',
+        args.batch_size, 1000 * durations[len(durations) // 2], 1000 * durations[-1]))
+
+
+def bench_wire_format(args):
+    """Compares size and encoding/decoding cost of JSON with hex-encoded
+    packets against the binary wire format.
+    """
+    import json
+    import wire
+
+    packets = [os.urandom(wire.DEAD_DROP_MESSAGE_SIZE) for _ in range(args.packets)]
+
+    def measure(name, encode, decode):
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            body = encode()
+        encode_ms = 1000 * (time.perf_counter() - start) / args.rounds
+
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            decoded = decode(body)
+        decode_ms = 1000 * (time.perf_counter() - start) / args.rounds
+
+        assert decoded == packets
+        print("%-6s %9d bytes  encode %7.2f ms  decode %7.2f ms" % (name, len(body), encode_ms, decode_ms))
+
+    print("%d packets of %dB:" % (args.packets, wire.DEAD_DROP_MESSAGE_SIZE))
+    measure(
+        'json',
+        lambda: json.dumps([p.hex() for p in packets]).encode(),
+        lambda body: [bytes.fromhex(p) for p in json.loads(body)])
+    measure(
+        'binary',
+        lambda: wire.encode(packets, wire.DEAD_DROP_MESSAGE_SIZE),
+        lambda body: wire.decode(body, wire.DEAD_DROP_MESSAGE_SIZE))
+
+
+def bench_dead_drop_store(args):
+    """Compares appending and reading dead-drop messages in the SQLite
+    table against segment files.
+    """
+    import config
+    import datastore
+    import segments
+    import tempfile
+    import wire
+
+    config.DEAD_DROP_STORE = 'sqlite'
+    datastore.delete_all_messages()
+    batch = [os.urandom(wire.DEAD_DROP_MESSAGE_SIZE) for _ in range(args.batch_size)]
+    num_batches = args.packets // args.batch_size
+
+    def measure(name, append, read):
+        start = time.perf_counter()
+        for _ in range(num_batches):
+            append(batch)
+        append_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        num_read = len(read())
+        read_s = time.perf_counter() - start
+
+        assert num_read == num_batches * args.batch_size
+        print("%-8s append %8.0f packets/s   read all %6.2f s (%8.0f packets/s)" % (
+            name, num_read / append_s, read_s, num_read / read_s))
+
+    print("%d packets in batches of %d:" % (num_batches * args.batch_size, args.batch_size))
+    measure(
+        'sqlite',
+        datastore.add_dead_drop_messages,
+        lambda: datastore.get_active_dead_drop_rows(config.MESSAGE_WINDOW_HOURS))
+    datastore.delete_all_messages()
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = segments.SegmentStore(directory, wire.DEAD_DROP_MESSAGE_SIZE)
+        measure(
+            'segments',
+            store.append,
+            lambda: store.rows(config.MESSAGE_WINDOW_HOURS))
+
+        # What `/deaddrop/segments/<name>` serves: the raw records
+        start = time.perf_counter()
+        size = sum(len(store.read(segment)) for segment in store.segments(config.MESSAGE_WINDOW_HOURS))
+        duration = time.perf_counter() - start
+        print("segments read raw records %6.2f s (%.0f MB/s)" % (duration, size / 1e6 / duration))
+
+
+def bench_events(args):
+    """Holds open connections to the events sidecar and measures the time
+    from publishing dead-drop messages until every client received them.
+    """
+    import asyncio
+    import config
+    import datastore
+    import events
+    import subprocess
+    import sys
+    import tempfile
+    import wire
+
+    directory = tempfile.mkdtemp()
+    config.EVENTS_NOTIFY_SOCKET = '' if args.no_notify else os.path.join(directory, 'events.sock')
+    env = dict(os.environ, COVERDROP_EVENTS_NOTIFY_SOCKET=config.EVENTS_NOTIFY_SOCKET)
+
+    datastore.delete_all_messages()
+    sidecar = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'events.py'),
+         '--port', str(args.port)],
+        env=env, stdout=subprocess.PIPE)
+    sidecar.stdout.readline()
+
+    async def connect():
+        reader, writer = await asyncio.open_connection('127.0.0.1', args.port, limit=2 ** 20)
+        writer.write(b'GET /events/deaddrop?since=0 HTTP/1.1\r\n'
+                     b'Authorization: Token news_app_token\r\n\r\n')
+        await reader.readuntil(b'\r\n\r\n')
+        return reader, writer
+
+    async def receive(reader):
+        while True:
+            line = await reader.readline()
+            if line.startswith(b'data:'):
+                return time.perf_counter()
+
+    async def run():
+        clients = []
+        for _ in range(0, args.connections, 100):
+            clients += await asyncio.gather(*[connect() for _ in range(min(100, args.connections - len(clients)))])
+
+        with open('/proc/%d/status' % sidecar.pid) as f:
+            rss = [line.split()[1] for line in f if line.startswith('VmRSS')][0]
+        print("%d idle connections, sidecar RSS %d MB" % (len(clients), int(rss) // 1024))
+
+        latencies = []
+        for _ in range(args.rounds):
+            waiters = [asyncio.ensure_future(receive(reader)) for reader, _ in clients]
+            await asyncio.sleep(0.05)
+            loop = asyncio.get_running_loop()
+            start = time.perf_counter()
+            batch = [os.urandom(wire.DEAD_DROP_MESSAGE_SIZE) for _ in range(args.batch_size)]
+            await loop.run_in_executor(None, datastore.add_dead_drop_messages, batch)
+            events.notify('deaddrop')
+            received = await asyncio.gather(*waiters)
+            latencies.append(max(received) - start)
+            latencies.extend(r - start for r in received)
+
+        for _, writer in clients:
+            writer.close()
+        return sorted(latencies)
+
+    try:
+        latencies = asyncio.run(run())
+    finally:
+        sidecar.terminate()
+        sidecar.wait()
+
+    print("notification latency (%s): p50 %.1f ms, p99 %.1f ms, max %.1f ms" % (
+        'poll only' if args.no_notify else 'notify socket',
+        1000 * latencies[len(latencies) // 2],
+        1000 * latencies[int(len(latencies) * 0.99)],
+        1000 * latencies[-1]))
+
+
+def bench_streaming_memory(args):
+    """Compares the peak memory (as traced by tracemalloc) of building the
+    JSON of the whole dead drop in memory with streaming `GET /deaddrop`
+    without snapshots. Fails if the streamed peak grows with the dead drop.
+    """
+    import config
+    import datastore
+    import flask
+    import sys
+    import tracemalloc
+    from flaskapp import app
+
+    config.SNAPSHOTS = False
+    client = app.test_client()
+    datastore.delete_all_messages()
+    size = 0
+    streamed_peaks = []
+    for target_size in args.sizes:
+        while size < target_size:
+            batch = min(10000, target_size - size)
+            datastore.add_dead_drop_messages([os.urandom(360) for _ in range(batch)])
+            size += batch
+
+        tracemalloc.start()
+        with app.app_context():
+            body = flask.jsonify([m.hex() for m in datastore.get_active_dead_drop_messages()]).get_data()
+        buffered_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del body
+
+        tracemalloc.start()
+        resp = client.get('/deaddrop', headers=AUTH_HEADERS_NEWS, buffered=False)
+        streamed_bytes = sum(len(chunk) for chunk in resp.response)
+        resp.close()
+        streamed_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        streamed_peaks.append(streamed_peak)
+
+        print("GET /deaddrop (%7d messages, %6.1f MiB): in memory peak %8.1f MiB, streamed peak %6.2f MiB" % (
+            size, streamed_bytes / 2**20, buffered_peak / 2**20, streamed_peak / 2**20))
+
+    if streamed_peaks[-1] > 2 * streamed_peaks[0]:
+        print("FAILED: the streamed peak grows with the size of the dead drop")
+        sys.exit(1)
+
+
+def bench_queue_datastore(args):
+    """Measures the per-call cost of the datastore functions behind the user
+    and reporter message queue endpoints. With `--orm`, the ORM
+    implementation that they replaced is measured instead.
+    """
+    import datastore
+
+    datastore.delete_all_messages()
+    for name, cls, packet_size in (('user', datastore.UserMessage, 385),
+                                   ('reporter', datastore.ReporterMessage, 345)):
+        names = ['add_%s_message' % name, 'get_%s_messages' % name, 'delete_%s_message' % name,
+                 'claim_%s_messages' % name, 'ack_%s_messages' % name]
+        if args.orm:
+            add, get, delete, claim, ack = _orm_queue_functions(cls)
+        else:
+            add, get, delete, claim, ack = [getattr(datastore, n) for n in names]
+        labels = {function: n + (' (ORM)' if args.orm else '')
+                  for function, n in zip((add, get, delete, claim, ack), names)}
+        packet = os.urandom(packet_size)
+
+        def measure(function, calls, make_args):
+            results = []
+            start = time.perf_counter()
+            for i in range(calls):
+                results.append(function(*make_args(i)))
+            duration = time.perf_counter() - start
+            print("%-32s %8.1f us/call (%d calls)" % (labels[function], 1e6 * duration / calls, calls))
+            return results
+
+        measure(add, args.calls, lambda i: (packet,))
+        measure(get, args.calls, lambda i: (args.batch_size,))
+
+        ids = [m.id for m in get(args.calls // 2)]
+        measure(delete, len(ids), lambda i: (ids[i],))
+
+        leases = measure(claim, len(ids) // args.batch_size, lambda i: (args.batch_size, 60))
+        measure(ack, len(leases), lambda i: (leases[i][0], [m.id for m in leases[i][1]]))
+        datastore.delete_all_messages()
+
+
+def _orm_queue_functions(cls):
+    """Returns the add, get, delete, claim, and ack functions of the queue of
+    `cls` as they were implemented with the ORM before the queues moved to
+    Core statements.
+    """
+    import datastore
+    import datetime
+    import uuid
+
+    from sqlalchemy import select
+
+    def add_orm(message):
+        with datastore.ScopeSession() as session:
+            session.add(cls(message=message, creation_datetime=datetime.datetime.now()))
+            session.commit()
+
+    def get_orm(count):
+        with datastore.ScopeSession() as session:
+            return session.query(cls) \
+                .filter(datastore._is_claimable(cls, datetime.datetime.now())) \
+                .order_by(cls.id).limit(count).all()
+
+    def delete_orm(id):
+        with datastore.ScopeSession() as session:
+            session.query(cls).filter(cls.id == id).delete()
+            session.commit()
+
+    def claim_orm(count, lease_seconds):
+        lease_id = uuid.uuid4().hex
+        now = datetime.datetime.now()
+        lease_expiry = now + datetime.timedelta(seconds=lease_seconds)
+        with datastore.ScopeSession() as session:
+            claimable_ids = select([cls.id]).where(datastore._is_claimable(cls, now)).order_by(cls.id).limit(count)
+            session.query(cls) \
+                .filter(cls.id.in_(claimable_ids)) \
+                .update({cls.lease_id: lease_id, cls.lease_expiry: lease_expiry}, synchronize_session=False)
+            session.commit()
+            return lease_id, session.query(cls).filter(cls.lease_id == lease_id).order_by(cls.id).all()
+
+    def ack_orm(lease_id, ids):
+        with datastore.ScopeSession() as session:
+            deleted = session.query(cls) \
+                .filter(cls.lease_id == lease_id) \
+                .filter(cls.id.in_(ids)) \
+                .delete(synchronize_session=False)
+            session.commit()
+            return deleted
+
+    return add_orm, get_orm, delete_orm, claim_orm, ack_orm
+
+
+def bench_lock_contention(args):
+    """Publishes dead-drop batches and adds news stories while other threads
+    ingest user messages as fast as they can, either with all tables in one
+    SQLite file or (with `--split`) with one file per table group.
+    """
+    import config
+    if args.split:
+        base, _ = os.path.splitext(make_url(config.DB_URL).database)
+        config.DB_URL_QUEUES = 'sqlite:///%s-queues.sqlite' % base
+        config.DB_URL_BOARDS = 'sqlite:///%s-boards.sqlite' % base
+    import datastore
+
+    datastore.delete_all()
+    packets = [os.urandom(360) for _ in range(args.batch_size)]
+    packet = os.urandom(385)
+    stop = threading.Event()
+    ingested = [0] * args.threads
+
+    def ingest(index):
+        while not stop.is_set():
+            datastore.add_user_message(packet)
+            ingested[index] += 1
+
+    def measure(function):
+        durations = []
+        for _ in range(args.batches):
+            start = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - start)
+            time.sleep(0.01)
+        durations.sort()
+        return durations
+
+    threads = [threading.Thread(target=ingest, args=(i,)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    publish = measure(lambda: datastore.add_dead_drop_messages(packets))
+    add_story = measure(lambda: datastore.add_news_story(datastore.NewsStory(headline='x', content='x')))
+    stop.set()
+    for t in threads:
+        t.join()
+    duration = time.perf_counter() - start
+
+    print("%s, %d ingest threads: %.0f user messages/s" % (
+        'one file per group' if args.split else 'single file', args.threads, sum(ingested) / duration))
+    for name, durations in (('add_dead_drop_messages (%d)' % args.batch_size, publish),
+                            ('add_news_story', add_story)):
+        print("  %-30s p50 %7.2f ms  p99 %7.2f ms  max %7.2f ms" % (
+            name, 1000 * durations[len(durations) // 2],
+            1000 * durations[int(len(durations) * 0.99)], 1000 * durations[-1]))
+
+
+def bench_queue_full(args):
+    """Posts user messages while nothing drains the queue (e.g. during an SGX
+    outage) and reports how many were admitted, the resulting backlog, and
+    the latency of the posts.
+    """
+    import admission
+    import config
+    import datastore
+    from flaskapp import app
+
+    datastore.delete_all_messages()
+    config.QUEUE_MAX_USER_MESSAGES = args.capacity
+    config.QUEUE_FULL_MODE = args.mode
+    packet = _random_hex(385)
+    per_thread = args.requests // args.threads
+    statuses = {}
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        client = app.test_client()
+        for _ in range(per_thread):
+            start = time.perf_counter()
+            resp = client.post('/user_message', json={'message': packet}, headers=AUTH_HEADERS_NEWS)
+            duration = time.perf_counter() - start
+            with lock:
+                statuses[resp.status_code] = statuses.get(resp.status_code, 0) + 1
+                latencies.append(duration)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies.sort()
+    backlog = datastore.count_queued_messages()[admission.USER_MESSAGES]
+    print("POST /user_message (capacity %s, %s): %s, queued %d, p50 %.2f ms, p99 %.2f ms" % (
+        args.capacity or 'unbounded', args.mode,
+        ', '.join('%d x %d' % (count, status) for status, count in sorted(statuses.items())),
+        backlog,
+        1000 * latencies[len(latencies) // 2],
+        1000 * latencies[int(len(latencies) * 0.99)]))
+
+
+def bench_user_message_batch(args):
+    """Posts `args.packets` user messages one per request and then in batches
+    of each of `args.batch_sizes` packets and reports the packets per second.
+    """
+    import datastore
+    from flaskapp import app
+
+    client = app.test_client()
+    packets = [_random_hex(385) for _ in range(args.packets)]
+
+    datastore.delete_all_messages()
+    start = time.perf_counter()
+    for packet in packets:
+        client.post('/user_message', json={'message': packet}, headers=AUTH_HEADERS_NEWS)
+    duration = time.perf_counter() - start
+    print("POST /user_message: %.0f packets/s (%d requests)" % (len(packets) / duration, len(packets)))
+
+    for batch_size in args.batch_sizes:
+        datastore.delete_all_messages()
+        start = time.perf_counter()
+        for index in range(0, len(packets), batch_size):
+            resp = client.post(
+                '/user_message/batch',
+                json={'messages': packets[index:index + batch_size]},
+                headers=AUTH_HEADERS_NEWS)
+            if resp.status_code != 200:
+                print("WARNING: batch failed with status %d" % resp.status_code)
+        duration = time.perf_counter() - start
+        print("POST /user_message/batch (%d packets per batch): %.0f packets/s (%d requests)" % (
+            batch_size, len(packets) / duration, -(-len(packets) // batch_size)))
+
+
+def _add_request_arguments(parser):
+    parser.add_argument(
+        '--requests',
+        type=int, default=2000, metavar='n',
+        help='Total number of requests to issue (default: 2000)')
+    parser.add_argument(
+        '--threads',
+        type=int, default=1, metavar='n',
+        help='Number of concurrent client threads (default: 1)')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='CoverDrop benchmarks')
+    subparsers = parser.add_subparsers()
+
+    parser_user_message = subparsers.add_parser(
+        'user_message',
+        help='Measures requests/s of POST /user_message')
+    _add_request_arguments(parser_user_message)
+    parser_user_message.set_defaults(func=bench_user_message)
+
+    parser_deaddrop = subparsers.add_parser(
+        'deaddrop',
+        help='Measures requests/s of GET /deaddrop')
+    _add_request_arguments(parser_deaddrop)
+    parser_deaddrop.add_argument(
+        '--deaddrop-size',
+        type=int, default=240, metavar='n',
+        help='Number of messages in the dead drop (default: 240)')
+    parser_deaddrop.add_argument(
+        '--no-snapshots',
+        action='store_true',
+        help='Query the database on every request (like COVERDROP_SNAPSHOTS=0)')
+    parser_deaddrop.set_defaults(func=bench_deaddrop)
+
+    parser_pubkeys = subparsers.add_parser(
+        'pubkeys',
+        help='Measures requests/s of GET /pubkeys')
+    _add_request_arguments(parser_pubkeys)
+    parser_pubkeys.add_argument(
+        '--revalidate',
+        action='store_true',
+        help='Send the ETag of the current keys via If-None-Match')
+    parser_pubkeys.add_argument(
+        '--uncached',
+        action='store_true',
+        help='Read the keys on every request instead of serving the cached bundle')
+    parser_pubkeys.add_argument(
+        '--reporters',
+        type=int, default=3, metavar='n',
+        help='Number of reporters (default: 3)')
+    parser_pubkeys.set_defaults(func=bench_pubkeys)
+
+    parser_stories = subparsers.add_parser(
+        'stories',
+        help='Measures requests/s of the full index GET / and of GET /stories')
+    _add_request_arguments(parser_stories)
+    parser_stories.add_argument(
+        '--stories',
+        type=int, default=1000, metavar='n',
+        help='Number of news stories (default: 1000)')
+    parser_stories.add_argument(
+        '--per-story-reporter',
+        action='store_true',
+        help='Also measure loading the reporter of every story with a query of its own')
+    parser_stories.add_argument(
+        '--no-response-cache',
+        action='store_true',
+        help='Disable the cache of the responses (like COVERDROP_RESPONSE_CACHE_MAX_BYTES=0)')
+    parser_stories.set_defaults(func=bench_stories)
+
+    parser_search = subparsers.add_parser(
+        'search',
+        help='Measures full-text searches over the news stories')
+    parser_search.add_argument(
+        '--stories',
+        type=int, default=100000, metavar='n',
+        help='Number of news stories (default: 100000)')
+    parser_search.add_argument(
+        '--paragraphs',
+        type=int, default=3, metavar='n',
+        help='Number of paragraphs per story (default: 3)')
+    parser_search.add_argument(
+        '--keywords',
+        type=int, default=10000, metavar='n',
+        help='Number of distinct keywords in the headlines (default: 10000)')
+    parser_search.add_argument(
+        '--repeat',
+        type=int, default=10, metavar='n',
+        help='Number of times each query is run (default: 10)')
+    parser_search.set_defaults(func=bench_search)
+
+    parser_send_to_users = subparsers.add_parser(
+        'send_to_users',
+        help='Measures the latency of posting a batch to POST /send_to_users')
+    parser_send_to_users.add_argument(
+        '--batches',
+        type=int, default=20, metavar='n',
+        help='Number of batches to post (default: 20)')
+    parser_send_to_users.add_argument(
+        '--batch-size',
+        type=int, default=240, metavar='n',
+        help='Number of messages per batch (default: 240)')
+    parser_send_to_users.add_argument(
+        '--per-message',
+        action='store_true',
+        help='Commit every message separately instead of posting the batch')
+    parser_send_to_users.set_defaults(func=bench_send_to_users)
+
+    parser_wire_format = subparsers.add_parser(
+        'wire_format',
+        help='Compares the JSON and binary wire formats')
+    parser_wire_format.add_argument(
+        '--packets',
+        type=int, default=10000, metavar='n',
+        help='Number of dead-drop packets (default: 10000)')
+    parser_wire_format.add_argument(
+        '--rounds',
+        type=int, default=20, metavar='n',
+        help='Number of repetitions (default: 20)')
+    parser_wire_format.set_defaults(func=bench_wire_format)
+
+    parser_dead_drop_store = subparsers.add_parser(
+        'dead_drop_store',
+        help='Compares the SQLite and segment file storage of the dead drop')
+    parser_dead_drop_store.add_argument(
+        '--packets',
+        type=int, default=1000000, metavar='n',
+        help='Number of dead-drop packets (default: 1000000)')
+    parser_dead_drop_store.add_argument(
+        '--batch-size',
+        type=int, default=240, metavar='n',
+        help='Number of packets per append (default: 240)')
+    parser_dead_drop_store.set_defaults(func=bench_dead_drop_store)
+
+    parser_events = subparsers.add_parser(
+        'events',
+        help='Measures notification latency and connection capacity of the events sidecar')
+    parser_events.add_argument(
+        '--connections',
+        type=int, default=2000, metavar='n',
+        help='Number of concurrent event streams (default: 2000)')
+    parser_events.add_argument(
+        '--rounds',
+        type=int, default=10, metavar='n',
+        help='Number of published batches (default: 10)')
+    parser_events.add_argument(
+        '--batch-size',
+        type=int, default=10, metavar='n',
+        help='Number of messages per batch (default: 10)')
+    parser_events.add_argument(
+        '--port',
+        type=int, default=8765, metavar='n',
+        help='Port of the sidecar (default: 8765)')
+    parser_events.add_argument(
+        '--no-notify',
+        action='store_true',
+        help='Rely on polling instead of the notify socket')
+    parser_events.set_defaults(func=bench_events)
+
+    parser_streaming_memory = subparsers.add_parser(
+        'streaming_memory',
+        help='Compares the peak memory of GET /deaddrop with and without streaming')
+    parser_streaming_memory.add_argument(
+        '--sizes',
+        type=int, nargs='+', default=[1000, 10000, 100000], metavar='n',
+        help='Dead-drop sizes to measure (default: 1000 10000 100000)')
+    parser_streaming_memory.set_defaults(func=bench_streaming_memory)
+
+    parser_queue_datastore = subparsers.add_parser(
+        'queue_datastore',
+        help='Measures the per-call cost of the datastore functions of the message queues')
+    parser_queue_datastore.add_argument(
+        '--calls',
+        type=int, default=2000, metavar='n',
+        help='Number of messages to add (default: 2000)')
+    parser_queue_datastore.add_argument(
+        '--batch-size',
+        type=int, default=50, metavar='n',
+        help='Number of messages per get and claim (default: 50)')
+    parser_queue_datastore.add_argument(
+        '--orm',
+        action='store_true',
+        help='Measure the previous ORM implementation of the queue functions')
+    parser_queue_datastore.set_defaults(func=bench_queue_datastore)
+
+    parser_lock_contention = subparsers.add_parser(
+        'lock_contention',
+        help='Measures publishing and news writes while user messages are ingested')
+    parser_lock_contention.add_argument(
+        '--threads',
+        type=int, default=4, metavar='n',
+        help='Number of threads that ingest user messages (default: 4)')
+    parser_lock_contention.add_argument(
+        '--batches',
+        type=int, default=100, metavar='n',
+        help='Number of dead-drop batches and news stories to add (default: 100)')
+    parser_lock_contention.add_argument(
+        '--batch-size',
+        type=int, default=240, metavar='n',
+        help='Number of messages per dead-drop batch (default: 240)')
+    parser_lock_contention.add_argument(
+        '--split',
+        action='store_true',
+        help='Stores the queues and the dead drop in their own files')
+    parser_lock_contention.set_defaults(func=bench_lock_contention)
+
+    parser_queue_full = subparsers.add_parser(
+        'queue_full',
+        help='Measures POST /user_message while the queue is not drained')
+    _add_request_arguments(parser_queue_full)
+    parser_queue_full.add_argument(
+        '--capacity',
+        type=int, default=500, metavar='n',
+        help='Capacity of the user message queue; 0 for unbounded (default: 500)')
+    parser_queue_full.add_argument(
+        '--mode',
+        choices=['reject', 'shed'], default='reject',
+        help='What happens to messages once the queue is full (default: reject)')
+    parser_queue_full.set_defaults(func=bench_queue_full)
+
+    parser_user_message_batch = subparsers.add_parser(
+        'user_message_batch',
+        help='Compares POST /user_message with POST /user_message/batch')
+    parser_user_message_batch.add_argument(
+        '--packets',
+        type=int, default=2000, metavar='n',
+        help='Total number of packets to post (default: 2000)')
+    parser_user_message_batch.add_argument(
+        '--batch-sizes',
+        type=int, nargs='+', default=[2, 10, 100], metavar='n',
+        help='Numbers of packets per batch (default: 2 10 100)')
+    parser_user_message_batch.set_defaults(func=bench_user_message_batch)
+
+    args = parser.parse_args()
+    if 'func' in args:
+        args.func(args)
+    else:
+        parser.print_help()
@@ -1,7 +1,10 @@
 import argparse
+import config
 import datastore
 import lorem
+import querylog
 import random
+import retention
 import sys
 
 def story_add(args):
@@ -70,6 +73,62 @@ def clear_and_default(args):
         _story_add(10)
 
 
+def prune_messages(args):
+    try:
+        deleted, duration = retention.prune(args.retention_hours, args.chunk_size)
+    except ValueError as e:
+        print("Not pruning: %s" % e)
+        sys.exit(1)
+    print("Pruned expired messages: " + retention.format_result(deleted, duration))
+
+
+def query_stats(args):
+    """Runs the read queries of the web service and prints their timings and
+    query plans, e.g. to confirm that the time filters and the queue
+    ordering use an index.
+    """
+    config.QUERY_LOG = True
+    datastore.init()
+    querylog.reset()
+
+    for _ in range(args.repeat):
+        datastore.get_active_dead_drop_rows(config.MESSAGE_WINDOW_HOURS)
+        datastore.get_active_reporter_inbox_rows(config.MESSAGE_WINDOW_HOURS)
+        datastore.get_user_messages(args.count)
+        datastore.get_reporter_messages(args.count)
+        datastore.get_queue_stats()
+        datastore.count_active_messages(config.MESSAGE_WINDOW_HOURS)
+
+    print(querylog.format_stats(querylog.get_stats()))
+
+
+def search_rebuild(args):
+    indexed = datastore.rebuild_search_index()
+    if indexed is None:
+        print("The database has no search index; searches use LIKE instead")
+    else:
+        print("Rebuilt the search index of %d stories" % indexed)
+
+
+def split_db(args):
+    """Moves the tables of every group that is configured with its own
+    database (e.g. `COVERDROP_DB_URL_QUEUES`) out of the shared database.
+    Stop the web service first.
+    """
+    try:
+        copied = datastore.split_database(args.source, args.delete_source)
+    except ValueError as e:
+        print("Not splitting: %s" % e)
+        sys.exit(1)
+    if not copied:
+        print("Nothing to do: no group is configured with its own database")
+        return
+    for table, count in copied.items():
+        print("Copied %d rows of %s" % (count, table))
+    if not args.delete_source:
+        print("The rows are still in %s; pass --delete-source to remove them" % args.source)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='CoverDrop CLI')
     subparsers = parser.add_subparsers()
@@ -114,6 +173,50 @@ if __name__ == "__main__":
         help='Clears the entire DB and generates a scenario with default reporters and articles')
     parser_clear_and_default.set_defaults(func=clear_and_default)
 
+    parser_prune_messages = subparsers.add_parser(
+        'prune_messages',
+        help='Deletes expired dead-drop and reporter inbox messages')
+    parser_prune_messages.add_argument(
+        '--retention-hours',
+        type=int, default=None, metavar='h',
+        help='Delete messages older than this (default: COVERDROP_RETENTION_HOURS)')
+    parser_prune_messages.add_argument(
+        '--chunk-size',
+        type=int, default=None, metavar='n',
+        help='Maximum rows deleted per transaction (default: COVERDROP_RETENTION_CHUNK_SIZE)')
+    parser_prune_messages.set_defaults(func=prune_messages)
+
+    parser_query_stats = subparsers.add_parser(
+        'query_stats',
+        help='Prints timings and query plans of the read queries')
+    parser_query_stats.add_argument(
+        '--repeat',
+        type=int, default=10, metavar='n',
+        help='Number of times each query is run (default: 10)')
+    parser_query_stats.add_argument(
+        '--count',
+        type=int, default=100, metavar='n',
+        help='Number of queue messages to query (default: 100)')
+    parser_query_stats.set_defaults(func=query_stats)
+
+    parser_search_rebuild = subparsers.add_parser(
+        'search_rebuild',
+        help='Rebuilds the full-text search index of the news stories')
+    parser_search_rebuild.set_defaults(func=search_rebuild)
+
+    parser_split_db = subparsers.add_parser(
+        'split_db',
+        help='Copies table groups that have their own database out of the shared database')
+    parser_split_db.add_argument(
+        '--source',
+        default=config.DB_URL, metavar='url',
+        help='Shared database to copy from (default: COVERDROP_DB_URL)')
+    parser_split_db.add_argument(
+        '--delete-source',
+        action='store_true',
+        help='Deletes the copied rows from the shared database')
+    parser_split_db.set_defaults(func=split_db)
+
     args = parser.parse_args()
     if 'func' in args:
         args.func(args)
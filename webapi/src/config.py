@@ -0,0 +1,203 @@
+"""Runtime configuration of the web service. All settings can be overridden
+through environment variables so that they can be changed per deployment
+without touching the code, e.g.:
+
+    env COVERDROP_SQLITE_SYNCHRONOUS=FULL gunicorn --bind 0.0.0.0:8000 wsgi
+"""
+
+import os
+
+
+def _get_str(name, default):
+    return os.environ.get(name, default)
+
+
+def _get_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def _get_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+def _get_bool(name, default):
+    if name not in os.environ:
+        return default
+    return os.environ[name].lower() in ('1', 'true', 'yes', 'on')
+
+
+#
+# Database
+#
+
+# SQLAlchemy URL of the database
+DB_URL = _get_str('COVERDROP_DB_URL', 'sqlite:///coverdrop.sqlite')
+
+# Number of pooled connections kept open per process and how many more may be
+# opened temporarily under load
+DB_POOL_SIZE = _get_int('COVERDROP_DB_POOL_SIZE', 5)
+DB_MAX_OVERFLOW = _get_int('COVERDROP_DB_MAX_OVERFLOW', 10)
+
+# SQLite pragmas that are applied to every new connection. WAL allows readers
+# to proceed while a writer is active; NORMAL synchronous is durable in WAL
+# mode except for the last transactions before a power loss
+SQLITE_JOURNAL_MODE = _get_str('COVERDROP_SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = _get_str('COVERDROP_SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT_MS = _get_int('COVERDROP_SQLITE_BUSY_TIMEOUT_MS', 5000)
+
+# Listings that are streamed to the client (e.g. `/deaddrop` without
+# snapshots) fetch this many rows at a time
+DB_STREAM_CHUNK_SIZE = _get_int('COVERDROP_DB_STREAM_CHUNK_SIZE', 1000)
+
+# The tables can be split into three groups with separate databases: news
+# stories and reporters, the inbound user and reporter message queues, and
+# the outbound dead drop and reporter inbox. With SQLite, separate files mean
+# that e.g. message ingest does not hold the single writer lock that
+# publishing the dead drop waits for. Each group defaults to DB_URL and the
+# SQLite pragmas above but can override them; pragmas only differ for
+# separate files
+DB_URL_NEWS = _get_str('COVERDROP_DB_URL_NEWS', DB_URL)
+DB_URL_QUEUES = _get_str('COVERDROP_DB_URL_QUEUES', DB_URL)
+DB_URL_BOARDS = _get_str('COVERDROP_DB_URL_BOARDS', DB_URL)
+SQLITE_JOURNAL_MODE_NEWS = _get_str('COVERDROP_SQLITE_JOURNAL_MODE_NEWS', SQLITE_JOURNAL_MODE)
+SQLITE_JOURNAL_MODE_QUEUES = _get_str('COVERDROP_SQLITE_JOURNAL_MODE_QUEUES', SQLITE_JOURNAL_MODE)
+SQLITE_JOURNAL_MODE_BOARDS = _get_str('COVERDROP_SQLITE_JOURNAL_MODE_BOARDS', SQLITE_JOURNAL_MODE)
+SQLITE_SYNCHRONOUS_NEWS = _get_str('COVERDROP_SQLITE_SYNCHRONOUS_NEWS', SQLITE_SYNCHRONOUS)
+SQLITE_SYNCHRONOUS_QUEUES = _get_str('COVERDROP_SQLITE_SYNCHRONOUS_QUEUES', SQLITE_SYNCHRONOUS)
+SQLITE_SYNCHRONOUS_BOARDS = _get_str('COVERDROP_SQLITE_SYNCHRONOUS_BOARDS', SQLITE_SYNCHRONOUS)
+
+# If enabled, every SQL statement is timed and aggregated per statement (see
+# `querylog.py`). Statements slower than QUERY_LOG_SLOW_MS are logged together
+# with their query plan. The percentiles are computed over the most recent
+# QUERY_LOG_SAMPLES executions of a statement
+QUERY_LOG = _get_bool('COVERDROP_QUERY_LOG', False)
+QUERY_LOG_SLOW_MS = _get_int('COVERDROP_QUERY_LOG_SLOW_MS', 100)
+QUERY_LOG_SAMPLES = _get_int('COVERDROP_QUERY_LOG_SAMPLES', 1000)
+
+
+#
+# Ingestion
+#
+
+# If enabled, incoming user and reporter messages are buffered in memory and
+# written in one transaction every INGEST_FLUSH_INTERVAL_MS milliseconds or
+# as soon as INGEST_FLUSH_MAX_PACKETS are pending. A request is only
+# acknowledged after the transaction containing its packet has been committed.
+# This only helps if a worker serves concurrent requests (e.g. gunicorn with
+# `--threads`).
+INGEST_GROUP_COMMIT = _get_bool('COVERDROP_INGEST_GROUP_COMMIT', False)
+INGEST_FLUSH_INTERVAL_MS = _get_int('COVERDROP_INGEST_FLUSH_INTERVAL_MS', 10)
+INGEST_FLUSH_MAX_PACKETS = _get_int('COVERDROP_INGEST_FLUSH_MAX_PACKETS', 100)
+
+# How long a request waits for its packet to be flushed before it fails
+INGEST_ACK_TIMEOUT_MS = _get_int('COVERDROP_INGEST_ACK_TIMEOUT_MS', 5000)
+
+# `Retry-After` of the `503 Service Unavailable` answered if group commit
+# failed or timed out
+INGEST_RETRY_AFTER_S = _get_int('COVERDROP_INGEST_RETRY_AFTER_S', 1)
+
+# Maximum number of packets per request to `/user_message/batch` and
+# `/reporter_message/batch`. Batches are always written in one transaction
+INGEST_MAX_BATCH_PACKETS = _get_int('COVERDROP_INGEST_MAX_BATCH_PACKETS', 100)
+
+
+#
+# Queues
+#
+
+# Default and maximum duration for which messages claimed by the SGX are
+# leased before they are returned to the queue
+QUEUE_LEASE_SECONDS = _get_int('COVERDROP_QUEUE_LEASE_SECONDS', 60)
+QUEUE_MAX_LEASE_SECONDS = _get_int('COVERDROP_QUEUE_MAX_LEASE_SECONDS', 600)
+
+# Capacity of the user and reporter message queues (0 for unlimited). Once a
+# queue is full, new messages are either rejected with `429 Too Many
+# Requests` and a `Retry-After` of QUEUE_RETRY_AFTER_S ('reject') or accepted
+# but dropped ('shed'). Workers count the backlog in the database at most
+# every QUEUE_COUNT_CACHE_MS
+QUEUE_MAX_USER_MESSAGES = _get_int('COVERDROP_QUEUE_MAX_USER_MESSAGES', 0)
+QUEUE_MAX_REPORTER_MESSAGES = _get_int('COVERDROP_QUEUE_MAX_REPORTER_MESSAGES', 0)
+QUEUE_FULL_MODE = _get_str('COVERDROP_QUEUE_FULL_MODE', 'reject')
+QUEUE_RETRY_AFTER_S = _get_int('COVERDROP_QUEUE_RETRY_AFTER_S', 30)
+QUEUE_COUNT_CACHE_MS = _get_int('COVERDROP_QUEUE_COUNT_CACHE_MS', 1000)
+
+
+#
+# News stories and reporters
+#
+
+# Memory cap of the per-process cache of serialized responses of `/`,
+# `/stories`, `/story/<id>`, and `/reporters`; 0 disables the cache
+RESPONSE_CACHE_MAX_BYTES = _get_int('COVERDROP_RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+
+
+#
+# Dead drop and reporter inbox
+#
+
+# Messages published by the SGX are served to the apps for this long
+MESSAGE_WINDOW_HOURS = _get_int('COVERDROP_MESSAGE_WINDOW_HOURS', 24)
+
+# Where dead-drop messages are stored: 'sqlite' for the database or
+# 'segments' for append-only hourly segment files in DEAD_DROP_SEGMENTS_DIR
+DEAD_DROP_STORE = _get_str('COVERDROP_DEAD_DROP_STORE', 'sqlite')
+DEAD_DROP_SEGMENTS_DIR = _get_str('COVERDROP_DEAD_DROP_SEGMENTS_DIR', 'deaddrop_segments')
+
+# If enabled, `/deaddrop` and `/reporter_inbox` are served from immutable
+# snapshots that are serialized and compressed once per change
+SNAPSHOTS = _get_bool('COVERDROP_SNAPSHOTS', True)
+
+# `max-age` of the `Cache-Control` header of snapshot responses. Clients and
+# CDNs revalidate via `If-None-Match` afterwards
+SNAPSHOT_MAX_AGE_S = _get_int('COVERDROP_SNAPSHOT_MAX_AGE_S', 60)
+
+# The events sidecar (`events.py`) refreshes its snapshots at this interval
+# and whenever a worker notifies it via the datagram socket at
+# EVENTS_NOTIFY_SOCKET after new messages have been published ('' disables
+# the notifications). Idle event streams receive a keepalive comment every
+# EVENTS_KEEPALIVE_S seconds
+EVENTS_POLL_INTERVAL_MS = _get_int('COVERDROP_EVENTS_POLL_INTERVAL_MS', 1000)
+EVENTS_NOTIFY_SOCKET = _get_str('COVERDROP_EVENTS_NOTIFY_SOCKET', '')
+EVENTS_KEEPALIVE_S = _get_int('COVERDROP_EVENTS_KEEPALIVE_S', 15)
+
+
+#
+# Metrics
+#
+
+# If enabled, every worker records request metrics and a background thread
+# writes them to its own file in METRICS_DIR every METRICS_FLUSH_INTERVAL_S
+# seconds; `/metrics` merges them with the archived metrics of exited workers
+METRICS = _get_bool('COVERDROP_METRICS', True)
+METRICS_DIR = _get_str('COVERDROP_METRICS_DIR', 'metrics')
+METRICS_FLUSH_INTERVAL_S = _get_int('COVERDROP_METRICS_FLUSH_INTERVAL_S', 5)
+
+# If enabled, PROFILE_SAMPLE_RATE of the requests whose route matches the
+# regular expression PROFILE_ROUTES ('' matches all routes) are profiled with
+# cProfile. The profiles are written to PROFILE_DIR, which keeps the newest
+# PROFILE_MAX_FILES. Disabled profiling does not add any per-request work
+PROFILE = _get_bool('COVERDROP_PROFILE', False)
+PROFILE_SAMPLE_RATE = _get_float('COVERDROP_PROFILE_SAMPLE_RATE', 0.01)
+PROFILE_ROUTES = _get_str('COVERDROP_PROFILE_ROUTES', '')
+PROFILE_DIR = _get_str('COVERDROP_PROFILE_DIR', 'profiles')
+PROFILE_MAX_FILES = _get_int('COVERDROP_PROFILE_MAX_FILES', 200)
+
+
+#
+# Retention
+#
+
+# Dead-drop and reporter inbox messages older than this are deleted. Must not
+# be shorter than MESSAGE_WINDOW_HOURS, or messages that are still served
+# would be deleted
+RETENTION_HOURS = _get_int('COVERDROP_RETENTION_HOURS', MESSAGE_WINDOW_HOURS)
+if RETENTION_HOURS < MESSAGE_WINDOW_HOURS:
+    raise ValueError("COVERDROP_RETENTION_HOURS (%d) must be at least COVERDROP_MESSAGE_WINDOW_HOURS (%d)" % (
+        RETENTION_HOURS, MESSAGE_WINDOW_HOURS))
+
+# If positive, every worker prunes expired messages at this interval in the
+# background. Otherwise run `cli.py prune_messages` e.g. from a cron job
+RETENTION_INTERVAL_S = _get_int('COVERDROP_RETENTION_INTERVAL_S', 0)
+
+# Maximum number of rows deleted per transaction
+RETENTION_CHUNK_SIZE = _get_int('COVERDROP_RETENTION_CHUNK_SIZE', 1000)
@@ -1,24 +1,268 @@
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, create_engine
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, LargeBinary, String, and_, bindparam, create_engine, event, func, inspect, or_, select, text
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.pool import QueuePool
 
+import collections
+import config
 import datetime
 import os
+import querylog
+import re
+import segments
 import sys
+import threading
+import uuid
+import wire
 
 Base = declarative_base()
 __has_init = False
 
-
-def _get_engine():
-    return create_engine('sqlite:///coverdrop.sqlite', echo=False)
+# The tables are split into groups that may be stored in separate databases
+# (see `config.DB_URL_NEWS` etc.). Every table names its group in its `info`;
+# the generations table exists in every database.
+DB_NEWS = 'news'
+DB_QUEUES = 'queues'
+DB_BOARDS = 'boards'
+DB_GROUPS = (DB_NEWS, DB_QUEUES, DB_BOARDS)
+
+# The engines (and with them the connection pools) and the session factory are
+# created once per process; groups with the same settings share an engine. We
+# remember the pid so that a process that has been forked (e.g. gunicorn with
+# `--preload`) does not share pooled connections with its parent.
+_engines = None
+_session_factory = None
+_compiled_caches = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+_init_lock = threading.Lock()
+
+
+def _get_db_settings(group):
+    """Returns the URL, journal mode, and synchronous pragma of the database
+    of `group`.
+    """
+    if group == DB_NEWS:
+        return config.DB_URL_NEWS, config.SQLITE_JOURNAL_MODE_NEWS, config.SQLITE_SYNCHRONOUS_NEWS
+    if group == DB_QUEUES:
+        return config.DB_URL_QUEUES, config.SQLITE_JOURNAL_MODE_QUEUES, config.SQLITE_SYNCHRONOUS_QUEUES
+    return config.DB_URL_BOARDS, config.SQLITE_JOURNAL_MODE_BOARDS, config.SQLITE_SYNCHRONOUS_BOARDS
+
+
+def _create_engine(db_url, journal_mode, synchronous):
+    url = make_url(db_url)
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(url, echo=False, pool_size=config.DB_POOL_SIZE,
+                             max_overflow=config.DB_MAX_OVERFLOW)
+
+    if url.database in (None, '', ':memory:'):
+        # In-memory databases only exist per connection; keep SQLAlchemy's default pool
+        engine = create_engine(url, echo=False)
+    else:
+        engine = create_engine(url, echo=False, poolclass=QueuePool,
+                               pool_size=config.DB_POOL_SIZE,
+                               max_overflow=config.DB_MAX_OVERFLOW,
+                               connect_args={'check_same_thread': False})
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=%s' % journal_mode)
+        cursor.execute('PRAGMA synchronous=%s' % synchronous)
+        cursor.execute('PRAGMA busy_timeout=%d' % config.SQLITE_BUSY_TIMEOUT_MS)
+        cursor.close()
+
+    return engine
+
+
+def _create_engines():
+    engines = {}
+    engines_by_settings = {}
+    for group in DB_GROUPS:
+        settings = _get_db_settings(group)
+        if settings not in engines_by_settings:
+            engine = _create_engine(*settings)
+            if config.QUERY_LOG:
+                querylog.instrument(engine)
+            engines_by_settings[settings] = engine
+        engines[group] = engines_by_settings[settings]
+    return engines
+
+
+def _get_engine(group):
+    global _engines, _session_factory, _compiled_caches, _engine_pid
+    if _engines is None or _engine_pid != os.getpid():
+        with _engine_lock:
+            if _engines is None or _engine_pid != os.getpid():
+                _engines = _create_engines()
+                _session_factory = sessionmaker(binds={
+                    table: _engines[table.info['db']]
+                    for table in Base.metadata.sorted_tables if 'db' in table.info
+                })
+                _compiled_caches = {group: {} for group in DB_GROUPS}
+                _engine_pid = os.getpid()
+    return _engines[group]
+
+
+def _get_session_factory():
+    _get_engine(DB_NEWS)
+    return _session_factory
+
+
+def _get_tables_by_engine():
+    """Returns the distinct engines of this process and the tables stored in
+    their databases.
+    """
+    result = {}
+    for group in DB_GROUPS:
+        tables = result.setdefault(_get_engine(group), [Generation.__table__])
+        tables.extend(t for t in Base.metadata.sorted_tables if t.info.get('db') == group)
+    return list(result.items())
 
 
 def init():
     global __has_init
     if not __has_init:
-        Base.metadata.create_all(_get_engine())
-        __has_init = True
+        with _init_lock:
+            if not __has_init:
+                for engine, tables in _get_tables_by_engine():
+                    Base.metadata.create_all(engine, tables=tables)
+                    _upgrade_schema(engine, tables)
+                __has_init = True
+
+
+def _upgrade_schema(engine, tables):
+    """Adds columns and indexes that were introduced after an existing
+    database has been created, as `create_all` only creates missing tables.
+    """
+    inspector = inspect(engine)
+    for table in tables:
+        existing_columns = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=engine.dialect)
+                engine.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                               (table.name, column.name, column_type))
+
+        existing_indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=engine)
+
+    if engine.dialect.name == 'sqlite':
+        _add_autoincrement(engine, tables)
+        _convert_hex_messages(engine, tables)
+        if NewsStory.__table__ in tables:
+            _create_search_index(engine)
+
+
+def _add_autoincrement(engine, tables):
+    """Rebuilds the tables that were created before their ids were declared
+    AUTOINCREMENT, as SQLite cannot add it to an existing table. The rows keep
+    their ids and new ids continue after the largest one, even once the table
+    has been pruned empty.
+    """
+    for table in tables:
+        if not table.dialect_options['sqlite']['autoincrement']:
+            continue
+        sql = engine.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", table.name).scalar()
+        if 'AUTOINCREMENT' in sql.upper():
+            continue
+
+        old_name = table.name + '_without_autoincrement'
+        columns = ', '.join(c.name for c in table.columns)
+        with engine.begin() as connection:
+            connection.execute('ALTER TABLE %s RENAME TO %s' % (table.name, old_name))
+            for index in table.indexes:
+                connection.execute('DROP INDEX IF EXISTS %s' % index.name)
+            table.create(bind=connection)
+            connection.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (table.name, columns, columns, old_name))
+            connection.execute('DROP TABLE %s' % old_name)
+
+
+def _convert_hex_messages(engine, tables):
+    """Messages used to be stored as hex strings; converts any such rows to
+    the binary representation. Rows that are not valid hex of the packet size
+    of their table could not be served and are deleted.
+    """
+    packet_sizes = {
+        UserMessage: wire.USER_MESSAGE_SIZE,
+        ReporterMessage: wire.REPORTER_MESSAGE_SIZE,
+        DeadDropMessage: wire.DEAD_DROP_MESSAGE_SIZE,
+        ReporterInboxMessage: wire.REPORTER_INBOX_MESSAGE_SIZE,
+    }
+    for cls, packet_size in packet_sizes.items():
+        if cls.__table__ not in tables:
+            continue
+        table = cls.__tablename__
+        rows = engine.execute(
+            "SELECT id, message FROM %s WHERE typeof(message) = 'text'" % table).fetchall()
+        converted, invalid = [], []
+        for id, message in rows:
+            try:
+                packet = bytes.fromhex(message)
+            except ValueError:
+                packet = None
+            if packet is None or len(packet) != packet_size:
+                invalid.append((id,))
+            else:
+                converted.append((packet, id))
+
+        if converted:
+            engine.execute("UPDATE %s SET message = ? WHERE id = ?" % table, converted)
+        if invalid:
+            print("DELETING %d INVALID MESSAGES FROM %s" % (len(invalid), table))
+            engine.execute("DELETE FROM %s WHERE id = ?" % table, invalid)
+
+
+def split_database(source_url, delete_source=False, chunk_size=1000):
+    """Copies the tables (and generations) of every group whose database is
+    not `source_url` from the database at `source_url` into the group's own
+    database. Their rows are deleted from the source if `delete_source` is
+    set. Returns the number of copied rows per table.
+    """
+    init()
+    source = create_engine(source_url)
+    generations = Generation.__table__
+    result = {}
+    for group in DB_GROUPS:
+        target = _get_engine(group)
+        if target.url == source.url:
+            continue
+        tables = [t for t in Base.metadata.sorted_tables if t.info.get('db') == group]
+        names = [name for name, g in _GENERATION_DBS.items() if g == group]
+
+        with source.connect() as source_connection, target.begin() as target_connection:
+            for table in tables:
+                if not source.dialect.has_table(source_connection, table.name):
+                    continue
+                if target_connection.execute(select([func.count()]).select_from(table)).scalar():
+                    raise ValueError("%s already contains rows in %s" % (table.name, target.url))
+                rows = source_connection.execute(table.select().order_by(*table.primary_key.columns))
+                result[table.name] = 0
+                while True:
+                    chunk = rows.fetchmany(chunk_size)
+                    if not chunk:
+                        break
+                    target_connection.execute(table.insert(), [dict(row) for row in chunk])
+                    result[table.name] += len(chunk)
+
+            values = source_connection.execute(
+                select([generations.c.name, generations.c.value]).where(generations.c.name.in_(names))).fetchall()
+            target_connection.execute(generations.delete().where(generations.c.name.in_(names)))
+            if values:
+                target_connection.execute(generations.insert(), [dict(row) for row in values])
+
+        if delete_source:
+            with source.begin() as source_connection:
+                for table in reversed(tables):
+                    if source.dialect.has_table(source_connection, table.name):
+                        source_connection.execute(table.delete())
+
+    source.dispose()
+    return result
 
 
 def delete_all():
@@ -29,6 +273,12 @@ def delete_all():
         session.query(ReporterMessage).delete()
         session.query(ReporterInboxMessage).delete()
         session.query(DeadDropMessage).delete()
+        if get_dead_drop_segments() is not None:
+            get_dead_drop_segments().delete_all()
+        _bump_generation(session, GENERATION_NEWS)
+        _bump_generation(session, GENERATION_REPORTERS)
+        _bump_generation(session, GENERATION_REPORTER_INBOX)
+        _bump_generation(session, GENERATION_DEAD_DROP)
         session.commit()
 
 
@@ -38,6 +288,10 @@ def delete_all_messages():
         session.query(ReporterMessage).delete()
         session.query(ReporterInboxMessage).delete()
         session.query(DeadDropMessage).delete()
+        if get_dead_drop_segments() is not None:
+            get_dead_drop_segments().delete_all()
+        _bump_generation(session, GENERATION_REPORTER_INBOX)
+        _bump_generation(session, GENERATION_DEAD_DROP)
         session.commit()
 
 
@@ -45,13 +299,92 @@ class ScopeSession:
 
     def __enter__(self):
         init()
-        self.session = sessionmaker(bind=_get_engine())()
+        self.session = _get_session_factory()()
         return self.session
 
     def __exit__(self, type, value, traceback):
         self.session.close()
 
 
+class ScopeConnection:
+    """Like `ScopeSession` for a Core connection to the database of `group`.
+    Statements that are executed on it are only compiled once per process.
+    """
+
+    def __init__(self, group):
+        self.group = group
+
+    def __enter__(self):
+        init()
+        engine = _get_engine(self.group)
+        self.connection = engine.connect().execution_options(compiled_cache=_compiled_caches[self.group])
+        return self.connection
+
+    def __exit__(self, type, value, traceback):
+        self.connection.close()
+
+
+#
+# Generations (i.e. counters that are incremented within the same transaction
+# that modifies the data they describe). They allow every process to cheaply
+# detect whether derived data such as cached responses is still up-to-date.
+#
+
+GENERATION_DEAD_DROP = 'deaddrop'
+GENERATION_REPORTER_INBOX = 'reporter_inbox'
+GENERATION_REPORTERS = 'reporters'
+GENERATION_NEWS = 'news'
+
+# Generations are stored in the database of the data they describe
+_GENERATION_DBS = {
+    GENERATION_DEAD_DROP: DB_BOARDS,
+    GENERATION_REPORTER_INBOX: DB_BOARDS,
+    GENERATION_REPORTERS: DB_NEWS,
+    GENERATION_NEWS: DB_NEWS,
+}
+
+
+class Generation(Base):
+    __tablename__ = 'generations'
+
+    name = Column(String, primary_key=True)
+    value = Column(Integer, nullable=False)
+
+
+def _bump_generation(session, name):
+    table = Generation.__table__
+    bind = _get_engine(_GENERATION_DBS[name])
+    updated = session.execute(
+        table.update().where(table.c.name == name).values(value=table.c.value + 1), bind=bind).rowcount
+    if updated == 0:
+        session.execute(table.insert().values(name=name, value=1), bind=bind)
+
+
+def _bump_generation_now(name):
+    """Bumps the generation of data that is not stored in the database."""
+    with ScopeSession() as session:
+        _bump_generation(session, name)
+        session.commit()
+
+
+def get_generation(name):
+    return get_generations([name])[0]
+
+
+def get_generations(names):
+    """Like `get_generation` for several `names` within a single query per
+    database.
+    """
+    table = Generation.__table__
+    values = {}
+    for group in {_GENERATION_DBS[name] for name in names}:
+        with ScopeConnection(group) as connection:
+            values.update(connection.execute(
+                select([table.c.name, table.c.value])
+                .where(table.c.name.in_([n for n in names if _GENERATION_DBS[n] == group]))).fetchall())
+    return tuple(values.get(name, 0) for name in names)
+
+
 #
 # News stories (i.e. the regular news stories)
 #
@@ -59,6 +392,7 @@ class ScopeSession:
 
 class NewsStory(Base):
     __tablename__ = 'stories'
+    __table_args__ = {'info': {'db': DB_NEWS}}
 
     id = Column(Integer, primary_key=True)
     headline = Column(String)
@@ -66,20 +400,36 @@ class NewsStory(Base):
     content = Column(String)
     image = Column(String)
 
+    # Loaded within the same query as the story
+    author = relationship('Reporter', lazy='joined')
+
     def to_dict(self):
-        reporter = get_reporter(id=self.reporter)
         return {
             'id': self.id,
             'headline': self.headline,
             'content': self.content,
             'image': self.image,
-            'reporter': reporter.to_dict()
+            'reporter': self.author.to_dict() if self.author is not None else None
+        }
+
+
+# Projection of a story for listings; `to_dict` mirrors `NewsStory.to_dict`
+# without the content and the reporter's key and image
+class NewsStorySummary(collections.namedtuple(
+        'NewsStorySummary', ['id', 'headline', 'image', 'reporter_id', 'reporter_name'])):
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'headline': self.headline,
+            'image': self.image,
+            'reporter': {'id': self.reporter_id, 'name': self.reporter_name},
         }
 
 
 def get_all_news_stories():
     with ScopeSession() as session:
-        return session.query(NewsStory).all()
+        return session.query(NewsStory).order_by(NewsStory.id).all()
 
 
 def get_news_story(id):
@@ -87,24 +437,147 @@ def get_news_story(id):
         return session.query(NewsStory).filter(NewsStory.id == id).one()
 
 
+def get_news_story_summaries(before, limit):
+    """Returns the summaries of the newest `limit` stories with an id smaller
+    than the cursor `before` (or of the newest stories if it is None).
+    """
+    query = select([NewsStory.id, NewsStory.headline, NewsStory.image, Reporter.id, Reporter.name]) \
+        .select_from(NewsStory.__table__.outerjoin(Reporter.__table__, NewsStory.reporter == Reporter.id)) \
+        .order_by(NewsStory.id.desc()) \
+        .limit(limit)
+    if before is not None:
+        query = query.where(NewsStory.id < before)
+
+    with ScopeSession() as session:
+        return [NewsStorySummary(*row) for row in session.execute(query)]
+
+
 def add_news_story(story):
     with ScopeSession() as session:
         session.add(story)
+        _bump_generation(session, GENERATION_NEWS)
+        session.commit()
+
+
+def add_news_stories(stories):
+    """Adds all `stories` within a single transaction."""
+    with ScopeSession() as session:
+        session.bulk_save_objects(stories)
+        _bump_generation(session, GENERATION_NEWS)
         session.commit()
 
 
 def delete_all_news_stories():
     with ScopeSession() as session:
         session.query(NewsStory).delete()
+        _bump_generation(session, GENERATION_NEWS)
         session.commit()
 
 
+#
+# Full-text search over the headlines and contents of the news stories. On
+# SQLite an FTS5 table indexes the stories table as its external content and
+# triggers keep it in sync, so the text is not stored twice. Other databases
+# fall back to a (slow) LIKE scan.
+#
+
+_SEARCH_SCHEMA = [
+    "CREATE VIRTUAL TABLE stories_fts USING fts5("
+    "headline, content, content='stories', content_rowid='id')",
+    "CREATE TRIGGER stories_fts_insert AFTER INSERT ON stories BEGIN "
+    "INSERT INTO stories_fts(rowid, headline, content) VALUES (new.id, new.headline, new.content); "
+    "END",
+    "CREATE TRIGGER stories_fts_delete AFTER DELETE ON stories BEGIN "
+    "INSERT INTO stories_fts(stories_fts, rowid, headline, content) "
+    "VALUES ('delete', old.id, old.headline, old.content); "
+    "END",
+    "CREATE TRIGGER stories_fts_update AFTER UPDATE ON stories BEGIN "
+    "INSERT INTO stories_fts(stories_fts, rowid, headline, content) "
+    "VALUES ('delete', old.id, old.headline, old.content); "
+    "INSERT INTO stories_fts(rowid, headline, content) VALUES (new.id, new.headline, new.content); "
+    "END",
+]
+
+# Matches in the headline weigh more than matches in the content. The page is
+# ranked within the index first so that only its stories are looked up
+_SEARCH_QUERY = text(
+    "SELECT stories.id, stories.headline, stories.image, reporters.id, reporters.name "
+    "FROM (SELECT rowid, bm25(stories_fts, 10.0, 1.0) AS score FROM stories_fts "
+    "      WHERE stories_fts MATCH :query "
+    "      ORDER BY score, rowid DESC "
+    "      LIMIT :limit OFFSET :offset) AS hits "
+    "JOIN stories ON stories.id = hits.rowid "
+    "LEFT OUTER JOIN reporters ON stories.reporter = reporters.id "
+    "ORDER BY hits.score, hits.rowid DESC")
+
+
+def _create_search_index(engine):
+    """Creates the search index of the stories (and indexes all existing
+    stories) unless it already exists.
+    """
+    with engine.begin() as connection:
+        if engine.dialect.has_table(connection, 'stories_fts'):
+            return
+        for statement in _SEARCH_SCHEMA:
+            connection.execute(statement)
+        connection.execute("INSERT INTO stories_fts(stories_fts) VALUES ('rebuild')")
+
+
+def rebuild_search_index():
+    """Re-indexes all stories, e.g. after the index has been corrupted or
+    stories have been modified with the triggers disabled. Returns the
+    number of indexed stories or None if the database has no search index.
+    """
+    init()
+    engine = _get_engine(DB_NEWS)
+    if engine.dialect.name != 'sqlite':
+        return None
+    with engine.begin() as connection:
+        connection.execute("INSERT INTO stories_fts(stories_fts) VALUES ('rebuild')")
+        return connection.execute(select([func.count(NewsStory.id)])).scalar()
+
+
+def search_news_stories(query, offset, limit):
+    """Returns the summaries of the stories that contain all words of
+    `query`, best matches first, skipping the first `offset` matches.
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return []
+
+    with ScopeSession() as session:
+        if _get_engine(DB_NEWS).dialect.name != 'sqlite':
+            return _search_news_stories_like(session, words, offset, limit)
+
+        # Quoting every word makes FTS5 operators such as OR or NEAR plain words
+        match = ' '.join('"%s"' % word for word in words)
+        rows = session.execute(_SEARCH_QUERY, {'query': match, 'limit': limit, 'offset': offset},
+                               bind=_get_engine(DB_NEWS))
+        return [NewsStorySummary(*row) for row in rows]
+
+
+def _search_news_stories_like(session, words, offset, limit):
+    conditions = [
+        or_(func.lower(NewsStory.headline).contains(word.lower(), autoescape=True),
+            func.lower(NewsStory.content).contains(word.lower(), autoescape=True))
+        for word in words
+    ]
+    query = select([NewsStory.id, NewsStory.headline, NewsStory.image, Reporter.id, Reporter.name]) \
+        .select_from(NewsStory.__table__.outerjoin(Reporter.__table__, NewsStory.reporter == Reporter.id)) \
+        .where(and_(*conditions)) \
+        .order_by(NewsStory.id.desc()) \
+        .limit(limit) \
+        .offset(offset)
+    return [NewsStorySummary(*row) for row in session.execute(query)]
+
+
 #
 # Reporters (i.e. the investigative journalists)
 #
 
 class Reporter(Base):
     __tablename__ = 'reporters'
+    __table_args__ = {'info': {'db': DB_NEWS}}
 
     id = Column(Integer, primary_key=True)
     name = Column(String)
@@ -123,6 +596,7 @@ class Reporter(Base):
 def add_reporter(reporter):
     with ScopeSession() as session:
         session.add(reporter)
+        _bump_generation(session, GENERATION_REPORTERS)
         session.commit()
 
 
@@ -139,8 +613,165 @@ def get_reporter(id):
 def delete_all_reporters():
     with ScopeSession() as session:
         session.query(Reporter).delete()
+        _bump_generation(session, GENERATION_REPORTERS)
         session.commit()
 
+#
+# Leases for the queues of user and reporter messages: a consumer claims a
+# batch of messages for a limited time and acknowledges them once they have
+# been processed. Messages of leases that expire without acknowledgement are
+# returned to the queue.
+#
+
+def _is_claimable(cls, now):
+    return or_(cls.lease_expiry == None, cls.lease_expiry < now)
+
+
+class QueuedMessage(collections.namedtuple('QueuedMessage', ['id', 'message'])):
+
+    def to_dict(self):
+        return {'id': self.id, 'message': self.message.hex()}
+
+
+class _QueueStatements:
+    """The statements of the hot queue paths. They bypass the ORM (i.e. the
+    identity map and the unit of work) and are built once so that
+    `ScopeConnection` can reuse their compiled form.
+    """
+
+    def __init__(self, cls):
+        table = cls.__table__
+        claimable = or_(table.c.lease_expiry == None, table.c.lease_expiry < bindparam('now'))
+        oldest_claimable = select([table.c.id, table.c.message]).where(claimable).order_by(table.c.id)
+        oldest_claimable_ids = select([table.c.id]).where(claimable).order_by(table.c.id)
+
+        self.insert = table.insert()
+        self.select_oldest = oldest_claimable.limit(bindparam('count'))
+        self.select_all = oldest_claimable
+        self.lease = table.update() \
+            .where(table.c.id.in_(oldest_claimable_ids.limit(bindparam('count')))) \
+            .values(lease_id=bindparam('new_lease_id'), lease_expiry=bindparam('new_lease_expiry'))
+        self.select_leased = select([table.c.id, table.c.message]) \
+            .where(table.c.lease_id == bindparam('lease_id')) \
+            .order_by(table.c.id)
+        self.delete = table.delete().where(table.c.id == bindparam('id'))
+        self.release = table.update() \
+            .where(table.c.lease_id == bindparam('released_lease_id')) \
+            .values(lease_id=None, lease_expiry=None)
+        self.delete_leased = table.delete().where(and_(
+            table.c.lease_id == bindparam('lease_id'),
+            table.c.id.in_(bindparam('ids', expanding=True))))
+
+
+QueueStats = collections.namedtuple('QueueStats', ['messages', 'leased', 'oldest_creation_datetime'])
+
+
+def count_queued_messages():
+    """Returns the number of messages in the user and reporter message queues."""
+    with ScopeSession() as session:
+        return {
+            'user_messages': session.query(func.count(UserMessage.id)).scalar(),
+            'reporter_messages': session.query(func.count(ReporterMessage.id)).scalar(),
+        }
+
+
+def get_queue_stats():
+    """Returns the `QueueStats` of the user and reporter message queues.
+    Messages that were added before their creation time was recorded do not
+    count towards the oldest creation time.
+    """
+    now = datetime.datetime.now()
+    result = {}
+    with ScopeSession() as session:
+        for name, cls in (('user_messages', UserMessage), ('reporter_messages', ReporterMessage)):
+            messages, oldest = session.query(func.count(cls.id), func.min(cls.creation_datetime)).one()
+            leased = session.query(func.count(cls.id)).filter(~_is_claimable(cls, now)).scalar()
+            result[name] = QueueStats(messages, leased, oldest)
+    return result
+
+
+def _add_message(statements, message):
+    with ScopeConnection(DB_QUEUES) as connection:
+        connection.execute(statements.insert, message=message, creation_datetime=datetime.datetime.now())
+
+
+def _add_messages(statements, messages):
+    if not messages:
+        return
+
+    with ScopeConnection(DB_QUEUES) as connection:
+        now = datetime.datetime.now()
+        connection.execute(statements.insert, [{'message': m, 'creation_datetime': now} for m in messages])
+
+
+def _get_messages(statements, count):
+    """Returns the oldest `count` (or, if None, all) messages that are not
+    leased as `QueuedMessage`s.
+    """
+    now = datetime.datetime.now()
+    with ScopeConnection(DB_QUEUES) as connection:
+        if count is None:
+            rows = connection.execute(statements.select_all, now=now)
+        else:
+            rows = connection.execute(statements.select_oldest, now=now, count=int(count))
+        return [QueuedMessage(*row) for row in rows]
+
+
+def _iter_messages(statements):
+    """Yields all messages that are not leased as `QueuedMessage`s while
+    fetching them in chunks.
+    """
+    with ScopeConnection(DB_QUEUES) as connection:
+        rows = connection.execution_options(stream_results=True) \
+            .execute(statements.select_all, now=datetime.datetime.now())
+        while True:
+            chunk = rows.fetchmany(config.DB_STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            for row in chunk:
+                yield QueuedMessage(*row)
+
+
+def _delete_message(statements, id):
+    with ScopeConnection(DB_QUEUES) as connection:
+        connection.execute(statements.delete, id=id)
+
+
+def _claim_messages(statements, count, lease_seconds):
+    """Leases the oldest `count` claimable messages for `lease_seconds` and
+    returns the lease id and the claimed messages.
+    """
+    lease_id = uuid.uuid4().hex
+    now = datetime.datetime.now()
+    lease_expiry = now + datetime.timedelta(seconds=lease_seconds)
+
+    with ScopeConnection(DB_QUEUES) as connection:
+        # A single UPDATE so that concurrent consumers never claim the same message
+        connection.execute(statements.lease, now=now, count=count,
+                           new_lease_id=lease_id, new_lease_expiry=lease_expiry)
+        rows = connection.execute(statements.select_leased, lease_id=lease_id)
+        return lease_id, [QueuedMessage(*row) for row in rows]
+
+
+def _ack_messages(statements, lease_id, ids):
+    """Deletes the messages with the given `ids` if they are still held by the
+    lease `lease_id` and returns the number of deleted messages.
+    """
+    if not ids:
+        return 0
+
+    with ScopeConnection(DB_QUEUES) as connection:
+        return connection.execute(statements.delete_leased, lease_id=lease_id, ids=list(ids)).rowcount
+
+
+def _release_messages(statements, lease_id):
+    """Returns the messages of the lease `lease_id` to the queue before it
+    expires and returns their number.
+    """
+    with ScopeConnection(DB_QUEUES) as connection:
+        return connection.execute(statements.release, released_lease_id=lease_id).rowcount
+
+
 #
 # UserMessages that users have sent and that the SGX will pull
 #
@@ -148,29 +779,57 @@ def delete_all_reporters():
 
 class UserMessage(Base):
     __tablename__ = 'usermessages'
+    __table_args__ = {'info': {'db': DB_QUEUES}}
 
     id = Column(Integer, primary_key=True)
-    message = Column(String)
+    message = Column(LargeBinary)
+    lease_id = Column(String, index=True)
+    lease_expiry = Column(DateTime)
+    creation_datetime = Column(DateTime)
 
     def to_dict(self):
-        return {'id': self.id, 'message': self.message}
+        return {'id': self.id, 'message': self.message.hex()}
+
+
+_user_message_statements = _QueueStatements(UserMessage)
 
 
 def add_user_message(message):
-    with ScopeSession() as session:
-        session.add(UserMessage(message=message))
-        session.commit()
+    _add_message(_user_message_statements, message)
+
+
+def add_user_messages(messages):
+    """Adds all `messages` within a single transaction."""
+    _add_messages(_user_message_statements, messages)
 
 
 def get_user_messages(count):
-    with ScopeSession() as session:
-        return session.query(UserMessage).order_by(UserMessage.id).limit(count).all()
+    """Returns the oldest `count` user messages that are not leased."""
+    return _get_messages(_user_message_statements, count)
+
+
+def iter_user_messages():
+    """Yields all user messages that are not leased, oldest first."""
+    return _iter_messages(_user_message_statements)
+
+
+def claim_user_messages(count, lease_seconds):
+    """Leases the oldest `count` user messages. See `_claim_messages`."""
+    return _claim_messages(_user_message_statements, count, lease_seconds)
+
+
+def ack_user_messages(lease_id, ids):
+    """Deletes the leased user messages. See `_ack_messages`."""
+    return _ack_messages(_user_message_statements, lease_id, ids)
+
+
+def release_user_messages(lease_id):
+    """Returns the leased user messages to the queue. See `_release_messages`."""
+    return _release_messages(_user_message_statements, lease_id)
 
 
 def delete_user_message(id):
-    with ScopeSession() as session:
-        session.query(UserMessage).filter(UserMessage.id == id).delete()
-        session.commit()
+    _delete_message(_user_message_statements, id)
 
 #
 # ReporterMessages that reporters have sent and that the SGX will pull
@@ -179,60 +838,214 @@ def delete_user_message(id):
 
 class ReporterMessage(Base):
     __tablename__ = 'reportermessages'
+    __table_args__ = {'info': {'db': DB_QUEUES}}
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    message = Column(String)
+    message = Column(LargeBinary)
+    lease_id = Column(String, index=True)
+    lease_expiry = Column(DateTime)
+    creation_datetime = Column(DateTime)
 
     def to_dict(self):
-        return {'id': self.id, 'message': self.message}
+        return {'id': self.id, 'message': self.message.hex()}
+
+
+_reporter_message_statements = _QueueStatements(ReporterMessage)
 
 
 def add_reporter_message(message):
-    with ScopeSession() as session:
-        session.add(ReporterMessage(message=message))
-        session.commit()
+    _add_message(_reporter_message_statements, message)
+
+
+def add_reporter_messages(messages):
+    """Adds all `messages` within a single transaction."""
+    _add_messages(_reporter_message_statements, messages)
 
 
 def get_reporter_messages(count):
-    with ScopeSession() as session:
-        return session.query(ReporterMessage).order_by(ReporterMessage.id).limit(count).all()
+    """Returns the oldest `count` reporter messages that are not leased."""
+    return _get_messages(_reporter_message_statements, count)
+
+
+def iter_reporter_messages():
+    """Yields all reporter messages that are not leased, oldest first."""
+    return _iter_messages(_reporter_message_statements)
+
+
+def claim_reporter_messages(count, lease_seconds):
+    """Leases the oldest `count` reporter messages. See `_claim_messages`."""
+    return _claim_messages(_reporter_message_statements, count, lease_seconds)
+
+
+def ack_reporter_messages(lease_id, ids):
+    """Deletes the leased reporter messages. See `_ack_messages`."""
+    return _ack_messages(_reporter_message_statements, lease_id, ids)
+
+
+def release_reporter_messages(lease_id):
+    """Returns the leased reporter messages to the queue. See `_release_messages`."""
+    return _release_messages(_reporter_message_statements, lease_id)
 
 
 def delete_reporter_message(id):
+    _delete_message(_reporter_message_statements, id)
+
+
+#
+# Outbound messages that the SGX has published for the users and reporters
+#
+
+def _add_batch(cls, generation, messages):
+    if not messages:
+        return
+
+    creation_datetime = datetime.datetime.now()
     with ScopeSession() as session:
-        session.query(ReporterMessage).filter(
-            ReporterMessage.id == id).delete()
+        session.execute(cls.__table__.insert(), [
+            {'message': m, 'creation_datetime': creation_datetime} for m in messages
+        ])
+        _bump_generation(session, generation)
         session.commit()
 
 
+def count_active_messages(last_n_hours):
+    """Returns the number of dead-drop and reporter inbox messages that are
+    currently served to the apps.
+    """
+    cutoff_datetime = datetime.datetime.now() - datetime.timedelta(hours=last_n_hours)
+    with ScopeSession() as session:
+        result = {
+            'reporter_inbox': session.query(func.count(ReporterInboxMessage.id))
+            .filter(ReporterInboxMessage.creation_datetime > cutoff_datetime).scalar()
+        }
+        if get_dead_drop_segments() is not None:
+            result['deaddrop'] = get_dead_drop_segments().count(last_n_hours)
+        else:
+            result['deaddrop'] = session.query(func.count(DeadDropMessage.id)) \
+                .filter(DeadDropMessage.creation_datetime > cutoff_datetime).scalar()
+        return result
+
+
+def _get_active(cls, last_n_hours):
+    with ScopeSession() as session:
+        cutoff_datetime = datetime.datetime.now() - datetime.timedelta(hours=last_n_hours)
+        return session.query(cls.id, cls.message, cls.creation_datetime) \
+            .filter(cls.creation_datetime > cutoff_datetime) \
+            .order_by(cls.id).all()
+
+
+def _iter_active(cls, last_n_hours, since):
+    with ScopeSession() as session:
+        cutoff_datetime = datetime.datetime.now() - datetime.timedelta(hours=last_n_hours)
+        query = session.query(cls.id, cls.message, cls.creation_datetime) \
+            .filter(cls.creation_datetime > cutoff_datetime)
+        if since is not None:
+            query = query.filter(cls.id > since)
+        yield from query.order_by(cls.id).yield_per(config.DB_STREAM_CHUNK_SIZE)
+
+
+def _get_active_cursor(cls, last_n_hours):
+    with ScopeSession() as session:
+        cutoff_datetime = datetime.datetime.now() - datetime.timedelta(hours=last_n_hours)
+        return session.query(func.max(cls.id)).filter(cls.creation_datetime > cutoff_datetime).scalar()
+
+
 #
 # DeadDropMessages (i.e. messages to be fed back to the users)
 #
 
 class DeadDropMessage(Base):
     __tablename__ = 'deaddropmessages'
+    # Ids are never reused so that clients can use them as sync cursors
+    __table_args__ = {'sqlite_autoincrement': True, 'info': {'db': DB_BOARDS}}
 
     id = Column(Integer, primary_key=True)
-    message = Column(String)
-    creation_datetime = Column(DateTime)
+    message = Column(LargeBinary)
+    creation_datetime = Column(DateTime, index=True)
 
 
 def add_dead_drop_message(message):
+    if get_dead_drop_segments() is not None:
+        add_dead_drop_messages([message])
+        return
+
     with ScopeSession() as session:
         session.add(DeadDropMessage(
             message=message,
             creation_datetime=datetime.datetime.now()
         ))
+        _bump_generation(session, GENERATION_DEAD_DROP)
         session.commit()
 
 
+def add_dead_drop_messages(messages):
+    """Adds all `messages` within a single transaction. They share the same
+    creation time so that a batch from the SGX is published as a unit.
+    """
+    if get_dead_drop_segments() is not None:
+        # Invalidates the snapshots even if the append fails as the segment
+        # may have changed anyway (e.g. if dropping the partial batch failed)
+        try:
+            get_dead_drop_segments().append(messages)
+        finally:
+            _bump_generation_now(GENERATION_DEAD_DROP)
+        return
+
+    _add_batch(DeadDropMessage, GENERATION_DEAD_DROP, messages)
+
+
 def get_active_dead_drop_messages(last_n_hours=24):
-    with ScopeSession() as session:
-        cutoff_datetime = datetime.datetime.now() - datetime.timedelta(hours=last_n_hours)
-        messages = session.query(DeadDropMessage).filter(
-            DeadDropMessage.creation_datetime > cutoff_datetime).all()
+    return [m.message for m in get_active_dead_drop_rows(last_n_hours)]
+
+
+def get_active_dead_drop_rows(last_n_hours=24):
+    """Returns the `(id, message, creation_datetime)` tuples of all active
+    dead-drop messages ordered by id.
+    """
+    if get_dead_drop_segments() is not None:
+        return get_dead_drop_segments().rows(last_n_hours)
+
+    return _get_active(DeadDropMessage, last_n_hours)
 
-        return [m.message for m in messages]
+
+def iter_active_dead_drop_rows(last_n_hours=24, since=None):
+    """Like `get_active_dead_drop_rows` for the rows with an id greater than
+    `since`, but yields them while they are fetched in chunks so that memory
+    use does not grow with the size of the dead drop.
+    """
+    if get_dead_drop_segments() is not None:
+        return get_dead_drop_segments().iter_rows(last_n_hours, since, config.DB_STREAM_CHUNK_SIZE)
+
+    return _iter_active(DeadDropMessage, last_n_hours, since)
+
+
+def get_active_dead_drop_cursor(last_n_hours=24):
+    """Returns the id of the newest active dead-drop message or None."""
+    if get_dead_drop_segments() is not None:
+        return get_dead_drop_segments().last_id(last_n_hours)
+
+    return _get_active_cursor(DeadDropMessage, last_n_hours)
+
+
+#
+# Optional storage of the dead drop in segment files (see `segments.py`)
+#
+
+_dead_drop_segments = None
+
+
+def get_dead_drop_segments():
+    """Returns the `SegmentStore` of the dead drop or None if the dead drop
+    is stored in the database.
+    """
+    global _dead_drop_segments
+    if config.DEAD_DROP_STORE != 'segments':
+        return None
+    if _dead_drop_segments is None:
+        _dead_drop_segments = segments.SegmentStore(
+            config.DEAD_DROP_SEGMENTS_DIR,
+            wire.DEAD_DROP_MESSAGE_SIZE)
+    return _dead_drop_segments
 
 
 #
@@ -241,10 +1054,12 @@ def get_active_dead_drop_messages(last_n_hours=24):
 
 class ReporterInboxMessage(Base):
     __tablename__ = 'reporterinboxmessages'
+    # Ids are never reused so that clients can use them as sync cursors
+    __table_args__ = {'sqlite_autoincrement': True, 'info': {'db': DB_BOARDS}}
 
     id = Column(Integer, primary_key=True)
-    message = Column(String)
-    creation_datetime = Column(DateTime)
+    message = Column(LargeBinary)
+    creation_datetime = Column(DateTime, index=True)
 
 
 def add_reporter_inbox_message(message):
@@ -253,28 +1068,97 @@ def add_reporter_inbox_message(message):
             message=message,
             creation_datetime=datetime.datetime.now()
         ))
+        _bump_generation(session, GENERATION_REPORTER_INBOX)
         session.commit()
 
 
+def add_reporter_inbox_messages(messages):
+    """Adds all `messages` within a single transaction. They share the same
+    creation time so that a batch from the SGX is published as a unit.
+    """
+    _add_batch(ReporterInboxMessage, GENERATION_REPORTER_INBOX, messages)
+
+
 def get_active_reporter_inbox_messages(last_n_hours=24):
-    with ScopeSession() as session:
-        cutoff_datetime = datetime.datetime.now() - datetime.timedelta(hours=last_n_hours)
-        messages = session.query(ReporterInboxMessage).filter(
-            (ReporterInboxMessage.creation_datetime > cutoff_datetime)
-        ).all()
+    return [m.message for m in get_active_reporter_inbox_rows(last_n_hours)]
+
+
+def get_active_reporter_inbox_rows(last_n_hours=24):
+    """Returns the `(id, message, creation_datetime)` tuples of all active
+    reporter inbox messages ordered by id.
+    """
+    return _get_active(ReporterInboxMessage, last_n_hours)
+
+
+def iter_active_reporter_inbox_rows(last_n_hours=24, since=None):
+    """Like `iter_active_dead_drop_rows` for the reporter inbox."""
+    return _iter_active(ReporterInboxMessage, last_n_hours, since)
+
+
+def get_active_reporter_inbox_cursor(last_n_hours=24):
+    """Returns the id of the newest active reporter inbox message or None."""
+    return _get_active_cursor(ReporterInboxMessage, last_n_hours)
+
+
+#
+# Retention of the outbound messages
+#
+
+def prune_expired_messages(retention_hours, chunk_size=1000):
+    """Deletes all dead-drop and reporter inbox messages older than
+    `retention_hours` and returns the number of deleted rows per table. Rows
+    are deleted in transactions of at most `chunk_size` rows so that writers
+    are never blocked for long.
+    """
+    cutoff_datetime = datetime.datetime.now() - datetime.timedelta(hours=retention_hours)
+    result = {
+        cls.__tablename__: _prune_expired(cls, generation, cutoff_datetime, chunk_size)
+        for cls, generation in ((DeadDropMessage, GENERATION_DEAD_DROP),
+                                (ReporterInboxMessage, GENERATION_REPORTER_INBOX))
+    }
+
+    if get_dead_drop_segments() is not None:
+        reclaimed = get_dead_drop_segments().prune(retention_hours)
+        if reclaimed > 0:
+            _bump_generation_now(GENERATION_DEAD_DROP)
+        result['deaddrop_segments'] = reclaimed
+
+    return result
+
+
+def _prune_expired(cls, generation, cutoff_datetime, chunk_size):
+    total = 0
+    while True:
+        with ScopeSession() as session:
+            expired_ids = select([cls.id]) \
+                .where(cls.creation_datetime <= cutoff_datetime) \
+                .limit(chunk_size)
+            deleted = session.query(cls) \
+                .filter(cls.id.in_(expired_ids)) \
+                .delete(synchronize_session=False)
+            if deleted > 0:
+                _bump_generation(session, generation)
+            session.commit()
+
+        total += deleted
+        if deleted < chunk_size:
+            return total
 
-        return [m.message for m in messages]
 
 #
 # Public keys
 #
 
+SGX_KEY_PATH = os.path.join('keys', 'sgx_key.hex')
+SGX_SIGN_KEY_PATH = os.path.join('keys', 'sgx_sign_key.hex')
+
+
 def get_sgx_key():
-    with open(os.path.join('keys', 'sgx_key.hex'), 'r') as f:
+    with open(SGX_KEY_PATH, 'r') as f:
         return f.readline()
 
 def get_sgx_sign_key():
-    with open(os.path.join('keys', 'sgx_sign_key.hex'), 'r') as f:
+    with open(SGX_SIGN_KEY_PATH, 'r') as f:
         return f.readline()
 
 def get_reporter_key(reporter_id):
@@ -0,0 +1,249 @@
+"""Server-Sent Events sidecar that pushes newly published dead-drop and
+reporter inbox messages to connected apps.
+
+It runs as a separate single-threaded asyncio process next to the gunicorn
+workers so that idle connections only cost a socket and a coroutine:
+
+    (env) $ python3 events.py --port 8001
+
+Clients connect to `/events/deaddrop` (news app token) or
+`/events/reporter_inbox` (reporter app token) and pass the cursor of their
+last sync via `since` or the `Last-Event-ID` header. They then receive an
+event with the same JSON object as `GET /deaddrop?since=n` whenever messages
+have been published since:
+
+    id: 1300
+    event: messages
+    data: {"messages": [...], "cursor": 1300, "resync": false}
+
+The sidecar serves the same snapshots as the web service (see `snapshots.py`)
+and refreshes them once per process, not per client: every
+`COVERDROP_EVENTS_POLL_INTERVAL_MS` and immediately when a worker sends a
+notification datagram to `COVERDROP_EVENTS_NOTIFY_SOCKET` after the SGX
+posted new messages.
+"""
+
+import argparse
+import asyncio
+import bisect
+import collections
+import config
+import json
+import os
+import snapshots
+import socket
+import urllib.parse
+
+# Maximum size of the request line and headers of a client
+MAX_REQUEST_BYTES = 8192
+
+# Serialized events kept per channel and snapshot; see `Channel.get_event`
+MAX_CACHED_EVENTS = 64
+
+
+def notify(channel_name):
+    """Called from the web service after messages of the channel have been
+    committed. Wakes up the sidecar if one listens on the notify socket; does
+    nothing otherwise.
+    """
+    if not config.EVENTS_NOTIFY_SOCKET:
+        return
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as s:
+            s.setblocking(False)
+            s.sendto(channel_name.encode(), config.EVENTS_NOTIFY_SOCKET)
+    except OSError:
+        pass
+
+
+class Channel:
+
+    def __init__(self, name, snapshot_cache, service):
+        self.name = name
+        self.snapshot_cache = snapshot_cache
+        self.service = service
+        self.snapshot = None
+        self._changed = asyncio.Event()
+        self._events = collections.OrderedDict()
+
+    async def refresh(self, loop):
+        # `SnapshotCache.get` blocks on the database; the executor keeps the
+        # event loop responsive in the meantime
+        snapshot = await loop.run_in_executor(None, self.snapshot_cache.get)
+        if snapshot is not self.snapshot:
+            self.snapshot = snapshot
+            self._events = collections.OrderedDict()
+            self.wake_clients()
+
+    def wake_clients(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def changed(self):
+        """Returns an event that is set on the next change of the snapshot or
+        when it is time to send a keepalive.
+        """
+        return self._changed
+
+    def get_event(self, cursor):
+        """Returns the serialized event for a client at `cursor` (or None if
+        there is nothing new) and the client's next cursor. Most clients are
+        at the same cursor, so the events are only serialized once per
+        snapshot and cursor. All cursors that select the same messages share
+        an event, e.g. every cursor ahead of the newest id (which requires a
+        resync) and every cursor before the oldest one, and only the
+        MAX_CACHED_EVENTS most recently used events are kept.
+        """
+        ids = self.snapshot.ids
+        if not ids:
+            return None, cursor
+
+        # -1 stands for a resync, otherwise the index of the first new message
+        key = -1 if cursor > ids[-1] else bisect.bisect_right(ids, cursor)
+        entry = self._events.get(key)
+        if entry is None:
+            messages, new_cursor, resync = snapshots.select_since(ids, self.snapshot.messages, cursor)
+            event = None
+            if messages or resync:
+                data = json.dumps(
+                    {'messages': [m.hex() for m in messages], 'cursor': new_cursor, 'resync': resync},
+                    separators=(',', ':'))
+                event = ('id: %d\nevent: messages\ndata: %s\n\n' % (new_cursor, data)).encode()
+            entry = self._events[key] = event, new_cursor
+            if len(self._events) > MAX_CACHED_EVENTS:
+                self._events.popitem(last=False)
+        else:
+            self._events.move_to_end(key)
+        return entry
+
+
+class EventServer:
+
+    def __init__(self, channels, token_to_service):
+        self.channels = {'/events/' + c.name: c for c in channels}
+        self.token_to_service = token_to_service
+        self._wakeup = asyncio.Event()
+
+    async def run_poller(self):
+        loop = asyncio.get_running_loop()
+        last_keepalive = loop.time()
+        while True:
+            self._wakeup.clear()
+            for channel in self.channels.values():
+                try:
+                    await channel.refresh(loop)
+                except Exception as e:
+                    print("EVENTS: refreshing %s failed: %s" % (channel.name, e))
+
+            # One timer for all clients instead of a timeout per client
+            if loop.time() - last_keepalive >= config.EVENTS_KEEPALIVE_S:
+                last_keepalive = loop.time()
+                for channel in self.channels.values():
+                    channel.wake_clients()
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), config.EVENTS_POLL_INTERVAL_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+
+    def listen_for_notifications(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.setblocking(False)
+
+        def on_readable():
+            try:
+                while True:
+                    sock.recv(64)
+            except BlockingIOError:
+                pass
+            self._wakeup.set()
+
+        asyncio.get_running_loop().add_reader(sock.fileno(), on_readable)
+        return sock
+
+    async def handle_client(self, reader, writer):
+        try:
+            await self._serve(reader, writer)
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve(self, reader, writer):
+        request = await reader.readuntil(b'\r\n\r\n')
+        lines = request.decode('latin-1').split('\r\n')
+        method, target, _ = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+
+        url = urllib.parse.urlsplit(target)
+        channel = self.channels.get(url.path)
+        if method != 'GET' or channel is None:
+            return await _write_status(writer, '404 Not Found')
+
+        scheme, _, token = headers.get('authorization', '').partition(' ')
+        if scheme != 'Token' or self.token_to_service.get(token) != channel.service:
+            return await _write_status(writer, '401 Unauthorized')
+
+        try:
+            query = urllib.parse.parse_qs(url.query)
+            cursor = int(headers.get('last-event-id') or query.get('since', ['0'])[0])
+        except ValueError:
+            return await _write_status(writer, '400 Bad Request')
+
+        writer.write(
+            b'HTTP/1.1 200 OK\r\n'
+            b'Content-Type: text/event-stream\r\n'
+            b'Cache-Control: no-cache\r\n'
+            b'X-Accel-Buffering: no\r\n'
+            b'Connection: close\r\n'
+            b'\r\n')
+        await writer.drain()
+
+        while True:
+            changed = channel.changed()
+            if channel.snapshot is not None:
+                event, cursor = channel.get_event(cursor)
+                # Comments keep proxies from closing idle connections
+                writer.write(event if event is not None else b': keepalive\n\n')
+                await writer.drain()
+            await changed.wait()
+
+
+async def _write_status(writer, status):
+    writer.write(('HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % status).encode())
+    await writer.drain()
+
+
+async def serve(host, port):
+    # The web service imports this module for `notify`
+    from flaskapp import token_to_service
+
+    server = EventServer([
+        Channel('deaddrop', snapshots.dead_drop, 'news_app'),
+        Channel('reporter_inbox', snapshots.reporter_inbox, 'reporter_app'),
+    ], token_to_service)
+
+    if config.EVENTS_NOTIFY_SOCKET:
+        server.listen_for_notifications(config.EVENTS_NOTIFY_SOCKET)
+
+    poller = asyncio.create_task(server.run_poller())
+    tcp_server = await asyncio.start_server(
+        server.handle_client, host, port, limit=MAX_REQUEST_BYTES, backlog=1024)
+    print("EVENTS: listening on %s:%d" % (host, port), flush=True)
+    async with tcp_server:
+        await asyncio.gather(tcp_server.serve_forever(), poller)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='CoverDrop events sidecar')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
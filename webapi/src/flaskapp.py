@@ -1,9 +1,26 @@
-from flask import Flask, jsonify, request, g
+from flask import Flask, Response, abort, jsonify, request, g, send_file
 from flask_httpauth import HTTPTokenAuth
 from functools import wraps
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
 from werkzeug.security import generate_password_hash, check_password_hash
 
+import admission
+import config
 import datastore
+import events
+import os
+import ingest
+import json
+import metrics
+import profiling
+import pubkeys
+import querylog
+import response_cache
+import retention
+import segments
+import snapshots
+import time
+import wire
 
 app = Flask(__name__)
 auth = HTTPTokenAuth(scheme='Token')
@@ -14,9 +31,37 @@ token_to_service = {
     "news_app_token": "news_app",
     "reporter_app_token": "reporter_app",
     "sgx_token": "sgx",
+    "monitoring_token": "monitoring",
 }
 
 
+if config.PROFILE:
+    profiling.register(app)
+
+
+@app.before_first_request
+def start_background_jobs():
+    if config.RETENTION_INTERVAL_S > 0:
+        retention.start_background_pruning(config.RETENTION_INTERVAL_S)
+    if config.METRICS:
+        metrics.start_background_flushing(config.METRICS_FLUSH_INTERVAL_S)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    if config.METRICS and 'request_start' in g:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        size = None if response.is_streamed else response.calculate_content_length()
+        metrics.record_request(route, request.method, response.status_code,
+                               time.perf_counter() - g.request_start, size)
+    return response
+
+
 @auth.verify_token
 def verify_token(token):
     if token in token_to_service:
@@ -53,17 +98,71 @@ def require_service_auth(require):
 # dead drop messages
 #
 
+STORIES_PAGE_SIZE = 20
+STORIES_MAX_PAGE_SIZE = 100
+
+# Deeper pages of search results get increasingly expensive to rank
+SEARCH_MAX_RESULTS = 1000
+
 
 @app.route('/')
 @require_service_auth(require='news_app')
+@response_cache.cached(response_cache.news)
 def get_index():
     stories = datastore.get_all_news_stories()
     stories_dicts = [it.to_dict() for it in stories]
     return jsonify(stories_dicts)
 
 
+@app.route('/stories')
+@require_service_auth(require='news_app')
+@response_cache.cached(response_cache.news)
+def get_story_summaries():
+    """Returns one page of story summaries, newest first, as
+    `{"stories": [...], "next": n}`. The next page is requested with
+    `before=n` until `next` is null. The full story is available
+    via `/story/<id>`.
+    """
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', default=STORIES_PAGE_SIZE, type=int)
+    if not 1 <= limit <= STORIES_MAX_PAGE_SIZE:
+        abort(400, "`limit` must be between 1 and %d" % STORIES_MAX_PAGE_SIZE)
+
+    stories = datastore.get_news_story_summaries(before, limit)
+    return jsonify({
+        'stories': [it.to_dict() for it in stories],
+        'next': stories[-1].id if len(stories) == limit else None,
+    })
+
+
+@app.route('/search')
+@require_service_auth(require='news_app')
+@response_cache.cached(response_cache.news)
+def get_search_results():
+    """Returns one page of the summaries of the stories that contain all
+    words of `q`, best matches first, as `{"stories": [...], "next": n}`.
+    The next page is requested with `offset=n` until `next` is null.
+    """
+    query = request.args.get('q', default='')
+    offset = request.args.get('offset', default=0, type=int)
+    limit = request.args.get('limit', default=STORIES_PAGE_SIZE, type=int)
+    if not query.strip():
+        abort(400, "`q` must not be empty")
+    if not 1 <= limit <= STORIES_MAX_PAGE_SIZE:
+        abort(400, "`limit` must be between 1 and %d" % STORIES_MAX_PAGE_SIZE)
+    if not 0 <= offset <= SEARCH_MAX_RESULTS - limit:
+        abort(400, "only the first %d results can be requested" % SEARCH_MAX_RESULTS)
+
+    stories = datastore.search_news_stories(query, offset, limit)
+    return jsonify({
+        'stories': [it.to_dict() for it in stories],
+        'next': offset + limit if len(stories) == limit and offset + 2 * limit <= SEARCH_MAX_RESULTS else None,
+    })
+
+
 @app.route('/story/<id>')
 @require_service_auth(require='news_app')
+@response_cache.cached(response_cache.news)
 def get_story(id):
     story = datastore.get_news_story(id=id)
     return jsonify(story.to_dict())
@@ -71,6 +170,7 @@ def get_story(id):
 
 @app.route('/reporters')
 @require_service_auth(require='news_app')
+@response_cache.cached(response_cache.news)
 def get_reporters():
     reporters = datastore.get_all_reporters()
     reporters_dict = [it.to_dict() for it in reporters]
@@ -84,13 +184,7 @@ def get_reporters():
 @app.route('/pubkeys')
 @require_service_auth(require='news_app')
 def get_pub_keys():
-    reporters = datastore.get_all_reporters()
-    reporter_keys = {v.id: v.pub_key for v in reporters}
-    return jsonify({
-        'sgx_key': datastore.get_sgx_key(),
-        'sgx_sign_key': datastore.get_sgx_sign_key(),
-        'reporter_keys': reporter_keys,
-    })
+    return snapshots.make_response(pubkeys.registry.get())
 
 
 #
@@ -98,12 +192,12 @@ def get_pub_keys():
 #
 # The order of methods follows a standard scenario:
 #  - User sends a message
-#  - The SGX queries all buffered user messages
-#  - The user message is deleted
+#  - The SGX queries all buffered user messages (or claims a batch of them)
+#  - The user message is deleted (or the claimed batch is acknowledged)
 #  - The SGX posts a new message to be forwarded to a reporter
 #  - The reporter posts a message (e.g. a reply)
-#  - The SGX queries all buffered reporter messages
-#  - The reporter message is deleted
+#  - The SGX queries all buffered reporter messages (or claims a batch of them)
+#  - The reporter message is deleted (or the claimed batch is acknowledged)
 #  - The SGX posts a new message to be forwarded to a user
 #
 
@@ -113,17 +207,35 @@ def get_pub_keys():
 def post_user_message():
     """Called from the user app to post a new message."""
 
-    message = request.json['message']
-    datastore.add_user_message(message)
+    message = _get_posted_packet(wire.USER_MESSAGE_SIZE)
+    if not _admit(admission.USER_MESSAGES):
+        return ""
+    if config.INGEST_GROUP_COMMIT:
+        _submit(ingest.submit_user_message, message)
+    else:
+        datastore.add_user_message(message)
     return ""
 
 
+@app.route('/user_message/batch', methods=['POST'])
+@require_service_auth(require='news_app')
+def post_user_message_batch():
+    """Called from the user app to post several messages at once, e.g. a
+    real and a dummy message or the messages queued while offline. See
+    `_post_batch`.
+    """
+    return _post_batch(admission.USER_MESSAGES, wire.USER_MESSAGE_SIZE, datastore.add_user_messages)
+
+
 @app.route('/user_messages')
 @require_service_auth(require='sgx')
 def get_user_messages():
     """Called from the SGX to query the oldest `count` user messages."""
     count = request.args.get('count')
     messages = datastore.get_user_messages(count)
+    if _wants_binary():
+        return _binary_response(wire.encode_with_ids(messages, wire.USER_MESSAGE_SIZE))
+
     messages_array = [m.to_dict() for m in messages]
     return jsonify(messages_array)
 
@@ -135,38 +247,101 @@ def delete_user_message(id):
     with the given `id`.
     """
     datastore.delete_user_message(id)
+    metrics.record_acked('user_messages', 1)
     return ""
 
 
+@app.route('/user_messages/claim', methods=['POST'])
+@require_service_auth(require='sgx')
+def post_claim_user_messages():
+    """Called from the SGX to lease the oldest `count` user messages. The
+    messages must be acknowledged via `/user_messages/ack` before the lease
+    expires or they are returned to the queue.
+    """
+    count, lease_seconds = _get_claim_args()
+    lease_id, messages = datastore.claim_user_messages(count, lease_seconds)
+    metrics.record_claimed('user_messages', len(messages))
+    if _wants_binary():
+        return _binary_response(
+            wire.encode_with_ids(messages, wire.USER_MESSAGE_SIZE),
+            headers={'X-Lease-Id': lease_id, 'X-Lease-Seconds': str(lease_seconds)})
+
+    return jsonify({
+        'lease_id': lease_id,
+        'lease_seconds': lease_seconds,
+        'messages': [m.to_dict() for m in messages],
+    })
+
+
+@app.route('/user_messages/ack', methods=['POST'])
+@require_service_auth(require='sgx')
+def post_ack_user_messages():
+    """Called from the SGX to delete the claimed user messages with the given
+    `ids` of the lease `lease_id`.
+    """
+    lease_id, ids = _get_ack_args()
+    deleted = datastore.ack_user_messages(lease_id, ids)
+    metrics.record_acked('user_messages', deleted)
+    return jsonify({'deleted': deleted})
+
+
+@app.route('/user_messages/release', methods=['POST'])
+@require_service_auth(require='sgx')
+def post_release_user_messages():
+    """Called from the SGX to return the claimed user messages of the lease
+    `lease_id` to the queue without waiting for the lease to expire.
+    """
+    released = datastore.release_user_messages(_get_lease_id(request.get_json(silent=True)))
+    return jsonify({'released': released})
+
+
 @app.route('/send_to_reporter', methods=['POST'])
 @require_service_auth(require='sgx')
 def post_send_to_reporter():
     """Called from the SGX to send a message to the reporters
     """
-    messages = request.json['messages']
-
-    for message in messages:
-        datastore.add_reporter_inbox_message(message)
+    messages = _get_posted_packets(wire.REPORTER_INBOX_MESSAGE_SIZE)
+    datastore.add_reporter_inbox_messages(messages)
+    events.notify('reporter_inbox')
     return ""
 
 
 @app.route('/reporter_inbox', methods=['GET'])
 @require_service_auth(require='reporter_app')
 def get_reporter_inbox():
-    """Called from the reporter app to get recent messages."""
-    messages = datastore.get_active_reporter_inbox_messages()
-    return jsonify(messages)
+    """Called from the reporter app to get recent messages. See
+    `_get_published_messages` for the optional `since` cursor.
+    """
+    return _get_published_messages(
+        snapshots.reporter_inbox,
+        datastore.iter_active_reporter_inbox_rows,
+        datastore.get_active_reporter_inbox_cursor,
+        wire.REPORTER_INBOX_MESSAGE_SIZE)
 
 
 @app.route('/reporter_message', methods=['POST'])
 @require_service_auth(require='reporter_app')
 def post_from_reporter():
     """Called from the reporter app to post a new reporter message."""
-    message = request.json['message']
-    datastore.add_reporter_message(message)
+    message = _get_posted_packet(wire.REPORTER_MESSAGE_SIZE)
+    if not _admit(admission.REPORTER_MESSAGES):
+        return ""
+    if config.INGEST_GROUP_COMMIT:
+        _submit(ingest.submit_reporter_message, message)
+    else:
+        datastore.add_reporter_message(message)
     return ""
 
 
+@app.route('/reporter_message/batch', methods=['POST'])
+@require_service_auth(require='reporter_app')
+def post_reporter_message_batch():
+    """Called from the reporter app to post several messages at once, e.g.
+    all replies and a dummy message. See `_post_batch`.
+    """
+    return _post_batch(admission.REPORTER_MESSAGES, wire.REPORTER_MESSAGE_SIZE, datastore.add_reporter_messages)
+
+
 @app.route('/reporter_messages')
 @require_service_auth(require='sgx')
 def get_reporter_messages():
@@ -175,6 +350,9 @@ def get_reporter_messages():
     """
     count = request.args.get('count')
     messages = datastore.get_reporter_messages(count)
+    if _wants_binary():
+        return _binary_response(wire.encode_with_ids(messages, wire.REPORTER_MESSAGE_SIZE))
+
     messages_array = [m.to_dict() for m in messages]
     return jsonify(messages_array)
 
@@ -186,27 +364,363 @@ def delete_reporter_message(id):
     with the given `id`.
     """
     datastore.delete_reporter_message(id)
+    metrics.record_acked('reporter_messages', 1)
     return ""
 
 
+@app.route('/reporter_messages/claim', methods=['POST'])
+@require_service_auth(require='sgx')
+def post_claim_reporter_messages():
+    """Called from the SGX to lease the oldest `count` reporter messages. The
+    messages must be acknowledged via `/reporter_messages/ack` before the
+    lease expires or they are returned to the queue.
+    """
+    count, lease_seconds = _get_claim_args()
+    lease_id, messages = datastore.claim_reporter_messages(count, lease_seconds)
+    metrics.record_claimed('reporter_messages', len(messages))
+    if _wants_binary():
+        return _binary_response(
+            wire.encode_with_ids(messages, wire.REPORTER_MESSAGE_SIZE),
+            headers={'X-Lease-Id': lease_id, 'X-Lease-Seconds': str(lease_seconds)})
+
+    return jsonify({
+        'lease_id': lease_id,
+        'lease_seconds': lease_seconds,
+        'messages': [m.to_dict() for m in messages],
+    })
+
+
+@app.route('/reporter_messages/ack', methods=['POST'])
+@require_service_auth(require='sgx')
+def post_ack_reporter_messages():
+    """Called from the SGX to delete the claimed reporter messages with the
+    given `ids` of the lease `lease_id`.
+    """
+    lease_id, ids = _get_ack_args()
+    deleted = datastore.ack_reporter_messages(lease_id, ids)
+    metrics.record_acked('reporter_messages', deleted)
+    return jsonify({'deleted': deleted})
+
+
+@app.route('/reporter_messages/release', methods=['POST'])
+@require_service_auth(require='sgx')
+def post_release_reporter_messages():
+    """Called from the SGX to return the claimed reporter messages of the lease
+    `lease_id` to the queue without waiting for the lease to expire.
+    """
+    released = datastore.release_reporter_messages(_get_lease_id(request.get_json(silent=True)))
+    return jsonify({'released': released})
+
+
+def _admit(queue, count=1):
+    """Returns whether `count` posted messages should be stored. If the
+    `queue` is full, they are either silently dropped (False) or rejected
+    with `429 Too Many Requests`. See `admission.py`.
+    """
+    if admission.admit(queue, count):
+        return True
+    metrics.record_rejected(queue, count)
+    if config.QUEUE_FULL_MODE == admission.MODE_SHED:
+        return False
+    raise TooManyRequests("the queue is full", retry_after=config.QUEUE_RETRY_AFTER_S)
+
+
+def _submit(submit, message):
+    """Hands the `message` to group commit. If it was not committed in time,
+    answers `503 Service Unavailable`; after a timeout the message may still
+    be committed later, so the outcome is unknown to the client.
+    """
+    try:
+        submit(message)
+    except ingest.IngestError as e:
+        raise ServiceUnavailable(str(e), retry_after=config.INGEST_RETRY_AFTER_S)
+
+
+def _post_batch(queue, packet_size, add_messages):
+    """Stores the valid packets of `{"messages": [...]}` (or of a body in the
+    wire format) within a single transaction and returns the status of each
+    packet as `{"statuses": [...]}`: `accepted` or `invalid` if it is not a
+    hex-encoded packet of `packet_size` bytes. The batch is admitted or
+    rejected as a whole.
+    """
+    if request.mimetype == wire.MEDIA_TYPE:
+        packets = _get_posted_packets(packet_size)
+    else:
+        body = request.get_json(silent=True)
+        messages = body.get('messages') if isinstance(body, dict) else None
+        if not isinstance(messages, list):
+            abort(400, "expected {\"messages\": [...]}")
+        packets = [_decode_packet(m, packet_size) for m in messages]
+
+    if len(packets) > config.INGEST_MAX_BATCH_PACKETS:
+        abort(413, "at most %d packets can be posted at once" % config.INGEST_MAX_BATCH_PACKETS)
+
+    valid = [p for p in packets if p is not None]
+    if valid and _admit(queue, len(valid)):
+        add_messages(valid)
+    return jsonify({'statuses': ['accepted' if p is not None else 'invalid' for p in packets]})
+
+
+def _decode_packet(message, packet_size):
+    """Returns the packet of the hex-encoded `message` or None if it is
+    invalid.
+    """
+    try:
+        packet = bytes.fromhex(message)
+    except (TypeError, ValueError):
+        return None
+    return packet if len(packet) == packet_size else None
+
+
+def _get_claim_args():
+    count = request.args.get('count', type=int)
+    lease_seconds = request.args.get('lease', default=config.QUEUE_LEASE_SECONDS, type=int)
+    if count is None or count < 1:
+        abort(400, "`count` must be a positive integer")
+    if not 1 <= lease_seconds <= config.QUEUE_MAX_LEASE_SECONDS:
+        abort(400, "`lease` must be between 1 and %d seconds" % config.QUEUE_MAX_LEASE_SECONDS)
+    return count, lease_seconds
+
+
+def _get_ack_args():
+    body = request.get_json(silent=True)
+    ids = body.get('ids') if isinstance(body, dict) else None
+    if not isinstance(ids, list) or not all(isinstance(id, int) and not isinstance(id, bool) for id in ids):
+        abort(400, "`ids` must be a list of message ids")
+    return _get_lease_id(body), ids
+
+
+def _get_lease_id(body):
+    lease_id = body.get('lease_id') if isinstance(body, dict) else None
+    if not isinstance(lease_id, str):
+        abort(400, "`lease_id` must be a string")
+    return lease_id
+
+
 @app.route('/send_to_users', methods=['POST'])
 @require_service_auth(require='sgx')
 def post_send_to_users():
     """Called from the SGX to add the messages to the list of messages that
     are to be distributed to the user apps.
     """
-    messages = request.json['messages']
-
-    for message in messages:
-        datastore.add_dead_drop_message(message)
+    messages = _get_posted_packets(wire.DEAD_DROP_MESSAGE_SIZE)
+    datastore.add_dead_drop_messages(messages)
+    events.notify('deaddrop')
     return ""
 
 
 @app.route('/deaddrop')
 @require_service_auth(require='news_app')
 def get_dead_drop_messages():
-    messages = datastore.get_active_dead_drop_messages()
-    return jsonify(messages)
+    """Called from the user app to get recent messages. See
+    `_get_published_messages` for the optional `since` cursor.
+    """
+    return _get_published_messages(
+        snapshots.dead_drop,
+        datastore.iter_active_dead_drop_rows,
+        datastore.get_active_dead_drop_cursor,
+        wire.DEAD_DROP_MESSAGE_SIZE)
+
+
+@app.route('/deaddrop/segments')
+@require_service_auth(require='news_app')
+def get_dead_drop_segments():
+    """Lists the active dead-drop segment files if the dead drop is stored in
+    segments. The id of the first record of a segment is `first_id`, all
+    further records follow consecutively.
+    """
+    store = _get_dead_drop_segment_store()
+    result = []
+    for segment in store.segments(config.MESSAGE_WINDOW_HOURS):
+        size = os.path.getsize(segment.path)
+        result.append({
+            'name': os.path.basename(segment.path),
+            'first_id': (segment.hour << 32) + 1,
+            'size': size - size % wire.DEAD_DROP_MESSAGE_SIZE,
+            'sealed': segments.is_sealed(segment),
+        })
+    return jsonify(result)
+
+
+@app.route('/deaddrop/segments/<name>')
+@require_service_auth(require='news_app')
+def get_dead_drop_segment(name):
+    """Returns the raw concatenated records of a dead-drop segment. Supports
+    `Range` requests so that clients can resume downloads or fetch chunks in
+    parallel.
+    """
+    store = _get_dead_drop_segment_store()
+    segment = store.get_segment(name, config.MESSAGE_WINDOW_HOURS)
+    if segment is None:
+        abort(404)
+
+    if segments.is_sealed(segment):
+        # Sealed segments never change and are sent from the file without
+        # copying (via `wsgi.file_wrapper`, e.g. `sendfile` with gunicorn)
+        response = send_file(segment.path, mimetype=wire.MEDIA_TYPE, conditional=True)
+        response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % (
+            3600 * config.MESSAGE_WINDOW_HOURS)
+        return response
+
+    # The current segment still grows, so we serve the complete records that
+    # have been written so far
+    data = store.read(segment)
+    response = Response(data, mimetype=wire.MEDIA_TYPE)
+    response.set_etag('%s-%d' % (name, len(data)))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+
+
+def _get_dead_drop_segment_store():
+    store = datastore.get_dead_drop_segments()
+    if store is None:
+        abort(404, "the dead drop is not stored in segments")
+    return store
+
+
+def _get_published_messages(snapshot_cache, iter_rows, get_cursor, packet_size):
+    """Returns all active messages as a JSON array. If the client passes the
+    cursor of its last sync via `since`, it only receives newer messages as
+    `{"messages": [...], "cursor": n, "resync": bool}`. If `resync` is true,
+    the cursor was not recognized and `messages` contains all active messages.
+
+    In the binary format the cursor and the resync flag are returned in the
+    `X-Cursor` and `X-Resync` headers.
+    """
+    since = request.args.get('since', type=int)
+    binary = _wants_binary()
+
+    if not config.SNAPSHOTS:
+        return _stream_published_messages(iter_rows, get_cursor, packet_size, since, binary)
+
+    snapshot = snapshot_cache.get()
+    if since is None:
+        return snapshots.make_response(snapshot, binary)
+
+    messages, cursor, resync = snapshots.select_since(snapshot.ids, snapshot.messages, since)
+    if binary:
+        return _binary_response(
+            wire.encode(messages, packet_size),
+            headers={'X-Cursor': str(cursor), 'X-Resync': str(int(resync))})
+    return jsonify({'messages': [m.hex() for m in messages], 'cursor': cursor, 'resync': resync})
+
+
+def _stream_published_messages(iter_rows, get_cursor, packet_size, since, binary):
+    """Like `_get_published_messages` but reads the messages from the
+    database. JSON responses are streamed while the rows are fetched in
+    chunks, so memory use does not grow with the number of messages. The
+    binary format is built in memory as its header contains the count.
+    """
+    window = config.MESSAGE_WINDOW_HOURS
+    resync = False
+    if since is not None:
+        newest = get_cursor(window)
+        resync = newest is not None and since > newest
+    rows = iter_rows(window, None if resync else since)
+
+    if binary:
+        rows = list(rows)
+        body = wire.encode([r.message for r in rows], packet_size)
+        if since is None:
+            return _binary_response(body)
+        cursor = rows[-1].id if rows else since
+        return _binary_response(body, headers={'X-Cursor': str(cursor), 'X-Resync': str(int(resync))})
+
+    if since is None:
+        return _stream_json(_json_array('"%s"' % r.message.hex() for r in rows))
+
+    def generate():
+        cursor = since
+
+        def messages():
+            nonlocal cursor
+            for r in rows:
+                cursor = r.id
+                yield '"%s"' % r.message.hex()
+
+        yield '{"messages":'
+        yield from _json_array(messages())
+        yield ',"cursor":%d,"resync":%s}' % (cursor, 'true' if resync else 'false')
+
+    return _stream_json(generate())
+
+
+#
+# Helpers for message payloads. These are JSON objects with hex-encoded
+# packets by default or, if the client opts in via the `Content-Type` and
+# `Accept` headers, the binary wire format of `wire.py`.
+#
+
+STREAM_BUFFER_BYTES = 65536
+
+
+def _wants_binary():
+    best = request.accept_mimetypes.best_match(['application/json', wire.MEDIA_TYPE])
+    return best == wire.MEDIA_TYPE
+
+
+def _binary_response(body, headers=None):
+    return Response(body, mimetype=wire.MEDIA_TYPE, headers=headers)
+
+
+def _stream_json(parts):
+    """Returns a streamed JSON response of the string `parts`. They are
+    joined into chunks of about STREAM_BUFFER_BYTES so that the body is not
+    written to the socket in tiny pieces.
+    """
+    def generate():
+        buffer, size = [], 0
+        for part in parts:
+            buffer.append(part)
+            size += len(part)
+            if size >= STREAM_BUFFER_BYTES:
+                yield ''.join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield ''.join(buffer)
+
+    return Response(generate(), mimetype='application/json')
+
+
+def _json_array(items):
+    """Yields the parts of a JSON array of the already encoded `items`."""
+    yield '['
+    for index, item in enumerate(items):
+        yield item if index == 0 else ',' + item
+    yield ']'
+
+
+def _get_posted_packets(packet_size):
+    """Returns the packets posted as `{"messages": [...]}` or in the wire format."""
+    if request.mimetype == wire.MEDIA_TYPE:
+        try:
+            return wire.decode(request.get_data(), packet_size)
+        except wire.WireFormatError as e:
+            abort(400, str(e))
+
+    body = request.get_json(silent=True)
+    messages = body.get('messages') if isinstance(body, dict) else None
+    if not isinstance(messages, list):
+        abort(400, "expected {\"messages\": [...]}")
+    packets = [_decode_packet(m, packet_size) for m in messages]
+    if None in packets:
+        abort(400, "messages must be hex-encoded packets of %d bytes" % packet_size)
+    return packets
+
+
+def _get_posted_packet(packet_size):
+    """Returns the packet posted as `{"message": ...}` or in the wire format."""
+    if request.mimetype == wire.MEDIA_TYPE:
+        packets = _get_posted_packets(packet_size)
+        if len(packets) != 1:
+            abort(400, "expected exactly one packet")
+        return packets[0]
+
+    body = request.get_json(silent=True)
+    packet = _decode_packet(body.get('message') if isinstance(body, dict) else None, packet_size)
+    if packet is None:
+        abort(400, "message must be a hex-encoded packet of %d bytes" % packet_size)
+    return packet
 
 
 #
@@ -214,16 +728,67 @@ def get_dead_drop_messages():
 #
 
 
+@app.route('/metrics')
+@require_service_auth(require='monitoring')
+def get_metrics():
+    """Called from Prometheus to scrape the metrics of all workers."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/debug/all_messages', methods=['GET'])
 @require_service_auth(require='sgx')
 def get_debug_all_messages():
-    result = {
-        "user_messages": [m.to_dict() for m in datastore.get_user_messages(9999)],
-        "reporter_inboxes": datastore.get_active_reporter_inbox_messages(),
-        "reporter_messages": [m.to_dict() for m in datastore.get_reporter_messages(9999)],
-        "deaddrop": datastore.get_active_dead_drop_messages()
-    }
-    return jsonify(result)
+    """Streams all queued and active messages; see `_stream_json`."""
+    window = config.MESSAGE_WINDOW_HOURS
+
+    def generate():
+        yield '{"user_messages":'
+        yield from _json_array(json.dumps(m.to_dict()) for m in datastore.iter_user_messages())
+        yield ',"reporter_inboxes":'
+        yield from _json_array('"%s"' % r.message.hex() for r in datastore.iter_active_reporter_inbox_rows(window))
+        yield ',"reporter_messages":'
+        yield from _json_array(json.dumps(m.to_dict()) for m in datastore.iter_reporter_messages())
+        yield ',"deaddrop":'
+        yield from _json_array('"%s"' % r.message.hex() for r in datastore.iter_active_dead_drop_rows(window))
+        yield '}'
+
+    return _stream_json(generate())
+
+
+@app.route('/debug/queries', methods=['GET'])
+@require_service_auth(require='sgx')
+def get_debug_queries():
+    """Returns this worker's per-statement timings if `COVERDROP_QUERY_LOG` is
+    enabled.
+    """
+    if not config.QUERY_LOG:
+        abort(404, "the query log is disabled")
+    return jsonify({'pid': os.getpid(), 'statements': querylog.get_stats()})
+
+
+@app.route('/debug/profiles', methods=['GET'])
+@require_service_auth(require='sgx')
+def get_debug_profiles():
+    """Returns the hottest functions per route of the sampled profiles if
+    `COVERDROP_PROFILE` is enabled. Supports `route`, `sort` (`total` or
+    `cumulative`), and `limit`.
+    """
+    if not config.PROFILE:
+        abort(404, "profiling is disabled")
+    sort = request.args.get('sort', 'total')
+    if sort not in profiling.SORT_KEYS:
+        abort(400, "`sort` must be one of %s" % ', '.join(profiling.SORT_KEYS))
+    return jsonify(profiling.summarize(
+        request.args.get('route'),
+        sort,
+        request.args.get('limit', default=20, type=int)))
+
+
+@app.route('/debug/response_cache', methods=['GET'])
+@require_service_auth(require='sgx')
+def get_debug_response_cache():
+    """Returns the hit and miss counts of this worker's response cache."""
+    return jsonify({'pid': os.getpid(), 'news': response_cache.news.stats()})
 
 
 @app.route('/debug/delete_all_messages', methods=['POST'])
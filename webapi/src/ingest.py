@@ -0,0 +1,116 @@
+"""Group commit for incoming user and reporter messages.
+
+Instead of running one transaction per posted packet, request threads hand
+their packet to a `GroupCommitBuffer` and block until a background thread has
+written it together with all other pending packets in a single transaction.
+"""
+
+import config
+import datastore
+import os
+import threading
+import time
+
+
+class IngestError(Exception):
+    pass
+
+
+class _PendingPacket:
+
+    def __init__(self, message):
+        self.message = message
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommitBuffer:
+    """Collects messages and flushes them via `flush_fn(messages)` every
+    `flush_interval_ms` milliseconds or once `flush_max_packets` messages are
+    pending, whichever comes first.
+    """
+
+    def __init__(self, flush_fn, flush_interval_ms, flush_max_packets, ack_timeout_ms):
+        self.flush_fn = flush_fn
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.flush_max_packets = flush_max_packets
+        self.ack_timeout = ack_timeout_ms / 1000.0
+
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, message):
+        """Adds `message` to the next flush and blocks until it has been
+        committed. Raises an `IngestError` if the flush failed or timed out.
+        """
+        packet = _PendingPacket(message)
+        with self._cond:
+            self._pending.append(packet)
+            if len(self._pending) == 1 or len(self._pending) >= self.flush_max_packets:
+                self._cond.notify()
+
+        if not packet.done.wait(self.ack_timeout):
+            raise IngestError("timed out waiting for group commit")
+        if packet.error is not None:
+            raise IngestError("group commit failed") from packet.error
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+
+                # The flush interval starts with the first pending packet
+                deadline = time.monotonic() + self.flush_interval
+                while len(self._pending) < self.flush_max_packets:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                batch = self._pending
+                self._pending = []
+
+            try:
+                self.flush_fn([p.message for p in batch])
+            except Exception as e:
+                for p in batch:
+                    p.error = e
+
+            for p in batch:
+                p.done.set()
+
+
+#
+# Per-process buffers for the two inbound queues
+#
+
+_buffers = {}
+_buffers_pid = None
+_buffers_lock = threading.Lock()
+
+
+def _get_buffer(name, flush_fn):
+    global _buffers, _buffers_pid
+    with _buffers_lock:
+        # The flusher threads do not survive a fork
+        if _buffers_pid != os.getpid():
+            _buffers = {}
+            _buffers_pid = os.getpid()
+        if name not in _buffers:
+            _buffers[name] = GroupCommitBuffer(
+                flush_fn,
+                flush_interval_ms=config.INGEST_FLUSH_INTERVAL_MS,
+                flush_max_packets=config.INGEST_FLUSH_MAX_PACKETS,
+                ack_timeout_ms=config.INGEST_ACK_TIMEOUT_MS)
+        return _buffers[name]
+
+
+def submit_user_message(message):
+    _get_buffer('user', datastore.add_user_messages).submit(message)
+
+
+def submit_reporter_message(message):
+    _get_buffer('reporter', datastore.add_reporter_messages).submit(message)
@@ -0,0 +1,300 @@
+"""Request and queue metrics in the Prometheus text format.
+
+Every worker records request counts, latencies, and response sizes in memory
+and a background thread periodically writes them to the worker's own file in
+`COVERDROP_METRICS_DIR`. A scrape of `/metrics` (which may hit any worker)
+merges the files of all workers and adds gauges of the queues and boards that
+are read from the database at that time.
+
+Counters must never decrease, so the metrics of a worker that has exited are
+kept: once its file has not been written for `STALE_FLUSH_INTERVALS` flush
+intervals and its process is gone, a scrape folds it into `archive.json`,
+which is always merged, and deletes it.
+"""
+
+import config
+import datastore
+import datetime
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+STALE_FLUSH_INTERVALS = 3
+ARCHIVE_FILE_NAME = 'archive.json'
+
+HELP = {
+    'coverdrop_http_requests_total': ('counter', 'Requests by route, method, and status'),
+    'coverdrop_http_request_duration_seconds': ('histogram', 'Time spent handling a request'),
+    'coverdrop_http_response_size_bytes': ('histogram', 'Size of the response body'),
+    'coverdrop_queue_claimed_messages_total': ('counter', 'Messages claimed by the SGX'),
+    'coverdrop_queue_acked_messages_total': ('counter', 'Messages acknowledged (i.e. removed) by the SGX'),
+    'coverdrop_queue_rejected_messages_total': ('counter', 'Messages rejected or shed because the queue was full'),
+    'coverdrop_queue_messages': ('gauge', 'Messages waiting in the queue including leased ones'),
+    'coverdrop_queue_leased_messages': ('gauge', 'Messages currently leased by the SGX'),
+    'coverdrop_queue_oldest_message_age_seconds': ('gauge', 'Age of the oldest message in the queue'),
+    'coverdrop_published_messages': ('gauge', 'Messages currently served to the apps'),
+}
+
+
+class Registry:
+    """Counters and histograms of a single process. Series are identified by
+    their name and a sorted tuple of label pairs.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            # Bucket counts are not cumulative here; see `_render_histogram`
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    'buckets': list(buckets),
+                    'counts': [0] * (len(buckets) + 1),
+                    'sum': 0,
+                }
+            index = 0
+            while index < len(buckets) and value > buckets[index]:
+                index += 1
+            histogram['counts'][index] += 1
+            histogram['sum'] += value
+
+    def to_json(self, **extra):
+        with self._lock:
+            return json.dumps(dict(extra, **{
+                'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, labels, h] for (name, labels), h in self.histograms.items()],
+            }))
+
+    def merge_json(self, data):
+        state = json.loads(data)
+        for name, labels, value in state['counters']:
+            self.inc(name, value, **dict(labels))
+        for name, labels, h in state['histograms']:
+            key = (name, tuple(sorted(dict(labels).items())))
+            existing = self.histograms.get(key)
+            if existing is None:
+                self.histograms[key] = h
+            else:
+                existing['counts'] = [a + b for a, b in zip(existing['counts'], h['counts'])]
+                existing['sum'] += h['sum']
+        return state
+
+
+registry = Registry()
+
+# Unique per process as pids are reused after restarts
+_file_name = None
+_file_pid = None
+_flush_lock = threading.Lock()
+_thread_pid = None
+_thread_lock = threading.Lock()
+
+
+def record_request(route, method, status, duration, size):
+    registry.inc('coverdrop_http_requests_total', route=route, method=method, status=str(status))
+    registry.observe('coverdrop_http_request_duration_seconds', duration, LATENCY_BUCKETS,
+                     route=route, method=method)
+    if size is not None:
+        registry.observe('coverdrop_http_response_size_bytes', size, SIZE_BUCKETS, route=route)
+
+
+def record_claimed(queue, count):
+    registry.inc('coverdrop_queue_claimed_messages_total', count, queue=queue)
+
+
+def record_acked(queue, count):
+    registry.inc('coverdrop_queue_acked_messages_total', count, queue=queue)
+
+
+def record_rejected(queue, count):
+    registry.inc('coverdrop_queue_rejected_messages_total', count, queue=queue)
+
+
+def start_background_flushing(interval_s):
+    """Starts a daemon thread that flushes every `interval_s` seconds, also
+    while the worker is idle so that its file does not become stale. Calling
+    this repeatedly within the same process has no effect.
+    """
+    global _thread_pid
+    with _thread_lock:
+        if _thread_pid == os.getpid():
+            return
+        _thread_pid = os.getpid()
+
+    def run():
+        while True:
+            time.sleep(interval_s)
+            try:
+                flush()
+            except OSError as e:
+                print("METRICS FLUSH FAILED: %s" % e)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def flush():
+    """Writes the metrics of this process to its file in the metrics directory."""
+    global _file_name, _file_pid
+    with _flush_lock:
+        if _file_pid != os.getpid():
+            _file_name = 'worker-%d-%s.json' % (os.getpid(), uuid.uuid4().hex[:8])
+            _file_pid = os.getpid()
+
+        os.makedirs(config.METRICS_DIR, exist_ok=True)
+        path = os.path.join(config.METRICS_DIR, _file_name)
+        _write_file(path, registry.to_json())
+
+
+def _write_file(path, data):
+    with open(path + '.tmp', 'w') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+
+def _is_dead_worker_file(name, stale_before):
+    """Returns whether `name` is the file of a worker that has exited. A
+    stale file of a live process (e.g. one that is blocked) is kept.
+    """
+    if not name.startswith('worker-'):
+        return False
+    try:
+        if os.path.getmtime(os.path.join(config.METRICS_DIR, name)) >= stale_before:
+            return False
+        os.kill(int(name.split('-')[1]), 0)
+    except ProcessLookupError:
+        return True
+    except (OSError, ValueError):
+        return False
+    return False
+
+
+def _archive_dead_workers(archive, folded):
+    """Folds the files of exited workers into the `archive` registry, adds
+    their names to `folded`, and deletes them. The archive lists the files
+    it contains, so a file that could not be deleted after it was folded is
+    not counted twice.
+    """
+    stale_before = time.time() - STALE_FLUSH_INTERVALS * config.METRICS_FLUSH_INTERVAL_S
+    dead = [name for name in os.listdir(config.METRICS_DIR)
+            if name not in folded and _is_dead_worker_file(name, stale_before)]
+    for name in dead:
+        with open(os.path.join(config.METRICS_DIR, name)) as f:
+            archive.merge_json(f.read())
+        folded.append(name)
+    if not dead:
+        return
+
+    present = set(os.listdir(config.METRICS_DIR))
+    folded[:] = [name for name in folded if name in present]
+    _write_file(os.path.join(config.METRICS_DIR, ARCHIVE_FILE_NAME), archive.to_json(folded=folded))
+    for name in dead:
+        try:
+            os.remove(os.path.join(config.METRICS_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+def _merge_files():
+    """Returns the merged metrics of the archive and of all live workers."""
+    merged = Registry()
+    with open(os.path.join(config.METRICS_DIR, 'archive.lock'), 'w') as lock:
+        # Serializes the scrapes of all workers so that none of them misses
+        # a file while another one moves it into the archive
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_path = os.path.join(config.METRICS_DIR, ARCHIVE_FILE_NAME)
+        folded = []
+        if os.path.exists(archive_path):
+            with open(archive_path) as f:
+                folded = merged.merge_json(f.read()).get('folded', [])
+        _archive_dead_workers(merged, folded)
+
+        for name in sorted(os.listdir(config.METRICS_DIR)):
+            if name.startswith('worker-') and name.endswith('.json') and name not in folded:
+                try:
+                    with open(os.path.join(config.METRICS_DIR, name)) as f:
+                        merged.merge_json(f.read())
+                except (OSError, ValueError):
+                    # Written concurrently by another worker; it will be complete next time
+                    continue
+    return merged
+
+
+def render():
+    """Returns the metrics of all workers and the current gauges in the
+    Prometheus text format.
+    """
+    flush()
+    merged = _merge_files()
+    gauges = _get_gauges()
+
+    lines = []
+    for name, (metric_type, description) in HELP.items():
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        if metric_type == 'histogram':
+            for (series, labels), h in sorted(merged.histograms.items()):
+                if series == name:
+                    lines.extend(_render_histogram(name, labels, h))
+        elif metric_type == 'counter':
+            for (series, labels), value in sorted(merged.counters.items()):
+                if series == name:
+                    lines.append('%s%s %s' % (name, _render_labels(labels), _render_value(value)))
+        else:
+            for labels, value in gauges.get(name, []):
+                lines.append('%s%s %s' % (name, _render_labels(labels), _render_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _get_gauges():
+    gauges = {}
+    now = datetime.datetime.now()
+    for queue, stats in datastore.get_queue_stats().items():
+        labels = (('queue', queue),)
+        gauges.setdefault('coverdrop_queue_messages', []).append((labels, stats.messages))
+        gauges.setdefault('coverdrop_queue_leased_messages', []).append((labels, stats.leased))
+        age = (now - stats.oldest_creation_datetime).total_seconds() if stats.oldest_creation_datetime else 0
+        gauges.setdefault('coverdrop_queue_oldest_message_age_seconds', []).append((labels, age))
+    for board, count in datastore.count_active_messages(config.MESSAGE_WINDOW_HOURS).items():
+        gauges.setdefault('coverdrop_published_messages', []).append(((('board', board),), count))
+    return gauges
+
+
+def _render_histogram(name, labels, h):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(h['buckets'] + ['+Inf'], h['counts']):
+        cumulative += count
+        bucket_labels = labels + (('le', bound if bound == '+Inf' else _render_value(bound)),)
+        lines.append('%s_bucket%s %d' % (name, _render_labels(bucket_labels), cumulative))
+    lines.append('%s_sum%s %s' % (name, _render_labels(labels), _render_value(h['sum'])))
+    lines.append('%s_count%s %d' % (name, _render_labels(labels), cumulative))
+    return lines
+
+
+def _render_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value)) for key, value in labels)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _render_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
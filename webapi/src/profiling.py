@@ -0,0 +1,111 @@
+"""Opt-in profiling of sampled requests with cProfile (see
+`COVERDROP_PROFILE`).
+
+The request hooks are only registered if profiling is enabled, so disabled
+profiling costs nothing per request. Each profiled request is written to its
+own file in `COVERDROP_PROFILE_DIR`, which can be inspected with `pstats` or
+tools such as snakeviz; the oldest files are deleted once there are more than
+`COVERDROP_PROFILE_MAX_FILES`. `summarize` aggregates the files per route.
+"""
+
+from flask import g, request
+
+import config
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import time
+
+SUFFIX = '.prof'
+
+# Index of the sort key in the entries of `pstats.Stats.stats`
+SORT_KEYS = {'total': 2, 'cumulative': 3}
+
+
+def register(app):
+    """Registers the hooks that profile the sampled requests of `app`."""
+    route_pattern = re.compile(config.PROFILE_ROUTES) if config.PROFILE_ROUTES else None
+    os.makedirs(config.PROFILE_DIR, exist_ok=True)
+
+    @app.before_request
+    def start_profiler():
+        route = request.url_rule.rule if request.url_rule is not None else None
+        if route is None or (route_pattern is not None and not route_pattern.search(route)):
+            return
+        if random.random() >= config.PROFILE_SAMPLE_RATE:
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Newer Pythons only allow one active profiler per process
+            return
+        g.profiler = profiler
+
+    @app.teardown_request
+    def stop_profiler(exception):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+        profiler.disable()
+        _write(profiler, request.url_rule.rule)
+
+
+def summarize(route=None, sort='total', limit=20):
+    """Returns the hottest functions per route (or only of the given `route`)
+    by their own (`total`) or `cumulative` time. Times are averaged over the
+    profiled requests of the route.
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError("`sort` must be one of %s" % ', '.join(SORT_KEYS))
+    sort_index = SORT_KEYS[sort]
+    paths_by_route = {}
+    for name in os.listdir(config.PROFILE_DIR):
+        if name.endswith(SUFFIX):
+            paths_by_route.setdefault(_route_of(name), []).append(os.path.join(config.PROFILE_DIR, name))
+
+    result = {}
+    for slug, paths in sorted(paths_by_route.items()):
+        if route is not None and slug != _slug(route):
+            continue
+        stats = pstats.Stats(*paths, stream=io.StringIO())
+        functions = sorted(stats.stats.items(), key=lambda item: item[1][sort_index], reverse=True)[:limit]
+        result[slug] = {
+            'profiles': len(paths),
+            'functions': [{
+                'function': '%s:%d(%s)' % function,
+                'calls': calls,
+                'total_ms': 1000 * total_time / len(paths),
+                'cumulative_ms': 1000 * cumulative_time / len(paths),
+            } for function, (_, calls, total_time, cumulative_time, _) in functions],
+        }
+    return result
+
+
+def _write(profiler, route):
+    path = os.path.join(config.PROFILE_DIR, '%s.%d.%d%s' % (_slug(route), time.time_ns(), os.getpid(), SUFFIX))
+    profiler.dump_stats(path)
+    _rotate()
+
+
+def _rotate():
+    names = sorted(
+        (name for name in os.listdir(config.PROFILE_DIR) if name.endswith(SUFFIX)),
+        key=lambda name: int(name.split('.')[-3]))
+    for name in names[:max(0, len(names) - config.PROFILE_MAX_FILES)]:
+        try:
+            os.unlink(os.path.join(config.PROFILE_DIR, name))
+        except FileNotFoundError:
+            # Rotated concurrently by another worker
+            pass
+
+
+def _slug(route):
+    return re.sub(r'[^A-Za-z0-9_-]+', '_', route).strip('_') or 'index'
+
+
+def _route_of(name):
+    return name.split('.')[0]
@@ -0,0 +1,75 @@
+"""In-process registry of the public keys served by `/pubkeys`.
+
+Each process builds the key bundle (i.e. the serialized response body and a
+strong ETag) once and only rebuilds it when the reporters changed (see
+`datastore.GENERATION_REPORTERS`) or when one of the SGX key files has been
+replaced or modified. Clients revalidate with `If-None-Match` and receive a
+`304 Not Modified` as long as the keys stay the same.
+"""
+
+import datastore
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+
+class KeyBundle:
+
+    def __init__(self, version, sgx_key, sgx_sign_key, reporter_keys):
+        self.version = version
+        self.keys = {
+            'sgx_key': sgx_key,
+            'sgx_sign_key': sgx_sign_key,
+            'reporter_keys': {str(id): key for id, key in reporter_keys.items()},
+        }
+
+        self.body = json.dumps(self.keys, sort_keys=True, separators=(',', ':')).encode()
+        self.gzip_body = gzip.compress(self.body, compresslevel=6, mtime=0)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+
+
+class KeyRegistry:
+
+    def __init__(self, key_paths):
+        self.key_paths = key_paths
+        self._bundle = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        version = self._get_version()
+        bundle = self._bundle
+        if bundle is not None and bundle.version == version:
+            return bundle
+
+        with self._lock:
+            bundle = self._bundle
+            if bundle is None or bundle.version != version:
+                # As with the snapshots the version is determined before the
+                # keys are read so that a concurrent change triggers a rebuild
+                reporters = datastore.get_all_reporters()
+                bundle = KeyBundle(
+                    version,
+                    datastore.get_sgx_key(),
+                    datastore.get_sgx_sign_key(),
+                    {r.id: r.pub_key for r in reporters})
+                self._bundle = bundle
+            return bundle
+
+    def _get_version(self):
+        return (datastore.get_generation(datastore.GENERATION_REPORTERS),
+                tuple(_get_file_version(path) for path in self.key_paths))
+
+
+def _get_file_version(path):
+    # A key file is usually replaced rather than modified in place; the inode
+    # detects the former and mtime and size the latter
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+registry = KeyRegistry([datastore.SGX_KEY_PATH, datastore.SGX_SIGN_KEY_PATH])
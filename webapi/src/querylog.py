@@ -0,0 +1,149 @@
+"""Opt-in instrumentation of all SQL statements (see `COVERDROP_QUERY_LOG`).
+
+Every statement executed via the engine is timed and aggregated per
+statement text together with its plan (i.e. the output of `EXPLAIN QUERY
+PLAN` on SQLite). Statements that take longer than
+`COVERDROP_QUERY_LOG_SLOW_MS` are logged with their parameters redacted. The
+aggregates of a process are available via `GET /debug/queries` and
+`cli.py query_stats`.
+"""
+
+from sqlalchemy import event
+
+import collections
+import config
+import re
+import threading
+import time
+
+# Plans are only captured for statements that SQLite can explain
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|UPDATE|DELETE|INSERT)\b', re.IGNORECASE)
+
+_stats = {}
+_lock = threading.Lock()
+
+
+class StatementStats:
+
+    def __init__(self, statement):
+        self.statement = statement
+        self.count = 0
+        self.slow = 0
+        self.total_s = 0
+        self.max_s = 0
+        self.plan = None
+        # Only the most recent durations are kept for the percentiles
+        self.samples = collections.deque(maxlen=config.QUERY_LOG_SAMPLES)
+
+    def to_dict(self):
+        samples = sorted(self.samples)
+        return {
+            'statement': self.statement,
+            'count': self.count,
+            'slow': self.slow,
+            'total_ms': 1000 * self.total_s,
+            'p50_ms': 1000 * _percentile(samples, 0.5),
+            'p99_ms': 1000 * _percentile(samples, 0.99),
+            'max_ms': 1000 * self.max_s,
+            'plan': self.plan,
+        }
+
+
+def instrument(engine):
+    """Registers the timing hooks with the `engine`."""
+
+    # Statements on a connection never overlap, so it holds at most one start
+    # time. It is overwritten by the next statement if one fails, which is
+    # not timed.
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info['querylog_start'] = time.perf_counter()
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        if exception_context.connection is not None:
+            exception_context.connection.info.pop('querylog_start', None)
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop('querylog_start', None)
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+        key = ' '.join(statement.split())
+
+        with _lock:
+            stats = _stats.get(key)
+            if stats is None:
+                stats = _stats[key] = StatementStats(key)
+            stats.count += 1
+            stats.total_s += duration
+            stats.max_s = max(stats.max_s, duration)
+            stats.samples.append(duration)
+            is_slow = 1000 * duration >= config.QUERY_LOG_SLOW_MS
+            if is_slow:
+                stats.slow += 1
+
+        # The plan is captured once per statement and again whenever it is
+        # slow, as the plan may change with the data
+        if is_slow or stats.plan is None:
+            plan = _explain(conn, statement, parameters, executemany)
+            if plan is not None:
+                stats.plan = plan
+
+        if is_slow:
+            print("SLOW QUERY: %.1f ms: %s [%s]%s" % (
+                1000 * duration, key, _redact(parameters, executemany),
+                ''.join('\n    ' + line for line in stats.plan or [])))
+
+
+def get_stats():
+    """Returns the aggregates of all statements ordered by total time."""
+    with _lock:
+        result = [stats.to_dict() for stats in _stats.values()]
+    return sorted(result, key=lambda s: s['total_ms'], reverse=True)
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def format_stats(stats):
+    lines = []
+    for s in stats:
+        lines.append("%6d x  p50 %8.2f ms  p99 %8.2f ms  max %8.2f ms  total %9.1f ms  %s" % (
+            s['count'], s['p50_ms'], s['p99_ms'], s['max_ms'], s['total_ms'], s['statement']))
+        for line in s['plan'] or []:
+            lines.append("    " + line)
+    return "\n".join(lines)
+
+
+def _explain(conn, statement, parameters, executemany):
+    if conn.dialect.name != 'sqlite' or not _EXPLAINABLE.match(statement):
+        return None
+    if executemany:
+        parameters = parameters[0] if parameters else ()
+
+    # Uses the DBAPI connection directly so that the EXPLAIN itself is not
+    # instrumented
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        return [row[-1] for row in cursor.fetchall()]
+    except Exception as e:
+        return ['EXPLAIN failed: %s' % e]
+    finally:
+        cursor.close()
+
+
+def _redact(parameters, executemany):
+    if executemany:
+        return "%d parameter sets redacted" % len(parameters)
+    return "%d parameters redacted" % len(parameters or ())
+
+
+def _percentile(sorted_samples, p):
+    if not sorted_samples:
+        return 0
+    return sorted_samples[min(len(sorted_samples) - 1, int(p * len(sorted_samples)))]
@@ -0,0 +1,149 @@
+"""Cache of serialized responses for the read-mostly news routes (stories and
+reporters).
+
+Entries hold the JSON body together with its gzip- and, if the `brotli`
+package is installed, brotli-compressed variants and a strong ETag. The cache
+is bounded by the total size of all bodies and evicts the least recently used
+entries. It is keyed by the route's path and arguments and is emptied as soon
+as one of the generations it depends on changes. As the generations are
+bumped within the transactions that modify the stories and reporters, this
+invalidates the caches of all workers no matter if the change was made via
+the API or `cli.py`.
+"""
+
+from functools import wraps
+
+from flask import request
+
+import collections
+import config
+import datastore
+import gzip
+import hashlib
+import snapshots
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# News changes at any time, so clients and proxies have to revalidate with the
+# ETag on every request
+CACHE_CONTROL = 'no-cache'
+
+# Rough per-entry overhead of the key and the entry object
+ENTRY_OVERHEAD_BYTES = 512
+
+
+class CachedResponse:
+
+    def __init__(self, body):
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=6, mtime=0)
+        self.brotli_body = brotli.compress(body, quality=5) if brotli is not None else None
+        self.etag = hashlib.sha256(body).hexdigest()[:32]
+        self.size = ENTRY_OVERHEAD_BYTES + len(self.body) + len(self.gzip_body) + \
+            (len(self.brotli_body) if self.brotli_body is not None else 0)
+
+
+class ResponseCache:
+
+    def __init__(self, generation_names, max_bytes):
+        self.generation_names = generation_names
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """Returns the `CachedResponse` for `key`, calling `build` to create
+        its body if it is not cached. `build` may return None for responses
+        that must not be cached.
+        """
+        version = datastore.get_generations(self.generation_names)
+        with self._lock:
+            if version != self._version:
+                if self._version is not None:
+                    self.invalidations += 1
+                self._clear()
+                self._version = version
+
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # Built outside the lock; concurrent misses for the same key may build
+        # the entry twice, which is harmless
+        body = build()
+        if body is None:
+            return None
+        entry = CachedResponse(body)
+
+        with self._lock:
+            if version == self._version and entry.size <= self.max_bytes:
+                if key in self._entries:
+                    self._bytes -= self._entries.pop(key).size
+                self._entries[key] = entry
+                self._bytes += entry.size
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= evicted.size
+                    self.evictions += 1
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+
+news = ResponseCache(
+    [datastore.GENERATION_NEWS, datastore.GENERATION_REPORTERS],
+    config.RESPONSE_CACHE_MAX_BYTES)
+
+
+def cached(cache):
+    """Decorator for routes that returns the response of the decorated view
+    from `cache`. Only successful responses are cached.
+    """
+    def decorator(func):
+        @wraps(func)
+        def decorated(*args, **kwargs):
+            if cache.max_bytes <= 0:
+                return func(*args, **kwargs)
+
+            response = None
+
+            def build():
+                nonlocal response
+                response = func(*args, **kwargs)
+                return response.get_data() if response.status_code == 200 else None
+
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            entry = cache.get(key, build)
+            if entry is None:
+                return response
+            return snapshots.make_response(entry, cache_control=CACHE_CONTROL)
+
+        return decorated
+    return decorator
@@ -0,0 +1,56 @@
+"""Pruning of expired dead-drop and reporter inbox messages, either on demand
+(see `cli.py prune_messages`) or periodically from a background thread.
+"""
+
+import config
+import datastore
+import os
+import threading
+import time
+
+_thread_pid = None
+_thread_lock = threading.Lock()
+
+
+def prune(retention_hours=None, chunk_size=None):
+    """Deletes expired messages and returns the number of deleted rows per
+    table and the time it took in seconds. Raises a ValueError if
+    `retention_hours` is shorter than the window in which messages are served.
+    """
+    if retention_hours is None:
+        retention_hours = config.RETENTION_HOURS
+    if retention_hours < config.MESSAGE_WINDOW_HOURS:
+        raise ValueError("the retention must be at least COVERDROP_MESSAGE_WINDOW_HOURS (%d)" %
+                         config.MESSAGE_WINDOW_HOURS)
+
+    start = time.perf_counter()
+    deleted = datastore.prune_expired_messages(
+        retention_hours,
+        chunk_size if chunk_size is not None else config.RETENTION_CHUNK_SIZE)
+    return deleted, time.perf_counter() - start
+
+
+def format_result(deleted, duration):
+    counts = ", ".join("%d from %s" % (n, table) for table, n in deleted.items())
+    return "reclaimed %s in %.1f ms" % (counts, 1000 * duration)
+
+
+def start_background_pruning(interval_s):
+    """Starts a daemon thread that prunes every `interval_s` seconds. Calling
+    this repeatedly within the same process has no effect.
+    """
+    global _thread_pid
+    with _thread_lock:
+        if _thread_pid == os.getpid():
+            return
+        _thread_pid = os.getpid()
+
+    def run():
+        while True:
+            try:
+                print("RETENTION: " + format_result(*prune()))
+            except Exception as e:
+                print("RETENTION FAILED: %s" % e)
+            time.sleep(interval_s)
+
+    threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,193 @@
+"""Append-only segment files as an alternative storage engine for the dead
+drop (see `COVERDROP_DEAD_DROP_STORE`).
+
+Published packets are write-once, of fixed size, and expire in the order in
+which they were written. Hence, they are appended to one segment file per
+hour that contains nothing but the concatenated records. Reads use `mmap` and
+expiry unlinks whole segments. A segment is served for the configured window
+after the end of its hour, i.e. up to one hour longer than a single row in
+the SQL table.
+
+The id of a record encodes its segment and position, so ids increase
+monotonically and can be used as sync cursors:
+
+    id = hour << 32 | (index + 1)
+"""
+
+import collections
+import datetime
+import fcntl
+import mmap
+import os
+import time
+
+SUFFIX = '.seg'
+SECONDS_PER_HOUR = 3600
+
+# Appends that started just before the end of an hour may still be in flight
+SEAL_GRACE_SECONDS = 60
+
+# Same shape as the rows returned for the SQL table
+Row = collections.namedtuple('Row', ['id', 'message', 'creation_datetime'])
+
+Segment = collections.namedtuple('Segment', ['hour', 'path'])
+
+
+class SegmentStore:
+
+    def __init__(self, directory, record_size):
+        self.directory = os.path.abspath(directory)
+        self.record_size = record_size
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, packets, now=None):
+        """Appends all `packets` to the segment of the current hour."""
+        for packet in packets:
+            if len(packet) != self.record_size:
+                raise ValueError("expected %dB packet but got %dB" % (self.record_size, len(packet)))
+        if not packets:
+            return
+
+        hour = _hour_of(now)
+        fd = os.open(self._path(hour), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # Readers take a shared lock so that they never see a partial batch
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # A crash during an earlier append may have left a partial record,
+            # which would misalign all records after it
+            size = os.fstat(fd).st_size
+            size -= size % self.record_size
+            os.ftruncate(fd, size)
+
+            data = b''.join(packets)
+            written = 0
+            try:
+                while written < len(data):
+                    written += os.write(fd, data[written:])
+                os.fsync(fd)
+            except BaseException:
+                # Drops the partial batch
+                os.ftruncate(fd, size)
+                raise
+        finally:
+            os.close(fd)
+
+    def segments(self, window_hours, now=None):
+        """Returns the segments that are still active within the window ordered
+        from oldest to newest.
+        """
+        first_hour = _hour_of(now) - window_hours
+        result = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                hour = int(name[:-len(SUFFIX)])
+                if hour >= first_hour:
+                    result.append(Segment(hour, os.path.join(self.directory, name)))
+        return sorted(result)
+
+    def get_segment(self, name, window_hours, now=None):
+        """Returns the active segment with the file `name` or None."""
+        for segment in self.segments(window_hours, now):
+            if os.path.basename(segment.path) == name:
+                return segment
+        return None
+
+    def read(self, segment):
+        """Returns the complete records of the `segment` as bytes."""
+        try:
+            fd = os.open(segment.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return b''
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            size = os.fstat(fd).st_size
+            size -= size % self.record_size
+            if size == 0:
+                return b''
+            with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as m:
+                return m[:size]
+        finally:
+            os.close(fd)
+
+    def rows(self, window_hours, now=None):
+        """Returns the `Row`s of all records of the active segments."""
+        return list(self.iter_rows(window_hours, now=now))
+
+    def iter_rows(self, window_hours, since=None, chunk_records=1000, now=None):
+        """Yields the `Row`s of the records of the active segments with an id
+        greater than `since`, reading at most `chunk_records` at a time.
+        """
+        for segment in self.segments(window_hours, now):
+            base_id = segment.hour << 32
+            first_index = 0
+            if since is not None and since > base_id:
+                first_index = since - base_id
+            creation_datetime = datetime.datetime.fromtimestamp((segment.hour + 1) * SECONDS_PER_HOUR)
+            index = first_index
+            for data in self._read_chunks(segment, first_index * self.record_size,
+                                          chunk_records * self.record_size):
+                for offset in range(0, len(data), self.record_size):
+                    index += 1
+                    yield Row(base_id + index, data[offset:offset + self.record_size], creation_datetime)
+
+    def last_id(self, window_hours, now=None):
+        """Returns the id of the newest record of the active segments or None."""
+        for segment in reversed(self.segments(window_hours, now)):
+            records = os.path.getsize(segment.path) // self.record_size
+            if records > 0:
+                return (segment.hour << 32) + records
+        return None
+
+    def _read_chunks(self, segment, start, chunk_size):
+        try:
+            fd = os.open(segment.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            # Only the size is read under the lock: everything before it has
+            # been completely written and never changes, so the records can
+            # be read without blocking appends
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            size = os.fstat(fd).st_size
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            size -= size % self.record_size
+            for offset in range(start, size, chunk_size):
+                yield os.pread(fd, min(chunk_size, size - offset), offset)
+        finally:
+            os.close(fd)
+
+    def count(self, window_hours, now=None):
+        """Returns the number of complete records of the active segments."""
+        return sum(os.path.getsize(segment.path) // self.record_size
+                   for segment in self.segments(window_hours, now))
+
+    def prune(self, retention_hours, now=None):
+        """Unlinks all segments that ended more than `retention_hours` ago and
+        returns the number of reclaimed records.
+        """
+        first_hour = _hour_of(now) - retention_hours
+        reclaimed = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX) and int(name[:-len(SUFFIX)]) < first_hour:
+                path = os.path.join(self.directory, name)
+                reclaimed += os.path.getsize(path) // self.record_size
+                os.unlink(path)
+        return reclaimed
+
+    def delete_all(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(SUFFIX):
+                os.unlink(os.path.join(self.directory, name))
+
+    def _path(self, hour):
+        return os.path.join(self.directory, '%010d%s' % (hour, SUFFIX))
+
+
+def is_sealed(segment, now=None):
+    """Whether no more records will be appended to the `segment`."""
+    now = now if now is not None else time.time()
+    return segment.hour < _hour_of(now - SEAL_GRACE_SECONDS)
+
+
+def _hour_of(now):
+    return int((now if now is not None else time.time()) // SECONDS_PER_HOUR)
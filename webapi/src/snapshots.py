@@ -0,0 +1,151 @@
+"""Immutable snapshots of the dead drop and the reporter inbox.
+
+A snapshot holds the serialized and gzip-compressed JSON response body and
+the body in the binary wire format together with a strong ETag. Each process keeps the latest snapshot per board in
+memory and only rebuilds it when the board's generation in the database
+changed (i.e. the SGX published messages or messages were pruned) or when its
+oldest message left the time window.
+"""
+
+from flask import Response, request
+
+import config
+import bisect
+import datastore
+import datetime
+import gzip
+import hashlib
+import json
+import threading
+import wire
+
+
+class Snapshot:
+
+    def __init__(self, generation, rows, window_hours, packet_size):
+        self.generation = generation
+        self.packet_size = packet_size
+        self.ids = [row.id for row in rows]
+        self.messages = [row.message for row in rows]
+
+        # The snapshot content changes once the oldest message expires
+        if rows:
+            oldest = min(row.creation_datetime for row in rows)
+            self.expires_at = oldest + datetime.timedelta(hours=window_hours)
+        else:
+            self.expires_at = None
+
+        self.body = json.dumps([m.hex() for m in self.messages], separators=(',', ':')).encode()
+        # Without a fixed mtime, workers would send different bytes under the same strong ETag
+        self.gzip_body = gzip.compress(self.body, compresslevel=6, mtime=0)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        self._binary_body = None
+
+    @property
+    def binary_body(self):
+        # Only built on demand as most clients still use JSON
+        if self._binary_body is None:
+            self._binary_body = wire.encode(self.messages, self.packet_size)
+        return self._binary_body
+
+    def is_expired(self, now):
+        return self.expires_at is not None and now >= self.expires_at
+
+
+class SnapshotCache:
+
+    def __init__(self, generation_name, get_rows, packet_size):
+        self.generation_name = generation_name
+        self.get_rows = get_rows
+        self.packet_size = packet_size
+        self._snapshot = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        generation = datastore.get_generation(self.generation_name)
+        snapshot = self._snapshot
+        if self._is_current(snapshot, generation):
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if not self._is_current(snapshot, generation):
+                # The generation is read before the rows so that a concurrent
+                # write results in a rebuild on the next request
+                rows = self.get_rows(config.MESSAGE_WINDOW_HOURS)
+                snapshot = Snapshot(generation, rows, config.MESSAGE_WINDOW_HOURS, self.packet_size)
+                self._snapshot = snapshot
+            return snapshot
+
+    def _is_current(self, snapshot, generation):
+        return snapshot is not None \
+            and snapshot.generation == generation \
+            and not snapshot.is_expired(datetime.datetime.now())
+
+
+dead_drop = SnapshotCache(
+    datastore.GENERATION_DEAD_DROP,
+    datastore.get_active_dead_drop_rows,
+    wire.DEAD_DROP_MESSAGE_SIZE)
+
+reporter_inbox = SnapshotCache(
+    datastore.GENERATION_REPORTER_INBOX,
+    datastore.get_active_reporter_inbox_rows,
+    wire.REPORTER_INBOX_MESSAGE_SIZE)
+
+
+def make_response(snapshot, binary=False, cache_control=None):
+    """Returns the snapshot (or any other object with a `body`, `gzip_body`,
+    and `etag`) as a response to the current request. Answers with `304 Not
+    Modified` if the client already has the same version and with the
+    compressed body if the client accepts gzip (or brotli if the object also
+    has a `brotli_body`). The binary body is never compressed as the packets
+    are indistinguishable from random data. `cache_control` defaults to the
+    `max-age` of the snapshots.
+    """
+    brotli_body = getattr(snapshot, 'brotli_body', None)
+    use_brotli = not binary and brotli_body is not None and 'br' in request.accept_encodings
+    use_gzip = not binary and not use_brotli and 'gzip' in request.accept_encodings
+
+    # All representations need distinct strong ETags
+    if binary:
+        etag = snapshot.etag + '-bin'
+    elif use_brotli:
+        etag = snapshot.etag + '-br'
+    elif use_gzip:
+        etag = snapshot.etag + '-gzip'
+    else:
+        etag = snapshot.etag
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif binary:
+        response = Response(snapshot.binary_body, mimetype=wire.MEDIA_TYPE)
+    elif use_brotli:
+        response = Response(brotli_body, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'br'
+    elif use_gzip:
+        response = Response(snapshot.gzip_body, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(snapshot.body, mimetype='application/json')
+
+    response.set_etag(etag)
+    if cache_control is None:
+        cache_control = 'public, max-age=%d' % config.SNAPSHOT_MAX_AGE_S
+    response.headers['Cache-Control'] = cache_control
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def select_since(ids, messages, since):
+    """Returns the messages with an id greater than the cursor `since`, the
+    new cursor, and whether the client has to resync. `ids` must be sorted.
+    A cursor ahead of the newest id (e.g. after the messages have been reset)
+    requires a resync and is answered with all messages.
+    """
+    if not ids:
+        return [], since, False
+    if since > ids[-1]:
+        return messages, ids[-1], True
+    return messages[bisect.bisect_right(ids, since):], ids[-1], False
@@ -0,0 +1,74 @@
+"""Compact binary wire format for the fixed-size message packets.
+
+Clients opt in via `Content-Type: application/octet-stream` when posting and
+`Accept: application/octet-stream` when fetching; JSON with hex-encoded
+packets remains the default. A binary body consists of a 9-byte header
+followed by `count` records of `record_size` bytes each:
+
+    magic (2 bytes, "CD") | version (1 byte) | record_size (uint16) | count (uint32)
+
+All integers are big-endian. Records of the SGX queue endpoints are prefixed
+with the message id as an uint64.
+"""
+
+import struct
+
+MEDIA_TYPE = 'application/octet-stream'
+
+MAGIC = b'CD'
+VERSION = 1
+HEADER = struct.Struct('!2sBHI')
+ID = struct.Struct('!Q')
+
+# Packet sizes as produced by the user app, the reporter app, and the SGX
+USER_MESSAGE_SIZE = 385
+REPORTER_MESSAGE_SIZE = 345
+REPORTER_INBOX_MESSAGE_SIZE = 400
+DEAD_DROP_MESSAGE_SIZE = 360
+
+
+class WireFormatError(Exception):
+    pass
+
+
+def encode(packets, packet_size):
+    """Returns the binary body for the `packets`, which must all be of
+    `packet_size` bytes.
+    """
+    for packet in packets:
+        if len(packet) != packet_size:
+            raise WireFormatError("expected %dB packet but got %dB" % (packet_size, len(packet)))
+    return HEADER.pack(MAGIC, VERSION, packet_size, len(packets)) + b''.join(packets)
+
+
+def encode_with_ids(messages, packet_size):
+    """Like `encode` for `messages` with `id` and `message` attributes."""
+    for m in messages:
+        if len(m.message) != packet_size:
+            raise WireFormatError("expected %dB packet but got %dB" % (packet_size, len(m.message)))
+    record_size = ID.size + packet_size
+    return HEADER.pack(MAGIC, VERSION, record_size, len(messages)) + \
+        b''.join(ID.pack(m.id) + m.message for m in messages)
+
+
+def decode(data, packet_size):
+    """Returns the list of packets of the binary body `data`. Raises a
+    `WireFormatError` if the header is invalid or the records do not have
+    the expected `packet_size`.
+    """
+    if len(data) < HEADER.size:
+        raise WireFormatError("body is shorter than the header")
+
+    magic, version, record_size, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise WireFormatError("unsupported format or version")
+    if record_size != packet_size:
+        raise WireFormatError("expected %dB records but got %dB" % (packet_size, record_size))
+    if len(data) != HEADER.size + count * record_size:
+        raise WireFormatError("body length does not match the header")
+
+    view = memoryview(data)
+    return [
+        bytes(view[offset:offset + record_size])
+        for offset in range(HEADER.size, len(data), record_size)
+    ]
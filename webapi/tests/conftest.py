@@ -0,0 +1,13 @@
+"""Sets up the configuration for the tests. It is read when the modules of
+`src` are imported, so this has to run first.
+"""
+
+import os
+import sys
+import tempfile
+
+_db_dir = tempfile.TemporaryDirectory()
+os.environ['COVERDROP_DB_URL'] = 'sqlite:///' + os.path.join(_db_dir.name, 'coverdrop.sqlite')
+os.environ['COVERDROP_SNAPSHOTS'] = '0'
+os.environ['COVERDROP_METRICS'] = '0'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
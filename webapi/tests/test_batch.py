@@ -0,0 +1,64 @@
+"""Tests of posting several messages at once."""
+
+import config
+import datastore
+import flaskapp
+import os
+import pytest
+import wire
+
+NEWS_APP = {'Authorization': 'Token news_app_token'}
+SGX = {'Authorization': 'Token sgx_token'}
+
+
+@pytest.fixture
+def client():
+    datastore.init()
+    datastore.delete_all_messages()
+    return flaskapp.app.test_client()
+
+
+def _queued_messages(client):
+    return [bytes.fromhex(m['message']) for m in client.get('/user_messages', headers=SGX).get_json()]
+
+
+def test_batch_reports_the_status_of_each_packet(client):
+    valid = [os.urandom(wire.USER_MESSAGE_SIZE) for _ in range(2)]
+    messages = [valid[0].hex(), 'not hex', os.urandom(wire.USER_MESSAGE_SIZE - 1).hex(), 42, valid[1].hex()]
+    response = client.post('/user_message/batch', json={'messages': messages}, headers=NEWS_APP)
+
+    assert response.status_code == 200
+    assert response.get_json() == {'statuses': ['accepted', 'invalid', 'invalid', 'invalid', 'accepted']}
+    assert _queued_messages(client) == valid
+
+
+def test_binary_batch(client):
+    packets = [os.urandom(wire.USER_MESSAGE_SIZE) for _ in range(3)]
+    response = client.post('/user_message/batch', data=wire.encode(packets, wire.USER_MESSAGE_SIZE),
+                           content_type=wire.MEDIA_TYPE, headers=NEWS_APP)
+
+    assert response.get_json() == {'statuses': ['accepted'] * 3}
+    assert _queued_messages(client) == packets
+
+
+def test_binary_batch_with_wrong_record_size_is_rejected(client):
+    packets = [os.urandom(wire.REPORTER_MESSAGE_SIZE)]
+    response = client.post('/user_message/batch', data=wire.encode(packets, wire.REPORTER_MESSAGE_SIZE),
+                           content_type=wire.MEDIA_TYPE, headers=NEWS_APP)
+
+    assert response.status_code == 400
+    assert _queued_messages(client) == []
+
+
+@pytest.mark.parametrize('body', [None, [], {'messages': 'abc'}])
+def test_malformed_batch_is_rejected(client, body):
+    response = client.post('/user_message/batch', json=body, headers=NEWS_APP)
+    assert response.status_code == 400
+
+
+def test_too_large_batch_is_rejected(client):
+    messages = [os.urandom(wire.USER_MESSAGE_SIZE).hex()] * (config.INGEST_MAX_BATCH_PACKETS + 1)
+    response = client.post('/user_message/batch', json={'messages': messages}, headers=NEWS_APP)
+
+    assert response.status_code == 413
+    assert _queued_messages(client) == []
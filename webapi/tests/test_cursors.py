@@ -0,0 +1,89 @@
+"""Tests of the sync cursors of `/deaddrop` and `/reporter_inbox`."""
+
+import config
+import datastore
+import flaskapp
+import os
+import pytest
+import snapshots
+import wire
+
+NEWS_APP = {'Authorization': 'Token news_app_token'}
+BINARY = dict(NEWS_APP, Accept=wire.MEDIA_TYPE)
+
+
+def test_select_since():
+    ids, messages = [3, 5, 8], [b'a', b'b', b'c']
+    assert snapshots.select_since(ids, messages, 0) == (messages, 8, False)
+    assert snapshots.select_since(ids, messages, 3) == ([b'b', b'c'], 8, False)
+    assert snapshots.select_since(ids, messages, 4) == ([b'b', b'c'], 8, False)
+    assert snapshots.select_since(ids, messages, 8) == ([], 8, False)
+    # A cursor ahead of the newest id, e.g. after the messages have been reset
+    assert snapshots.select_since(ids, messages, 9) == (messages, 8, True)
+    assert snapshots.select_since([], [], 9) == ([], 9, False)
+
+
+@pytest.fixture(params=[True, False], ids=['snapshots', 'streaming'])
+def client(request, monkeypatch):
+    monkeypatch.setattr(config, 'SNAPSHOTS', request.param)
+    datastore.init()
+    datastore.delete_all_messages()
+    return flaskapp.app.test_client()
+
+
+def _publish(count):
+    packets = [os.urandom(wire.DEAD_DROP_MESSAGE_SIZE) for _ in range(count)]
+    datastore.add_dead_drop_messages(packets)
+    ids = [row.id for row in datastore.get_active_dead_drop_rows(config.MESSAGE_WINDOW_HOURS)]
+    return ids, packets
+
+
+def _get(client, since):
+    response = client.get('/deaddrop?since=%d' % since, headers=NEWS_APP)
+    assert response.status_code == 200
+    body = response.get_json()
+    return [bytes.fromhex(m) for m in body['messages']], body['cursor'], body['resync']
+
+
+def test_without_cursor_returns_all_messages(client):
+    ids, packets = _publish(3)
+    response = client.get('/deaddrop', headers=NEWS_APP)
+    assert [bytes.fromhex(m) for m in response.get_json()] == packets
+
+    response = client.get('/deaddrop', headers=BINARY)
+    assert wire.decode(response.data, wire.DEAD_DROP_MESSAGE_SIZE) == packets
+    assert 'X-Cursor' not in response.headers
+    assert 'X-Resync' not in response.headers
+
+
+def test_cursor_returns_newer_messages(client):
+    ids, packets = _publish(3)
+    assert _get(client, ids[0]) == (packets[1:], ids[-1], False)
+    assert _get(client, ids[-1]) == ([], ids[-1], False)
+
+
+def test_cursor_before_the_oldest_message_returns_all_messages(client):
+    ids, packets = _publish(3)
+    assert _get(client, 0) == (packets, ids[-1], False)
+
+
+def test_cursor_ahead_of_the_newest_message_requires_resync(client):
+    ids, packets = _publish(3)
+    assert _get(client, ids[-1] + 100) == (packets, ids[-1], True)
+
+
+def test_binary_cursor_headers(client):
+    ids, packets = _publish(3)
+    response = client.get('/deaddrop?since=%d' % ids[0], headers=BINARY)
+    assert wire.decode(response.data, wire.DEAD_DROP_MESSAGE_SIZE) == packets[1:]
+    assert response.headers['X-Cursor'] == str(ids[-1])
+    assert response.headers['X-Resync'] == '0'
+
+    response = client.get('/deaddrop?since=%d' % (ids[-1] + 100), headers=BINARY)
+    assert wire.decode(response.data, wire.DEAD_DROP_MESSAGE_SIZE) == packets
+    assert response.headers['X-Cursor'] == str(ids[-1])
+    assert response.headers['X-Resync'] == '1'
+
+
+def test_empty_dead_drop_keeps_the_cursor(client):
+    assert _get(client, 5) == ([], 5, False)
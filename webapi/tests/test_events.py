@@ -0,0 +1,56 @@
+"""Tests of the events that the Server-Sent Events sidecar sends."""
+
+import collections
+import events
+import json
+import snapshots
+
+Snapshot = collections.namedtuple('Snapshot', ['ids', 'messages'])
+
+
+def _channel(ids):
+    channel = events.Channel('deaddrop', None, 'news_app')
+    channel.snapshot = Snapshot(ids, [b'%d' % id for id in ids])
+    return channel
+
+
+def _data(event):
+    return json.loads(event.decode().split('data: ')[1])
+
+
+def test_events_match_select_since():
+    channel = _channel([10, 11, 12])
+    for cursor in (0, 10, 11, 12, 13, 1000):
+        event, new_cursor = channel.get_event(cursor)
+        messages, expected_cursor, resync = snapshots.select_since(
+            channel.snapshot.ids, channel.snapshot.messages, cursor)
+        assert new_cursor == expected_cursor
+        if messages or resync:
+            assert _data(event) == {'messages': [m.hex() for m in messages], 'cursor': 12, 'resync': resync}
+        else:
+            assert event is None
+
+
+def test_cursors_that_select_the_same_messages_share_an_event():
+    channel = _channel([10, 11, 12])
+    resync = channel.get_event(13)
+    full = channel.get_event(0)
+    for cursor in range(13, 1000):
+        assert channel.get_event(cursor) is resync
+    for cursor in range(-1000, 10):
+        assert channel.get_event(cursor) is full
+    assert len(channel._events) == 2
+
+
+def test_cached_events_are_bounded():
+    ids = list(range(1, 10 * events.MAX_CACHED_EVENTS))
+    channel = _channel(ids)
+    for cursor in ids:
+        channel.get_event(cursor)
+    assert len(channel._events) == events.MAX_CACHED_EVENTS
+
+
+def test_empty_snapshot_keeps_the_cursor():
+    channel = _channel([])
+    assert channel.get_event(5) == (None, 5)
+    assert len(channel._events) == 0
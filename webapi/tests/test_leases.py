@@ -0,0 +1,117 @@
+"""Tests of the leases with which the SGX claims and acknowledges queued
+messages.
+"""
+
+import datastore
+import flaskapp
+import os
+import pytest
+import time
+import wire
+
+SGX = {'Authorization': 'Token sgx_token'}
+NEWS_APP = {'Authorization': 'Token news_app_token'}
+
+
+@pytest.fixture
+def client():
+    datastore.init()
+    datastore.delete_all_messages()
+    return flaskapp.app.test_client()
+
+
+def _post_user_messages(client, count):
+    packets = [os.urandom(wire.USER_MESSAGE_SIZE) for _ in range(count)]
+    for packet in packets:
+        response = client.post('/user_message', json={'message': packet.hex()}, headers=NEWS_APP)
+        assert response.status_code == 200
+    return packets
+
+
+def _claim(client, count, lease=60):
+    response = client.post('/user_messages/claim?count=%d&lease=%d' % (count, lease), headers=SGX)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def _ack(client, lease_id, ids):
+    response = client.post('/user_messages/ack', json={'lease_id': lease_id, 'ids': ids}, headers=SGX)
+    assert response.status_code == 200
+    return response.get_json()['deleted']
+
+
+def _queued_ids(client):
+    return [m['id'] for m in client.get('/user_messages', headers=SGX).get_json()]
+
+
+def test_claim_leases_the_oldest_messages(client):
+    packets = _post_user_messages(client, 3)
+    lease = _claim(client, 2)
+
+    assert [bytes.fromhex(m['message']) for m in lease['messages']] == packets[:2]
+    # Concurrent consumers only get the rest
+    assert [bytes.fromhex(m['message']) for m in _claim(client, 2)['messages']] == packets[2:]
+    assert _claim(client, 2)['messages'] == []
+
+
+def test_legacy_get_skips_leased_messages(client):
+    _post_user_messages(client, 3)
+    all_ids = _queued_ids(client)
+    lease = _claim(client, 2)
+
+    assert _queued_ids(client) == all_ids[2:]
+    assert [m['id'] for m in lease['messages']] == all_ids[:2]
+
+
+def test_ack_deletes_only_messages_of_the_lease(client):
+    _post_user_messages(client, 3)
+    lease = _claim(client, 2)
+    other = _claim(client, 1)
+    ids = [m['id'] for m in lease['messages']]
+
+    assert _ack(client, 'not-the-lease', ids) == 0
+    assert _ack(client, lease['lease_id'], ids + [m['id'] for m in other['messages']]) == 2
+    assert _ack(client, lease['lease_id'], ids) == 0
+    assert _ack(client, other['lease_id'], [m['id'] for m in other['messages']]) == 1
+
+
+def test_expired_lease_makes_messages_claimable_again(client):
+    _post_user_messages(client, 2)
+    lease = _claim(client, 2, lease=1)
+    assert _claim(client, 2)['messages'] == []
+
+    time.sleep(1.1)
+    again = _claim(client, 2)
+    assert [m['id'] for m in again['messages']] == [m['id'] for m in lease['messages']]
+
+    # The expired lease can no longer acknowledge them
+    assert _ack(client, lease['lease_id'], [m['id'] for m in lease['messages']]) == 0
+    assert _ack(client, again['lease_id'], [m['id'] for m in again['messages']]) == 2
+
+
+def test_release_returns_messages_to_the_queue(client):
+    _post_user_messages(client, 2)
+    lease = _claim(client, 2)
+
+    response = client.post('/user_messages/release', json={'lease_id': lease['lease_id']}, headers=SGX)
+    assert response.get_json() == {'released': 2}
+    assert len(_queued_ids(client)) == 2
+    assert _ack(client, lease['lease_id'], [m['id'] for m in lease['messages']]) == 0
+
+
+@pytest.mark.parametrize('body', [
+    None,
+    {'ids': [1]},
+    {'lease_id': 'x'},
+    {'lease_id': 'x', 'ids': ['1']},
+    {'lease_id': 1, 'ids': [1]},
+])
+def test_invalid_ack_is_rejected(client, body):
+    response = client.post('/user_messages/ack', json=body, headers=SGX)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('query', ['', 'count=0', 'count=1&lease=0', 'count=1&lease=100000'])
+def test_invalid_claim_is_rejected(client, query):
+    response = client.post('/user_messages/claim?' + query, headers=SGX)
+    assert response.status_code == 400
@@ -0,0 +1,47 @@
+"""Tests of the upgrade of databases that were created by earlier versions."""
+
+import datastore
+import datetime
+import os
+import wire
+
+from sqlalchemy import create_engine
+
+# The message tables as created by the first version, which stored the
+# packets as hex strings
+BASELINE_SCHEMA = [
+    'CREATE TABLE usermessages (id INTEGER NOT NULL, message VARCHAR, PRIMARY KEY (id))',
+    'CREATE TABLE deaddropmessages (id INTEGER NOT NULL, message VARCHAR, creation_datetime DATETIME, '
+    'PRIMARY KEY (id))',
+]
+
+
+def test_upgrade_converts_hex_messages_and_deletes_invalid_ones(tmp_path):
+    engine = create_engine('sqlite:///' + str(tmp_path / 'baseline.sqlite'))
+    for statement in BASELINE_SCHEMA:
+        engine.execute(statement)
+
+    user_packet = os.urandom(wire.USER_MESSAGE_SIZE)
+    dead_drop_packet = os.urandom(wire.DEAD_DROP_MESSAGE_SIZE)
+    now = datetime.datetime.now()
+    engine.execute('INSERT INTO usermessages (id, message) VALUES (?, ?)', [
+        (1, user_packet.hex()),
+        (2, 'not hex'),
+        (3, user_packet.hex()[:-1]),
+    ])
+    engine.execute('INSERT INTO deaddropmessages (id, message, creation_datetime) VALUES (?, ?, ?)', [
+        (1, dead_drop_packet.hex(), now),
+        (2, os.urandom(wire.USER_MESSAGE_SIZE).hex(), now),
+    ])
+
+    tables = [datastore.UserMessage.__table__, datastore.DeadDropMessage.__table__]
+    datastore._upgrade_schema(engine, tables)
+
+    assert engine.execute('SELECT id, message FROM usermessages').fetchall() == [(1, user_packet)]
+    rows = engine.execute('SELECT id, message FROM deaddropmessages').fetchall()
+    assert rows == [(1, dead_drop_packet)]
+    wire.encode([message for _, message in rows], wire.DEAD_DROP_MESSAGE_SIZE)
+
+    # Published ids are never reused, also not those of deleted rows
+    engine.execute('INSERT INTO deaddropmessages (message, creation_datetime) VALUES (?, ?)', dead_drop_packet, now)
+    assert engine.execute('SELECT max(id) FROM deaddropmessages').scalar() == 3
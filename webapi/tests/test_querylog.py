@@ -0,0 +1,24 @@
+"""Tests of the SQL statement instrumentation."""
+
+import pytest
+import querylog
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+
+
+def test_failed_statement_does_not_affect_the_next_one():
+    querylog.reset()
+    engine = create_engine('sqlite://')
+    querylog.instrument(engine)
+    with engine.connect() as connection:
+        connection.execute('CREATE TABLE t (id INTEGER PRIMARY KEY)')
+        with pytest.raises(IntegrityError):
+            connection.execute('INSERT INTO t VALUES (1), (1)')
+        assert 'querylog_start' not in connection.info
+
+        connection.execute('SELECT id FROM t')
+
+    stats = {s['statement']: s for s in querylog.get_stats()}
+    assert stats['SELECT id FROM t']['count'] == 1
+    assert 'INSERT INTO t VALUES (1), (1)' not in stats
@@ -0,0 +1,60 @@
+"""Tests of the full-text search over the news stories."""
+
+import datastore
+import flaskapp
+import pytest
+
+NEWS_APP = {'Authorization': 'Token news_app_token'}
+
+
+@pytest.fixture
+def client():
+    datastore.init()
+    datastore.delete_all_news_stories()
+    datastore.add_news_stories([
+        datastore.NewsStory(id=1, headline="Harbour report", content="The ferry was late again"),
+        datastore.NewsStory(id=2, headline="Ferry strike", content="Workers walk out"),
+        datastore.NewsStory(id=3, headline="Weather", content="Rain or sun near the harbour"),
+        datastore.NewsStory(id=4, headline="Ferry ferry", content="Another ferry story"),
+    ])
+    return flaskapp.app.test_client()
+
+
+def _search(client, query, **args):
+    response = client.get('/search', query_string=dict(args, q=query), headers=NEWS_APP)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def _ids(result):
+    return [story['id'] for story in result['stories']]
+
+
+def test_headline_matches_rank_first(client):
+    # Matches in the headline weigh more than those in the content; the
+    # story that only mentions the word in its content comes last
+    assert _ids(_search(client, 'ferry')) == [4, 2, 1]
+
+
+def test_all_words_must_match(client):
+    assert _ids(_search(client, 'ferry late')) == [1]
+    assert _ids(_search(client, 'ferry weather')) == []
+
+
+def test_operators_are_plain_words(client):
+    assert _ids(_search(client, 'rain OR sun')) == [3]
+    assert _ids(_search(client, 'ferry OR weather')) == []
+
+
+def test_pages(client):
+    first = _search(client, 'ferry', limit=2)
+    assert _ids(first) == [4, 2]
+    assert first['next'] == 2
+    second = _search(client, 'ferry', limit=2, offset=first['next'])
+    assert _ids(second) == [1]
+    assert second['next'] is None
+
+
+def test_empty_query_is_rejected(client):
+    response = client.get('/search', query_string={'q': ' '}, headers=NEWS_APP)
+    assert response.status_code == 400
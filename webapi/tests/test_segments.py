@@ -0,0 +1,76 @@
+"""Tests of the append-only segment files of the dead drop."""
+
+import os
+import pytest
+import segments
+
+RECORD_SIZE = 4
+HOUR = segments.SECONDS_PER_HOUR
+
+
+@pytest.fixture
+def store(tmp_path):
+    return segments.SegmentStore(str(tmp_path), RECORD_SIZE)
+
+
+def test_segments_rotate_every_hour(store):
+    now = 1000 * HOUR
+    store.append([b'aaaa', b'bbbb'], now=now)
+    store.append([b'cccc'], now=now + HOUR)
+
+    assert [s.hour for s in store.segments(24, now=now + HOUR)] == [1000, 1001]
+    rows = store.rows(24, now=now + HOUR)
+    assert [r.message for r in rows] == [b'aaaa', b'bbbb', b'cccc']
+    assert [r.id for r in rows] == [(1000 << 32) + 1, (1000 << 32) + 2, (1001 << 32) + 1]
+    assert store.last_id(24, now=now + HOUR) == (1001 << 32) + 1
+
+    since = [r.message for r in store.iter_rows(24, since=rows[0].id, now=now + HOUR)]
+    assert since == [b'bbbb', b'cccc']
+
+
+def test_prune_unlinks_expired_segments(store):
+    now = 1000 * HOUR
+    store.append([b'aaaa', b'bbbb'], now=now)
+    store.append([b'cccc'], now=now + 2 * HOUR)
+
+    assert store.prune(1, now=now + 2 * HOUR) == 2
+    assert [r.message for r in store.rows(24, now=now + 2 * HOUR)] == [b'cccc']
+    assert store.prune(1, now=now + 2 * HOUR) == 0
+
+
+def test_append_rejects_packets_of_the_wrong_size(store):
+    with pytest.raises(ValueError):
+        store.append([b'aaaa', b'bbb'])
+    assert store.segments(24) == []
+
+
+def test_append_drops_a_partial_record(store):
+    now = 1000 * HOUR
+    store.append([b'aaaa'], now=now)
+    path = store.segments(24, now=now)[0].path
+    with open(path, 'ab') as f:
+        # As left behind by a crash during an append
+        f.write(b'xx')
+
+    store.append([b'bbbb'], now=now)
+    assert [r.message for r in store.rows(24, now=now)] == [b'aaaa', b'bbbb']
+    assert os.path.getsize(path) == 2 * RECORD_SIZE
+
+
+def test_failed_append_drops_the_partial_batch(store, monkeypatch):
+    now = 1000 * HOUR
+    store.append([b'aaaa'], now=now)
+
+    write = os.write
+
+    def write_one_record(fd, data):
+        if len(data) < 2 * RECORD_SIZE:
+            raise OSError("disk full")
+        return write(fd, data[:RECORD_SIZE])
+
+    monkeypatch.setattr(os, 'write', write_one_record)
+    with pytest.raises(OSError):
+        store.append([b'bbbb', b'cccc'], now=now)
+    monkeypatch.undo()
+
+    assert [r.message for r in store.rows(24, now=now)] == [b'aaaa']
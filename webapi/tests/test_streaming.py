@@ -0,0 +1,53 @@
+"""Checks that `/deaddrop` streams the dead drop from the database without
+holding the whole response in memory.
+
+Run from the `webapi` folder with `python -m pytest tests`.
+"""
+
+import datastore
+import flaskapp
+import os
+import pytest
+import tracemalloc
+import wire
+
+# Upper bound for the memory allocated while streaming. The JSON body of the
+# larger dead drop alone is about 36 MB.
+MAX_PEAK_BYTES = 8 * 1024 * 1024
+
+
+def _fill_dead_drop(count, batch_size=5000):
+    datastore.delete_all_messages()
+    for start in range(0, count, batch_size):
+        n = min(batch_size, count - start)
+        datastore.add_dead_drop_messages([os.urandom(wire.DEAD_DROP_MESSAGE_SIZE) for _ in range(n)])
+
+
+def _stream_dead_drop():
+    """Returns the size of the streamed body and the peak of the memory
+    allocated while it was produced.
+    """
+    client = flaskapp.app.test_client()
+    tracemalloc.start()
+    try:
+        response = client.get('/deaddrop', headers={'Authorization': 'Token news_app_token'}, buffered=False)
+        assert response.status_code == 200
+        assert response.is_streamed
+        size = 0
+        for chunk in response.response:
+            size += len(chunk)
+        response.close()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return size, peak
+
+
+@pytest.mark.parametrize('count', [5000, 50000])
+def test_dead_drop_is_streamed_in_bounded_memory(count):
+    _fill_dead_drop(count)
+    size, peak = _stream_dead_drop()
+
+    # Two hex characters per byte, the quotes, and the commas and brackets
+    assert size == count * (2 * wire.DEAD_DROP_MESSAGE_SIZE + 3) + 1
+    assert peak < MAX_PEAK_BYTES
@@ -0,0 +1,46 @@
+"""Tests of the binary wire format."""
+
+import collections
+import pytest
+import wire
+
+Message = collections.namedtuple('Message', ['id', 'message'])
+
+
+def test_round_trip():
+    packets = [bytes([i]) * 4 for i in range(3)]
+    body = wire.encode(packets, 4)
+    assert body[:wire.HEADER.size] == wire.HEADER.pack(b'CD', 1, 4, 3)
+    assert wire.decode(body, 4) == packets
+
+
+def test_round_trip_of_empty_body():
+    assert wire.decode(wire.encode([], 4), 4) == []
+
+
+def test_records_with_ids():
+    body = wire.encode_with_ids([Message(7, b'aaaa'), Message(2 ** 40, b'bbbb')], 4)
+    assert wire.HEADER.unpack_from(body) == (b'CD', 1, 12, 2)
+    records = wire.decode(body, 12)
+    assert [(wire.ID.unpack_from(r)[0], r[wire.ID.size:]) for r in records] == [(7, b'aaaa'), (2 ** 40, b'bbbb')]
+
+
+def test_encode_rejects_packets_of_the_wrong_size():
+    with pytest.raises(wire.WireFormatError):
+        wire.encode([b'aaaa', b'bbb'], 4)
+    with pytest.raises(wire.WireFormatError):
+        wire.encode_with_ids([Message(1, b'aaaaa')], 4)
+
+
+@pytest.mark.parametrize('body', [
+    b'',
+    b'CD\x01',
+    wire.HEADER.pack(b'XX', 1, 4, 1) + b'aaaa',
+    wire.HEADER.pack(b'CD', 2, 4, 1) + b'aaaa',
+    wire.HEADER.pack(b'CD', 1, 5, 1) + b'aaaaa',
+    wire.HEADER.pack(b'CD', 1, 4, 2) + b'aaaa',
+    wire.HEADER.pack(b'CD', 1, 4, 1) + b'aaaab',
+])
+def test_decode_rejects_invalid_bodies(body):
+    with pytest.raises(wire.WireFormatError):
+        wire.decode(body, 4)